@@ -0,0 +1,182 @@
+import ast
+import math
+import os
+import pstats
+from prompt_compaction import _call_name, _is_logging
+
+"""
+Profiling of generated backtests.
+A backtest run under cProfile (see backtest_runner.execute_code()) is summarised into a hot-spot report: the time of
+every method of the generated code, attributed to its class, the functions with the most own time and the bars
+processed per second. Static hints point at code that typically makes next() slow: indicators created on every bar,
+loops over the price history and per-bar logging. The report is written to be sent to the coding agent together with
+the code, see BtCopilot.optimise_speed().
+"""
+
+CODE_FILENAME = '<generated backtest>'
+
+# methods of a strategy that run on every bar
+_PER_BAR_METHODS = {'next', 'prenext', 'nextstart'}
+
+
+def code_functions(code):
+    '''
+    qualified names of the functions defined in the code by the line of their code object.
+    :param code: str
+    :return: functions: dict mapping first line to name, e.g. {42: 'SmaCross.next'}
+    '''
+    functions = {}
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.ClassDef):
+                visit(child, f'{prefix}{child.name}.')
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                # the code object of a decorated function starts at its first decorator
+                line = min([child.lineno] + [decorator.lineno for decorator in child.decorator_list])
+                functions[line] = f'{prefix}{child.name}'
+                visit(child, f'{prefix}{child.name}.')
+            else:
+                visit(child, prefix)
+        return
+
+    visit(ast.parse(code), '')
+    return functions
+
+
+def _is_indicator(call):
+    # bt.indicators.SMA(...), bt.ind.RSI(...), btind.MACD(...)
+    path = ast.unparse(call.func)
+    return any(part in ('ind', 'indicators', 'btind', 'talib') for part in path.split('.')[:-1])
+
+
+def static_hints(code):
+    '''
+    code patterns in per-bar methods that are slow in backtrader.
+    :param code: str
+    :return: hints: list of str
+    '''
+    hints = []
+    for cls in ast.walk(ast.parse(code)):
+        if not isinstance(cls, ast.ClassDef):
+            continue
+        for method in cls.body:
+            if not (isinstance(method, ast.FunctionDef) and method.name in _PER_BAR_METHODS):
+                continue
+            name = f'{cls.name}.{method.name}'
+            for node in ast.walk(method):
+                if isinstance(node, ast.Call) and _is_indicator(node):
+                    hints.append(f'line {node.lineno}: {name} creates the indicator {_call_name(node)} on every bar, '
+                                 f'create it once in __init__()')
+                elif isinstance(node, (ast.For, ast.While)):
+                    hints.append(f'line {node.lineno}: {name} loops in python on every bar, use an indicator or '
+                                 f'keep a running value instead')
+                elif isinstance(node, ast.Call) and _call_name(node) == 'get' and \
+                        any(keyword.arg == 'size' for keyword in node.keywords):
+                    hints.append(f'line {node.lineno}: {name} copies the price history on every bar')
+                elif isinstance(node, ast.stmt) and _is_logging(node) and node in method.body:
+                    hints.append(f'line {node.lineno}: {name} formats a log message on every bar')
+    return hints
+
+
+def profile_summary(profiler, code, runtime, bars, filename = CODE_FILENAME, top = 15):
+    '''
+    hot-spot report of a profiled backtest run.
+    :param profiler: cProfile.Profile, disabled
+    :param code: str, the profiled code
+    :param runtime: float, seconds of the profiled run
+    :param bars: int, bars processed by all strategies
+    :param filename: str, file name the code was compiled with
+    :param top: int, number of hot spots
+    :return: report: dict with keys runtime, bars, bars_per_second, methods (generated functions by cumulative time),
+    hot_spots (all functions by own time) and hints
+    '''
+    functions = code_functions(code)
+    rows = []
+    for (file, line, function), (_, calls, own_time, cumulative_time, _) in pstats.Stats(profiler).stats.items():
+        generated = file == filename
+        if generated:
+            name = functions.get(line, function)
+        elif file == '~':
+            # built-in functions
+            name = function
+        else:
+            path = file.replace(os.sep, '/').rsplit('site-packages/', 1)[-1]
+            name = f'{path}:{line}({function})'
+        rows.append({'function': name, 'generated': generated, 'calls': calls,
+                     'own_time': own_time, 'cumulative_time': cumulative_time})
+
+    total = sum(row['own_time'] for row in rows) or math.inf
+    for row in rows:
+        row['share'] = row['cumulative_time'] / total
+        row['per_bar_us'] = row['cumulative_time'] / bars * 1e6 if bars else None
+
+    methods = sorted((row for row in rows if row['generated'] and row['function'] != '<module>'),
+                     key=lambda row: row['cumulative_time'], reverse=True)
+    hot_spots = sorted(rows, key=lambda row: row['own_time'], reverse=True)[:top]
+    return {'runtime': runtime,
+            'bars': bars,
+            'bars_per_second': bars / runtime if runtime else None,
+            'methods': methods,
+            'hot_spots': hot_spots,
+            'hints': static_hints(code)}
+
+
+def format_report(report, top = 10):
+    '''
+    text of a hot-spot report, for the console and the coding agent.
+    :param report: dict, see profile_summary()
+    :param top: int, rows per section
+    :return: str
+    '''
+    lines = [f"{report['bars']} bars in {report['runtime']:.3f} s under the profiler"
+             + (f" ({report['bars_per_second']:.0f} bars/s)" if report['bars_per_second'] else '')]
+    if report['methods']:
+        lines.append('Methods of the strategy code (cumulative time, share of the run, time per bar, calls):')
+        for row in report['methods'][:top]:
+            per_bar = f"{row['per_bar_us']:.1f} us/bar" if row['per_bar_us'] is not None else ''
+            lines.append(f"  {row['function']}: {row['cumulative_time']:.3f} s, {row['share']:.1%}, {per_bar}, "
+                         f"{row['calls']} calls")
+    lines.append('Hot spots (own time, calls):')
+    for row in report['hot_spots'][:top]:
+        lines.append(f"  {row['function']}: {row['own_time']:.3f} s, {row['calls']} calls")
+    if report['hints']:
+        lines.append('Hints:')
+        lines.extend(f'  {hint}' for hint in report['hints'])
+    return '\n'.join(lines)
+
+
+def compare_results(first, second, rel_tol = 1e-9):
+    '''
+    compares the outcome of two backtest runs recorded with record=True: final value, closed trades and metrics.
+    :param first: dict, see backtest_runner.execute_code()
+    :param second: dict
+    :param rel_tol: float, relative tolerance of numbers
+    :return: differences: list of str, empty if the results are identical
+    '''
+    def same(a, b):
+        if isinstance(a, float) or isinstance(b, float):
+            if a is None or b is None:
+                return a is b
+            return math.isclose(a, b, rel_tol=rel_tol, abs_tol=1e-12) or (math.isnan(a) and math.isnan(b))
+        return a == b
+
+    differences = []
+    if not same(first.get('final_value'), second.get('final_value')):
+        differences.append(f"final value {first.get('final_value')} != {second.get('final_value')}")
+
+    trades, other_trades = first.get('trades') or [], second.get('trades') or []
+    if len(trades) != len(other_trades):
+        differences.append(f'{len(trades)} != {len(other_trades)} closed trades')
+    else:
+        for index, (trade, other) in enumerate(zip(trades, other_trades)):
+            keys = [key for key in trade if not same(trade[key], other.get(key))]
+            if keys:
+                differences.append(f"trade {index} differs in {', '.join(keys)}")
+                break
+
+    metrics, other_metrics = first.get('metrics') or {}, second.get('metrics') or {}
+    keys = [key for key in metrics if not same(metrics[key], other_metrics.get(key))]
+    if keys:
+        differences.append(f"metrics differ: {', '.join(keys)}")
+    return differences
@@ -0,0 +1,414 @@
+import ast
+import contextlib
+import io
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+import types
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import backtrader as bt
+import data_cache
+import strategy_loader
+
+"""
+In-process execution of generated backtests.
+Generated code runs inside a warm worker process that has already imported backtrader, pandas and matplotlib.
+Cerebro instances created by the code are recorded, so analyzer results come back as Python objects instead of
+printed text. Plots are rendered to file instead of opening a window.
+"""
+
+
+def to_plain(value):
+    '''
+    converts analyzer output (AutoOrderedDict, OrderedDict, datetime keys, numpy scalars) into plain python objects.
+    :param value: analysis
+    :return: plain value: dict, list, str, int, float, bool or None
+    '''
+    if isinstance(value, dict):
+        return {(key.isoformat() if hasattr(key, 'isoformat') else str(key) if not isinstance(key, (str, int, float))
+                 else key): to_plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_plain(item) for item in value]
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'item') and callable(value.item):
+        # numpy scalar
+        return value.item()
+    return value
+
+
+# names of the analyzers added by the runner, left out of the analyzer results
+_BAR_LIMIT = '_bar_limit'
+_RECORDER = '_recorder'
+
+
+class _BarLimit(bt.Analyzer):
+    """
+    Stops the run once the strategy has processed max_bars bars after its warm-up period.
+    """
+    params = (('max_bars', None),)
+
+    def start(self):
+        self.bars = 0
+
+    def prenext(self):
+        # Analyzer.prenext() calls next(), warm-up bars must not count
+        pass
+
+    def next(self):
+        self.bars += 1
+        if self.bars >= self.p.max_bars:
+            self.strategy.env.runstop()
+
+    def get_analysis(self):
+        return {'bars': self.bars}
+
+
+class _Recorder(bt.Analyzer):
+    """
+    Records the portfolio value after every bar and every closed trade.
+    """
+    def start(self):
+        self.datetimes = []
+        self.values = []
+        self.trades = []
+
+    def next(self):
+        self.datetimes.append(self.strategy.datetime[0])
+        self.values.append(self.strategy.broker.getvalue())
+
+    def notify_trade(self, trade):
+        if not trade.isclosed:
+            return
+        self.trades.append({'data': trade.data._name or str(self.strategy.datas.index(trade.data)),
+                            'long': bool(trade.long),
+                            'open': bt.num2date(trade.dtopen).isoformat(),
+                            'close': bt.num2date(trade.dtclose).isoformat(),
+                            'bars': trade.barlen,
+                            'price': trade.price,
+                            'pnl': trade.pnl,
+                            'pnl_net': trade.pnlcomm})
+
+    def get_analysis(self):
+        return {'equity_curve': {'datetime': [bt.num2date(value).isoformat() for value in self.datetimes],
+                                 'value': self.values},
+                'trades': self.trades}
+
+
+def _recording_cerebro(records, plot_path, max_bars = None, record = False):
+    '''
+    builds a Cerebro subclass that records every run and renders plots to file.
+    :param records: list receiving (cerebro, strategies) for every run
+    :param plot_path: str or None, png file for cerebro.plot(). None skips plotting.
+    :param max_bars: int or None, stop every run after this many bars past the indicator warm-up
+    :param record: bool, record the equity curve, the closed trades and the sweep metrics of every strategy
+    :return: class
+    '''
+    class RecordingCerebro(bt.Cerebro):
+        def run(self, **kwargs):
+            if max_bars:
+                self.addanalyzer(_BarLimit, max_bars=max_bars, _name=_BAR_LIMIT)
+            if record:
+                from optimiser import SWEEP_ANALYZERS
+                self.addanalyzer(_Recorder, _name=_RECORDER)
+                for name, analyzer, analyzer_kwargs in SWEEP_ANALYZERS:
+                    self.addanalyzer(analyzer, _name=f'{_RECORDER}_{name}', **analyzer_kwargs)
+            strategies = super(RecordingCerebro, self).run(**kwargs)
+            records.append((self, strategies))
+            return strategies
+
+        def plot(self, *args, **kwargs):
+            if plot_path is None:
+                return []
+            kwargs['iplot'] = False
+            figures = super(RecordingCerebro, self).plot(*args, **kwargs)
+            for i, figure in enumerate(fig for run_figures in figures for fig in run_figures):
+                root, extension = os.path.splitext(plot_path)
+                figure.savefig(plot_path if i == 0 else f'{root}_{i}{extension}')
+            return figures
+
+    return RecordingCerebro
+
+
+def _cached_feeds(code, cache_dir):
+    '''
+    builds replacements for the CSV feed classes called in the code, reading from the memory-mapped data cache.
+    Feed classes that the code subclasses are left untouched.
+    :param code: str
+    :param cache_dir: str
+    :return: replacements: dict mapping feed class name to factory
+    '''
+    tree = ast.parse(code)
+    subclassed = {base.attr if isinstance(base, ast.Attribute) else getattr(base, 'id', None)
+                  for node in ast.walk(tree) if isinstance(node, ast.ClassDef) for base in node.bases}
+
+    replacements = {}
+    for feed_spec in strategy_loader.parse_backtest_spec(code)['feeds']:
+        name = feed_spec['feed']
+        if name in subclassed or data_cache.memmap_feed_kwargs(feed_spec) is None:
+            continue
+
+        # bound as defaults with private names, the feed itself takes a name= keyword
+        def factory(_original=getattr(bt.feeds, name), _feed_name=name, **kwargs):
+            memmap_kwargs = data_cache.memmap_feed_kwargs({'feed': _feed_name, 'kwargs': kwargs},
+                                                          feed_cls=_original)
+            if memmap_kwargs is None or not os.path.exists(memmap_kwargs['dataname']):
+                return _original(**kwargs)
+            memmap_kwargs['cache_dir'] = cache_dir
+            return data_cache.MemmapData(**memmap_kwargs)
+
+        replacements[name] = factory
+    return replacements
+
+
+def execute_code(code, cwd = None, plot_path = None, cache_dir = None, max_bars = None, record = False,
+                 profile = False):
+    '''
+    executes generated code in the current process and collects the results of all Cerebro runs.
+    Intended to be called inside a worker process, see BacktestRunner.
+    :param code: str
+    :param cwd: str, working directory for relative data paths
+    :param plot_path: str or None
+    :param cache_dir: str or None, market data cache directory. None reads CSV feeds as written in the code.
+    :param max_bars: int or None, stop every Cerebro run after this many bars past the indicator warm-up
+    :param record: bool, add the equity curve, the closed trades and the metrics of optimiser.flatten_analysis() of
+    every strategy to the result
+    :param profile: bool, run the code under cProfile and add the hot-spot report of backtest_profiler to the result
+    :return: result: dict with keys ok, error, stdout, runtime, final_value, analyzers, runs (and equity_curve, trades
+    and metrics if recorded, profile if profiled)
+    '''
+    records = []
+    result = {'ok': True, 'error': None, 'stdout': '', 'runtime': None,
+              'final_value': None, 'analyzers': {}, 'runs': []}
+
+    previous_cwd = os.getcwd()
+    original_cerebro = bt.Cerebro
+    original_feeds = {}
+    stdout = io.StringIO()
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        if cwd:
+            os.chdir(cwd)
+
+        # route Cerebro and CSV feeds through recording/cached replacements
+        bt.Cerebro = _recording_cerebro(records, plot_path, max_bars, record)
+        if cache_dir is not None:
+            for name, factory in _cached_feeds(code, cache_dir).items():
+                original_feeds[name] = getattr(bt.feeds, name)
+                setattr(bt.feeds, name, factory)
+
+        module = types.ModuleType('__main__')
+        module.__file__ = '<generated backtest>'
+        previous_main = sys.modules.get('__main__')
+        sys.modules['__main__'] = module
+        try:
+            with contextlib.redirect_stdout(stdout):
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    exec(compile(code, '<generated backtest>', 'exec'), module.__dict__)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+        finally:
+            if previous_main is not None:
+                sys.modules['__main__'] = previous_main
+
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            result['ok'] = False
+            result['error'] = f'SystemExit: {e.code}'
+    except BaseException as e:
+        result['ok'] = False
+        result['error'] = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+    finally:
+        bt.Cerebro = original_cerebro
+        for name, feed in original_feeds.items():
+            setattr(bt.feeds, name, feed)
+        os.chdir(previous_cwd)
+
+    result['runtime'] = time.perf_counter() - start
+    result['stdout'] = stdout.getvalue()
+
+    bars = 0
+    for cerebro, strategies in records:
+        run = {'final_value': cerebro.broker.getvalue(), 'strategies': []}
+        for strategy in strategies:
+            # optimisation runs return lists of strategies
+            for instance in (strategy if isinstance(strategy, list) else [strategy]):
+                bars += len(instance)
+                analyzers = {name: to_plain(analyzer.get_analysis())
+                             for name, analyzer in zip(instance.analyzers.getnames(), instance.analyzers)
+                             if name != _BAR_LIMIT and not name.startswith(_RECORDER)}
+                run['strategies'].append({'strategy': type(instance).__name__,
+                                          'params': to_plain(dict(instance.params._getkwargs())),
+                                          'analyzers': analyzers})
+                if record:
+                    from optimiser import SWEEP_ANALYZERS, flatten_analysis
+                    run['strategies'][-1].update(getattr(instance.analyzers, _RECORDER).get_analysis())
+                    sweep_analyzers = types.SimpleNamespace(**{name: getattr(instance.analyzers, f'{_RECORDER}_{name}')
+                                                               for name, _, _ in SWEEP_ANALYZERS})
+                    run['strategies'][-1]['metrics'] = to_plain(flatten_analysis(sweep_analyzers))
+        result['runs'].append(run)
+
+    # shortcut to the first strategy of the last run
+    if result['runs']:
+        last_run = result['runs'][-1]
+        result['final_value'] = last_run['final_value']
+        if last_run['strategies']:
+            result['analyzers'] = last_run['strategies'][0]['analyzers']
+            if record:
+                result['equity_curve'] = last_run['strategies'][0]['equity_curve']
+                result['trades'] = last_run['strategies'][0]['trades']
+                result['metrics'] = last_run['strategies'][0]['metrics']
+
+    if profiler is not None:
+        from backtest_profiler import profile_summary
+        result['profile'] = profile_summary(profiler, code, result['runtime'], bars)
+    return result
+
+
+def _start_worker(pids):
+    '''
+    initialises a worker process: reports its pid, so a stuck worker can be terminated, and warms it up.
+    :param pids: multiprocessing queue
+    :return:
+    '''
+    pids.put(os.getpid())
+    _warm_up()
+
+
+def _warm_up():
+    '''
+    imports the heavy dependencies once per worker process.
+    :return:
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+    try:
+        import pandas
+    except ImportError:
+        pass
+
+
+class BacktestRunner:
+    """
+    Runs generated backtests in a pool of warm, reusable worker processes.
+    Each run is isolated from the copilot process, but pays neither interpreter startup nor the backtrader, pandas and
+    matplotlib imports.
+    """
+    def __init__(self, max_workers = 1, cache_dir = None):
+        """
+        Constructs a new backtest runner. Worker processes are started on first use.
+        Args:
+            max_workers: number of warm worker processes
+            cache_dir: market data cache directory. CSV feeds are served from the memory-mapped cache if set.
+        """
+        self.max_workers = max_workers
+        # runs change into their working directory, keep the cache location fixed
+        self.cache_dir = os.path.abspath(cache_dir) if cache_dir else None
+        self._executor = None
+        # worker pids reported by _start_worker
+        self._pids = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._pids = multiprocessing.SimpleQueue()
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_start_worker,
+                                                 initargs=(self._pids,))
+        return self._executor
+
+    def _terminate_workers(self):
+        '''
+        terminates the worker processes that have started so far.
+        :return:
+        '''
+        while not self._pids.empty():
+            try:
+                os.kill(self._pids.get(), signal.SIGTERM)
+            except OSError:
+                # already exited
+                pass
+        return
+
+    def warm_up(self, wait = True):
+        '''
+        starts the worker processes ahead of the first run.
+        :param wait: bool, False returns at once while the workers import their dependencies in the background
+        :return:
+        '''
+        executor = self._get_executor()
+        futures = [executor.submit(_warm_up) for _ in range(self.max_workers)]
+        if wait:
+            for future in futures:
+                future.result()
+        return
+
+    def submit(self, code, cwd = None, plot_path = None, max_bars = None, record = False, profile = False):
+        '''
+        schedules a run and returns immediately.
+        :param code: str
+        :param cwd: str
+        :param plot_path: str or None
+        :param max_bars: int or None, see execute_code()
+        :param record: bool, see execute_code()
+        :param profile: bool, see execute_code()
+        :return: concurrent.futures.Future resolving to the result dict of execute_code()
+        '''
+        return self._get_executor().submit(execute_code, code, cwd or os.getcwd(), plot_path, self.cache_dir, max_bars,
+                                           record, profile)
+
+    def run(self, code, cwd = None, plot_path = None, timeout = None, max_bars = None, record = False,
+            profile = False):
+        '''
+        runs generated code in a warm worker and waits for the result.
+        :param code: str
+        :param cwd: str, working directory for relative data paths, defaults to the current directory
+        :param plot_path: str or None, png file for cerebro.plot()
+        :param timeout: seconds, None waits indefinitely
+        :param max_bars: int or None, short smoke run: stop after this many bars past the indicator warm-up
+        :param record: bool, add the equity curve, the closed trades and the metrics to the result
+        :param profile: bool, add a hot-spot report of the run to the result, see backtest_profiler
+        :return: result: dict, see execute_code()
+        '''
+        start = time.perf_counter()
+        try:
+            future = self.submit(code, cwd=cwd, plot_path=plot_path, max_bars=max_bars, record=record, profile=profile)
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # a stuck run cannot be interrupted, replace the workers
+            self.close(kill=True)
+            return {'ok': False, 'error': f'backtest did not finish within {timeout} seconds', 'stdout': '',
+                    'runtime': timeout, 'final_value': None, 'analyzers': {}, 'runs': []}
+        except BrokenProcessPool as e:
+            # a worker died (os._exit, segfault, out of memory), the pool cannot be used again
+            self.close(kill=True)
+            return {'ok': False, 'error': f'backtest worker terminated abruptly: {type(e).__name__}: {str(e)}',
+                    'stdout': '', 'runtime': time.perf_counter() - start, 'final_value': None, 'analyzers': {},
+                    'runs': []}
+
+    def close(self, kill = False):
+        '''
+        shuts the worker processes down.
+        :param kill: bool, terminate running workers instead of waiting for them
+        :return:
+        '''
+        if self._executor is None:
+            return
+        if kill:
+            # ProcessPoolExecutor has no public api to stop a running task
+            self._terminate_workers()
+        self._executor.shutdown(wait=not kill, cancel_futures=True)
+        self._executor = None
+        self._pids.close()
+        self._pids = None
+        return
@@ -0,0 +1,294 @@
+import csv
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+"""
+Batch code generation.
+Generates one backtest per row of a table of strategy descriptions (CSV or JSONL). Rows are sent to the coding agent
+concurrently, throttled by a shared requests-per-minute limiter, and failed calls are retried with exponential backoff.
+Every result is written to its own code file and recorded in a JSONL manifest, so a rerun skips finished rows.
+"""
+
+# prompt elements read from the batch table, see BtCopilot.prompt_elements
+PROMPT_ELEMENTS = ('datapipeline', 'strategy', 'analysers', 'custom')
+
+# prompt templates applied to the descriptions like BtCopilot.set_<element>(), custom text is used as it is
+ELEMENT_TEMPLATES = {'datapipeline': 'set_datapipeline',
+                     'strategy': 'set_strategy',
+                     'analysers': 'set_analysers'}
+
+
+def load_batch(path):
+    '''
+    reads a table of strategy descriptions. Columns: name (optional), datapipeline, strategy, analysers, custom.
+    Missing columns are left empty and filled with the batch defaults.
+    :param path: str, .csv or .jsonl file
+    :return: rows: list of dict
+    '''
+    if path.endswith('.jsonl'):
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, newline='') as f:
+            rows = [dict(row) for row in csv.DictReader(f)]
+
+    # rows without any description are skipped
+    return [row for row in rows if any((row.get(element) or '').strip() for element in PROMPT_ELEMENTS)]
+
+
+def _slug(text):
+    '''
+    file name safe version of a row name.
+    :param text: str
+    :return: slug: str
+    '''
+    slug = re.sub(r'[^A-Za-z0-9_-]+', '_', text.strip()).strip('_')
+    return slug[:60] or 'strategy'
+
+
+def _is_rate_limit_error(error):
+    '''
+    checks if an exception signals an exceeded api rate limit, without importing the openai package.
+    :param error: Exception
+    :return: bool
+    '''
+    return 'ratelimit' in type(error).__name__.lower() or '429' in str(error)
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket limiting the number of requests per minute.
+    A rate limit error reported by any worker pauses all workers for the cooldown period.
+    """
+    def __init__(self, requests_per_minute = 60, burst = None):
+        """
+        Constructs a new rate limiter.
+        Args:
+            requests_per_minute: sustained request rate. None disables throttling.
+            burst: number of requests that may be sent at once, defaults to one second of requests (at least 1)
+        """
+        self.requests_per_minute = requests_per_minute
+        self.rate = requests_per_minute / 60.0 if requests_per_minute else None
+        self.capacity = float(burst) if burst else max(1.0, self.rate or 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        blocks until a request may be sent.
+        :return: waited seconds: float
+        '''
+        if self.rate is None and self._paused_until <= time.monotonic():
+            return 0.0
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self.rate is None:
+                    return waited
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return waited
+                    delay = (1.0 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        '''
+        stops all requests for a cooldown period, e.g. after a rate limit error.
+        :param seconds: float
+        :return:
+        '''
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+        return
+
+
+class BatchGenerator:
+    """
+    Generates backtest code for many strategy descriptions concurrently.
+    Prompts are composed with the prompt library of a BtCopilot, the llm calls go through its coding agent.
+    """
+    def __init__(self, copilot, output_dir, max_workers = 8, requests_per_minute = 60, max_retries = 4,
+                 backoff = 2.0, max_backoff = 60.0):
+        """
+        Constructs a new batch generator.
+        Args:
+            copilot: BtCopilot providing the prompt library, settings and coding agent
+            output_dir: directory receiving one code file per row and manifest.jsonl
+            max_workers: number of concurrent llm calls
+            requests_per_minute: shared request budget of all workers, None disables throttling
+            max_retries: retries per row after the first failed attempt
+            backoff: initial retry delay in seconds, doubled after every failed attempt
+            max_backoff: upper bound of the retry delay in seconds
+        """
+        self.copilot = copilot
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(requests_per_minute=requests_per_minute)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.manifest_path = os.path.join(output_dir, 'manifest.jsonl')
+        self._manifest_lock = threading.Lock()
+
+    def _completed(self):
+        '''
+        reads the manifest of previous runs.
+        :return: completed rows: dict mapping prompt hash to manifest entry
+        '''
+        completed = {}
+        if not os.path.exists(self.manifest_path):
+            return completed
+        with open(self.manifest_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # partially written last line of an interrupted run
+                    continue
+                if entry.get('ok') and os.path.exists(os.path.join(self.output_dir, entry['file'])):
+                    completed[entry['prompt_sha1']] = entry
+        return completed
+
+    def _record(self, entry):
+        '''
+        appends an entry to the manifest.
+        :param entry: dict
+        :return:
+        '''
+        with self._manifest_lock:
+            with open(self.manifest_path, 'a+') as f:
+                if f.tell() > 0:
+                    f.seek(f.tell() - 1)
+                    if f.read(1) != '\n':
+                        # end the incomplete last line of an interrupted run, the entry must not be part of it
+                        f.write('\n')
+                f.write(json.dumps(entry) + '\n')
+        return
+
+    def _call_with_retries(self, prompt, temperature):
+        '''
+        sends a prompt to the coding agent, retrying failed calls with exponential backoff and jitter.
+        :param prompt: str
+        :param temperature: float
+        :return: (code, attempts, error): code is None if all attempts failed
+        '''
+        error = None
+        for attempt in range(1, self.max_retries + 2):
+            self.rate_limiter.acquire()
+            try:
+                code = self.copilot.coding_agent.code(prompt=prompt, temperature=temperature,
+                                                      goal_code='build_code')
+                return code, attempt, None
+            except Exception as e:
+                error = f'{type(e).__name__}: {str(e)}'
+                if attempt > self.max_retries:
+                    break
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                if _is_rate_limit_error(e):
+                    # every worker would hit the same limit, slow all of them down
+                    self.rate_limiter.pause(delay)
+                time.sleep(delay)
+        return None, self.max_retries + 1, error
+
+    def compose_prompt(self, elements):
+        '''
+        composes the prompt of one row the same way as the serial flow (set_datapipeline(), set_strategy(),
+        set_analysers(), set_custom_prompt() and compose_prompt_from_elements()), so both produce identical prompts.
+        :param elements: dict mapping the keys of PROMPT_ELEMENTS to descriptions
+        :return: prompt: str
+        '''
+        prompt_elements = {}
+        for element in PROMPT_ELEMENTS:
+            user_input = elements.get(element) or ''
+            if user_input and element in ELEMENT_TEMPLATES:
+                user_input = self.copilot.prompt_library.format(ELEMENT_TEMPLATES[element], user_input=user_input)
+            prompt_elements[element] = user_input
+        return self.copilot.compose_prompt(prompt_elements)
+
+    def _generate(self, index, row, prompt, file_name):
+        '''
+        generates and saves the code of one row.
+        :return: manifest entry: dict
+        '''
+        start = time.perf_counter()
+        code, attempts, error = self._call_with_retries(prompt, temperature=self.copilot.settings['coding_temp'])
+        if code is not None:
+            with open(os.path.join(self.output_dir, file_name), 'w') as f:
+                f.write(code)
+
+        entry = {'index': index,
+                 'name': row.get('name') or '',
+                 'file': file_name,
+                 'ok': code is not None,
+                 'attempts': attempts,
+                 'error': error,
+                 'runtime': round(time.perf_counter() - start, 3),
+                 'prompt_sha1': hashlib.sha1(prompt.encode('utf-8')).hexdigest()}
+        self._record(entry)
+        return entry
+
+    def run(self, rows, defaults = None, resume = True):
+        '''
+        generates code for all rows.
+        :param rows: list of dict with prompt element descriptions, see load_batch()
+        :param defaults: dict of prompt element descriptions used for empty columns, e.g. a shared datapipeline
+        :param resume: bool, skip rows whose identical prompt was generated successfully by a previous run
+        :return: manifest entries of this batch in row order: list of dict
+        '''
+        defaults = defaults or {}
+        os.makedirs(self.output_dir, exist_ok=True)
+        if not resume and os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        completed = self._completed() if resume else {}
+
+        # prompts are composed up front, the workers only wait for the llm
+        jobs = []
+        entries = [None] * len(rows)
+        used_names = set()
+        for index, row in enumerate(rows):
+            elements = {element: (row.get(element) or defaults.get(element) or '').strip()
+                        for element in PROMPT_ELEMENTS}
+            prompt = self.compose_prompt(elements)
+
+            file_name = f"{index:04d}_{_slug(row.get('name') or elements['strategy'][:40])}.py"
+            while file_name in used_names:
+                file_name = f'_{file_name}'
+            used_names.add(file_name)
+
+            previous = completed.get(hashlib.sha1(prompt.encode('utf-8')).hexdigest())
+            if previous is not None:
+                entries[index] = dict(previous, index=index, skipped=True)
+            else:
+                jobs.append((index, row, prompt, file_name))
+
+        if jobs and not self.copilot.coding_agent.test_mode:
+            # create the shared client pool before the workers race for it
+            self.copilot.coding_agent.client_pool
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._generate, *job) for job in jobs]
+            for future in as_completed(futures):
+                entry = future.result()
+                entries[entry['index']] = entry
+                status = 'ok' if entry['ok'] else f"failed ({entry['error']})"
+                print(f"[{sum(e is not None for e in entries)}/{len(rows)}] {entry['file']}: {status}")
+
+        return entries
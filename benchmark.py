@@ -0,0 +1,449 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from metrics import percentile
+
+"""
+Offline benchmark suite.
+Runs copilot workflows against a local MockLLMServer with a realistic latency profile and canned backtrader answers,
+so end-to-end performance can be measured without API calls or costs. Every scenario runs in a fresh working
+directory (empty caches). Results are stored as JSON with a fixed layout and can be compared against a baseline to
+catch performance regressions:
+
+    python benchmark.py --profile fast --repeat 3 --output bench.json
+    python benchmark.py --profile fast --repeat 3 --baseline bench.json
+"""
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = ('main_example', 'copilot_workflow', 'batch_generation', 'backtest_execution')
+
+# layout version of the stored results
+RESULTS_SCHEMA = 1
+
+_DESCRIPTION_ANSWER = '''
+- Data: daily BTC-USD candles from Yahoo Finance
+- Indicators: fast simple moving average (10) and slow simple moving average (30)
+- Entry: buy when the fast average crosses above the slow average and no position is open
+- Exit: sell on the opposite crossover, at +15% take profit or at -10% stop loss
+- Sizing: fixed stake of 10 units
+'''
+
+_VISUALISATION_ANSWER = '''
+print('digraph strategy { data -> sma_fast; data -> sma_slow; sma_fast -> crossover; sma_slow -> crossover; }')
+'''
+
+
+def canned_responder(prompt):
+    '''
+    answers copilot prompts like a completion model would: backtrader code for coding prompts, a plotting script for
+    visualisation prompts and a bullet point text otherwise.
+    :param prompt: str
+    :return: completion: str
+    '''
+    lowered = prompt.lower()
+    if 'graphviz' in lowered or 'flowchart of the following' in lowered:
+        return _VISUALISATION_ANSWER
+    if lowered.startswith('generate python code for the backtrader framework'):
+        with open(os.path.join(REPO_DIR, 'resources', 'example_backtest.py')) as f:
+            return f.read()
+    return _DESCRIPTION_ANSWER
+
+
+def write_synthetic_yahoo_csv(path, start = datetime.date(2019, 1, 1), days = 1600, seed = 0):
+    '''
+    writes a deterministic random-walk price series in the Yahoo Finance CSV format.
+    :param path: str
+    :param start: datetime.date
+    :param days: int
+    :param seed: int
+    :return:
+    '''
+    rng = random.Random(seed)
+    close = 4000.0
+    with open(path, 'w') as f:
+        f.write('Date,Open,High,Low,Close,Adj Close,Volume\n')
+        for day in range(days):
+            open_ = close
+            close = max(100.0, open_ * (1.0 + rng.gauss(0.0005, 0.03)))
+            high = max(open_, close) * (1.0 + abs(rng.gauss(0.0, 0.01)))
+            low = min(open_, close) * (1.0 - abs(rng.gauss(0.0, 0.01)))
+            date = start + datetime.timedelta(days=day)
+            f.write(f'{date.isoformat()},{open_:.6f},{high:.6f},{low:.6f},{close:.6f},{close:.6f},'
+                    f'{rng.randint(1000000, 10000000)}\n')
+    return
+
+
+def _workdir():
+    '''
+    fresh working directory with the settings and resources of the repository.
+    :return: path: str
+    '''
+    workdir = tempfile.mkdtemp(prefix='bt_copilot_bench_')
+    shutil.copy(os.path.join(REPO_DIR, 'settings.yaml'), workdir)
+    shutil.copytree(os.path.join(REPO_DIR, 'resources'), os.path.join(workdir, 'resources'),
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    write_synthetic_yahoo_csv(os.path.join(workdir, 'BTC-USD.csv'))
+    return workdir
+
+
+def _peak_rss_mb(who = resource.RUSAGE_SELF):
+    # ru_maxrss is reported in kilobytes on linux and in bytes on macos
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def _distribution(name, values, unit = 's'):
+    '''
+    p50/p95/p99 and max of a list of measurements.
+    :return: metrics: dict
+    '''
+    return {f'{name}_p50_{unit}': percentile(values, 50),
+            f'{name}_p95_{unit}': percentile(values, 95),
+            f'{name}_p99_{unit}': percentile(values, 99),
+            f'{name}_max_{unit}': max(values) if values else None}
+
+
+def _copilot(server, workdir, metrics = None):
+    '''
+    copilot with a coding agent pointed at the mock server. Changes into the working directory.
+    :return: BtCopilot
+    '''
+    from bt_copilot import BtCopilot
+    from coding_agent import SimpleCodingAgent
+    from llm_cache import LLMResponseCache
+
+    os.chdir(workdir)
+    cache = LLMResponseCache(path=os.path.join(workdir, '.bt_copilot_cache', 'llm_responses.sqlite'))
+    agent = SimpleCodingAgent(API_KEY='mock', cache=cache, api_base=server.api_base, metrics=metrics)
+    return BtCopilot(coding_agent=agent)
+
+
+def run_main_example(server, repeat):
+    '''
+    runs main_example.py end to end in a subprocess per repetition.
+    :return: metrics: dict
+    '''
+    env = dict(os.environ, API_KEY='mock', OPENAI_API_KEY='mock', OPENAI_API_BASE=server.api_base,
+               PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''), MPLBACKEND='Agg')
+    durations = []
+    requests_before = server.requests_served
+    for _ in range(repeat):
+        workdir = _workdir()
+        try:
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'main_example.py')], cwd=workdir,
+                                    env=env, capture_output=True, text=True)
+            durations.append(time.perf_counter() - start)
+            if result.returncode != 0:
+                raise RuntimeError(f'main_example.py failed: {result.stderr.strip()[-2000:]}')
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    metrics = _distribution('wall', durations)
+    metrics['llm_requests'] = (server.requests_served - requests_before) / repeat
+    metrics['children_peak_rss_mb'] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return metrics
+
+
+def run_copilot_workflow(server, repeat):
+    '''
+    runs the main_example workflow in-process with a metrics registry, to report llm latency percentiles and time
+    to first token of the streamed code generation.
+    :return: metrics: dict
+    '''
+    from metrics import MetricsRegistry
+
+    registry = MetricsRegistry()
+    durations = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        workdir = _workdir()
+        try:
+            copilot = _copilot(server, workdir, metrics=registry)
+            start = time.perf_counter()
+            copilot.load_code('resources/example_backtest.py')
+            analyses = copilot.analyse_strategy(feedback_basis='code', visualise=False)
+            for name, result in analyses.items():
+                if isinstance(result, BaseException):
+                    raise RuntimeError(f'strategy {name} failed') from result
+            copilot.prompt_elements['strategy'] = analyses['description']
+            copilot.get_strategy_feedback(feedback_basis='description')
+            copilot.set_datapipeline('Use btc-usd.csv from yahoo finance, from May 2022 to March 2023.')
+            copilot.set_strategy('Two moving averages 7 and 13 days, long on cross above, close on cross below.')
+            copilot.set_analysers('Total PNL and sharpe ratio.')
+            copilot.compose_prompt_from_elements()
+            for _ in copilot.stream_code_from_prompt(save=True):
+                pass
+            durations.append(time.perf_counter() - start)
+            # generated code is validated in the backtest worker
+            copilot.backtest_runner.close()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    os.chdir(REPO_DIR)
+
+    calls = list(registry.calls)
+    metrics = _distribution('wall', durations)
+    metrics.update(_distribution('llm_latency', [call['latency'] for call in calls]))
+    metrics.update(_distribution('build_code_ttft', [call['time_to_first_token'] for call in calls
+                                                     if call['goal_code'] == 'build_code']))
+    metrics['llm_calls'] = len(calls) / repeat
+    metrics['prompt_tokens'] = sum(call['prompt_tokens'] for call in calls) / repeat
+    metrics['python_peak_mb'] = python_peak / (1024.0 * 1024.0)
+    return metrics
+
+
+def run_batch_generation(server, repeat, rows = 24, max_workers = 8):
+    '''
+    generates code for a table of strategy ideas with the batch pipeline.
+    :return: metrics: dict
+    '''
+    ideas = [{'name': f'sma {fast}/{slow}',
+              'strategy': f'Go long when the {fast} day moving average crosses above the {slow} day average.'}
+             for fast, slow in ((fast, fast * 3) for fast in range(5, 5 + rows))]
+
+    durations = []
+    row_latencies = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        workdir = _workdir()
+        try:
+            copilot = _copilot(server, workdir)
+            start = time.perf_counter()
+            entries = copilot.generate_batch(ideas, defaults={'datapipeline': 'Use BTC-USD.csv from yahoo finance.'},
+                                             max_workers=max_workers, requests_per_minute=None, resume=False)
+            durations.append(time.perf_counter() - start)
+            row_latencies.extend(entry['runtime'] for entry in entries)
+            if not all(entry['ok'] for entry in entries):
+                raise RuntimeError('batch generation failed for some rows')
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    os.chdir(REPO_DIR)
+
+    metrics = _distribution('wall', durations)
+    metrics.update(_distribution('row_latency', row_latencies))
+    metrics['rows_per_s'] = rows * repeat / sum(durations)
+    metrics['python_peak_mb'] = python_peak / (1024.0 * 1024.0)
+    return metrics
+
+
+def run_backtest_execution(server, repeat, runs = 10):
+    '''
+    executes the example backtest in the warm in-process runner and, as a reference, in a fresh subprocess.
+    :return: metrics: dict
+    '''
+    with open(os.path.join(REPO_DIR, 'resources', 'example_backtest.py')) as f:
+        code = f.read()
+
+    cold = []
+    warm = []
+    subprocess_runs = []
+    worker_rss = []
+    for _ in range(repeat):
+        workdir = _workdir()
+        try:
+            copilot = _copilot(server, workdir)
+            for i in range(runs):
+                start = time.perf_counter()
+                result = copilot.backtest_runner.run(code)
+                (cold if i == 0 else warm).append(time.perf_counter() - start)
+                if not result['ok']:
+                    raise RuntimeError(f"backtest failed: {result['error']}")
+
+            for pid in list(copilot.backtest_runner._executor._processes):
+                worker_rss.append(_process_peak_rss_mb(pid))
+            copilot.backtest_runner.close()
+
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=workdir, capture_output=True,
+                           env=dict(os.environ, MPLBACKEND='Agg'))
+            subprocess_runs.append(time.perf_counter() - start)
+        finally:
+            os.chdir(REPO_DIR)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    metrics = _distribution('cold_run', cold)
+    metrics.update(_distribution('warm_run', warm))
+    metrics.update(_distribution('subprocess_run', subprocess_runs))
+    metrics['warm_runs_per_s'] = len(warm) / sum(warm) if warm else None
+    worker_rss = [value for value in worker_rss if value is not None]
+    metrics['worker_peak_rss_mb'] = max(worker_rss) if worker_rss else None
+    return metrics
+
+
+def _process_peak_rss_mb(pid):
+    '''
+    peak resident memory of a running process, linux only.
+    :return: megabytes: float or None
+    '''
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        return None
+    return None
+
+
+_RUNNERS = {'main_example': run_main_example,
+            'copilot_workflow': run_copilot_workflow,
+            'batch_generation': run_batch_generation,
+            'backtest_execution': run_backtest_execution}
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(scenarios = SCENARIOS, profile = 'fast', repeat = 3, seed = 0):
+    '''
+    runs benchmark scenarios against a mock llm server.
+    :param scenarios: iterable of scenario names, see SCENARIOS
+    :param profile: latency profile of the mock server, see mock_llm_server.LATENCY_PROFILES
+    :param repeat: repetitions per scenario
+    :param seed: seed of the latency jitter
+    :return: results: dict with run metadata and one metrics dict per scenario
+    '''
+    from mock_llm_server import MockLLMServer
+
+    results = {'schema': RESULTS_SCHEMA,
+               'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               'git_commit': _git_commit(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpu_count': os.cpu_count(),
+               'profile': profile,
+               'seed': seed,
+               'repeat': repeat,
+               'scenarios': {}}
+
+    previous_cwd = os.getcwd()
+    try:
+        for scenario in scenarios:
+            # a new server per scenario, so every scenario sees the same latency sequence
+            with MockLLMServer(profile=profile, responder=canned_responder, seed=seed) as server:
+                print(f'running {scenario} ...', flush=True)
+                start = time.perf_counter()
+                results['scenarios'][scenario] = _RUNNERS[scenario](server, repeat)
+                results['scenarios'][scenario]['scenario_s'] = time.perf_counter() - start
+    finally:
+        os.chdir(previous_cwd)
+    return results
+
+
+# measurements of code outside the copilot, reported for reference only
+_REFERENCE_METRICS = ('subprocess_run_', 'scenario_s')
+
+
+def _direction(metric):
+    '''
+    :return: 1 if higher values are better, -1 if lower values are better, 0 if the metric is not compared
+    '''
+    if metric.startswith(_REFERENCE_METRICS):
+        return 0
+    if metric.endswith('_per_s'):
+        return 1
+    if metric.endswith(('_s', '_mb')):
+        return -1
+    return 0
+
+
+def compare_results(baseline, current, threshold = 0.15):
+    '''
+    compares two benchmark results. Timing and memory metrics that got worse by more than the threshold are
+    regressions. Results of different latency profiles are not comparable.
+    :param baseline: dict, see run_benchmarks()
+    :param current: dict
+    :param threshold: float, relative change
+    :return: regressions: list of dict with scenario, metric, baseline, current and change
+    '''
+    if baseline.get('profile') != current.get('profile') or baseline.get('schema') != current.get('schema'):
+        raise ValueError(f"results are not comparable: profile {baseline.get('profile')} vs {current.get('profile')}, "
+                         f"schema {baseline.get('schema')} vs {current.get('schema')}")
+
+    regressions = []
+    for scenario, metrics in current['scenarios'].items():
+        baseline_metrics = baseline['scenarios'].get(scenario, {})
+        for metric, value in metrics.items():
+            reference = baseline_metrics.get(metric)
+            direction = _direction(metric)
+            if direction == 0 or value is None or not reference:
+                continue
+            change = (value - reference) / reference
+            if -direction * change > threshold:
+                regressions.append({'scenario': scenario, 'metric': metric, 'baseline': reference,
+                                    'current': value, 'change': change})
+    return regressions
+
+
+def print_results(results):
+    for scenario, metrics in results['scenarios'].items():
+        print(f'{scenario}:')
+        for metric, value in metrics.items():
+            print(f'  {metric:28s} {value:.4f}' if isinstance(value, float) else f'  {metric:28s} {value}')
+    return
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='offline performance benchmarks against a mock llm server')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated, from ' + ', '.join(SCENARIOS))
+    parser.add_argument('--profile', default='fast', help='mock server latency profile')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='relative slowdown reported as regression')
+    args = parser.parse_args(argv)
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    results = run_benchmarks(scenarios=scenarios, profile=args.profile, repeat=args.repeat, seed=args.seed)
+    print_results(results)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        try:
+            regressions = compare_results(baseline, results, threshold=args.threshold)
+        except ValueError as e:
+            print(f'Baseline not compared: {str(e)}')
+            return 2
+        for regression in regressions:
+            print(f"REGRESSION {regression['scenario']}.{regression['metric']}: {regression['baseline']:.4f} -> "
+                  f"{regression['current']:.4f} ({regression['change']:+.0%})")
+        if regressions:
+            return 1
+        print(f'No regressions against {args.baseline} (threshold {args.threshold:.0%})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
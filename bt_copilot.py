@@ -1,8 +1,6 @@
 import subprocess
 import os
-import pandas as pd
-import yaml
-from langchain.prompts import PromptTemplate
+from metrics import traced
 
 
 class BtCopilot:
@@ -22,14 +20,15 @@ class BtCopilot:
         '''
 
         # load settings
+        import yaml
         with open('settings.yaml') as f:
             self.settings = yaml.safe_load(f)
 
         # initiate coding agent
         self.coding_agent = coding_agent
 
-        # load prompt library
-        self.prompt_library = self.load_prompt_library()
+        # prompt library, loaded on first use
+        self._prompt_library = None
 
         # initiate code kept in memory
         self.code = ''
@@ -43,18 +42,54 @@ class BtCopilot:
         # initiate compiled prompt
         self.compiled_prompt = ''
 
+        # warm backtest worker, started on first use
+        self._backtest_runner = None
+
+        # compaction of code in prompts, created on first use
+        self._prompt_compactor = None
+        self.compaction_report = None
+
+        # components of the code and their stored llm analyses, see strategy_components
+        self.components = {}
+        self._component_analyser = None
+
+        # static checks and smoke test of generated code, created on first use
+        self._code_validator = None
+        self.validation_report = None
+
+        # recorded backtest runs, opened on first use
+        self._results_store = None
+
+    @property
+    def prompt_library(self):
+        '''
+        prompt library, loaded on first use so that commands without llm calls do not pay for it.
+        :return: PromptLibrary
+        '''
+        if self._prompt_library is None:
+            self._prompt_library = self.load_prompt_library()
+            semantic_cache = getattr(self.coding_agent, 'semantic_cache', None)
+            if semantic_cache is not None and self._prompt_library is not None:
+                # only the user input decides whether two prompts are near-duplicates
+                semantic_cache.set_boilerplate(self._prompt_library.templates.values())
+        return self._prompt_library
+    @prompt_library.setter
+    def prompt_library(self, prompt_library):
+        self._prompt_library = prompt_library
     def load_prompt_library(self):
         '''
         loads the prompt library file into the bt_copilote client
-        :return: Pandas dataframe containing prompt library
+        :return: PromptLibrary with precompiled templates indexed by goal_code
         '''
-        # read the prompt library CSV file
+        from prompt_library import PromptLibrary
+
+        # read and validate the prompt library CSV file
         try:
-            df = pd.read_csv(os.path.join(self.settings["resources_dir"], self.settings["prompt_lib"]))
-            return df
+            return PromptLibrary(os.path.join(self.settings["resources_dir"], self.settings["prompt_lib"]))
         except FileNotFoundError:
             print(f"Prompt library file not found in {self.settings['resources_dir']}/{self.settings['prompt_lib']}")
             return None
+    @traced
     def load_code(self, file_path):
         '''
         loads existing backtesting code into the bt_copilote client
@@ -66,13 +101,26 @@ class BtCopilot:
                 self.code = file.read()
         except FileNotFoundError:
             print(f"Code file not found at {file_path}")
+            return
+
+        # split into fingerprinted components for incremental analysis
+        from strategy_components import extract_components
+        self.components = extract_components(self.code)
+    def _code_file_path(self):
+        '''
+        path of the code file of the current project in the output directory. Creates the directory if required.
+        :return: file_path: str
+        '''
+        os.makedirs(self.settings["output_dir"], exist_ok=True)
+        return os.path.join(self.settings["output_dir"], f"{self.settings['project_name']}.py")
+    @traced
     def save_code(self):
         '''
         saves code that is stored in memory of bt_copilote client to file
         :return:
         '''
         # Open the file in write mode
-        with open(os.path.join(self.settings["output_dir"], f"{self.settings['project_name']}.py"), 'w') as f:
+        with open(self._code_file_path(), 'w') as f:
             # Write code to file
             f.write(self.code)
         return
@@ -83,39 +131,37 @@ class BtCopilot:
         :param goal_code: string
         :return: prompt template: string
         '''
-        # find the row with the key "suggest_strategy_improvement"
-        df = self.prompt_library
-        row = df.loc[df['goal_code'] == goal_code]
-
-        # store "prompt" and "temperature" in variables
-        prompt = row['prompt'].values[0]
-
-        prompt = {'prompt' : prompt}
+        prompt = {'prompt' : self.prompt_library.template(goal_code)}
 
         return prompt
-    def compose_prompt_from_elements(self):
+    def compose_prompt(self, prompt_elements):
         '''
-        composes the individual elements of the prompt into one prompt describing the entire desired backtest.
-        This prompt can be sent to the coding agent to obtain the backtesting code.
-        :return:
+        composes prompt elements into one prompt describing the entire desired backtest, without changing the
+        client memory.
+        :param prompt_elements: dict with the keys of self.prompt_elements
+        :return: prompt: str
         '''
 
         # combine prompt elements
-        combined_prompt = ''.join(self.prompt_elements.values())
+        combined_prompt = ''.join(prompt_elements.values())
 
         # load general context
-        submission_prompt_template = self._get_prompt_template(goal_code='submission_prompt_template')['prompt']
-        coding_context = self._get_prompt_template(goal_code='coding_context')['prompt']
+        coding_context = self.prompt_library.template('coding_context')
 
-        # create langchain prompt_template
-        prompt_template = PromptTemplate(
-            input_variables=["context","combined_prompt"],
-            template = submission_prompt_template,
-        )
+        return self.prompt_library.format('submission_prompt_template',
+                                          context = coding_context,
+                                          combined_prompt = combined_prompt)
+    @traced
+    def compose_prompt_from_elements(self):
+        '''
+        composes the individual elements of the prompt into one prompt describing the entire desired backtest.
+        This prompt can be sent to the coding agent to obtain the backtesting code.
+        :return:
+        '''
 
         # store formatted prompt with context in client memory
-        self.prompt = prompt_template.format(context = coding_context,
-                                             combined_prompt = combined_prompt)
+        self.prompt = self.compose_prompt(self.prompt_elements)
+        self.compiled_prompt = self.prompt
         return
     def _build_prompt(self, goal_code, user_input):
         '''
@@ -125,19 +171,87 @@ class BtCopilot:
         :param user_input: str
         :return: formatted prompt: str
         '''
-        # load prompt template
-        prompt_from_library = self._get_prompt_template(goal_code=goal_code)
-        template = prompt_from_library['prompt']
+        # insert user input into precompiled template
+        formatted_prompt = self.prompt_library.format(goal_code, user_input=user_input)
+        return formatted_prompt
+    @property
+    def prompt_compactor(self):
+        '''
+        fits the stored code into the prompt budget of the model, created on first use.
+        :return: PromptCompactor
+        '''
+        if self._prompt_compactor is None:
+            from prompt_compaction import PromptCompactor
+            self._prompt_compactor = PromptCompactor(coding_agent=self.coding_agent,
+                                                     prompt_library=self.prompt_library,
+                                                     context_tokens=self.settings.get('context_tokens'))
+        return self._prompt_compactor
+    @traced
+    def _code_prompt(self, goal_code):
+        '''
+        builds a prompt with the stored code as user input. Unless compact_prompts is disabled in the settings, code
+        that exceeds the prompt budget is stripped to the strategy and Cerebro configuration and summarised in chunks
+        if it still exceeds it. Token counts before and after are printed and kept in self.compaction_report.
+        :param goal_code: str
+        :return: formatted prompt: str
+        '''
+        if not self.settings.get('compact_prompts', True):
+            return self._build_prompt(goal_code=goal_code, user_input=self.code)
 
-        # create langchain prompt_template
-        prompt_template = PromptTemplate(
-            input_variables=["user_input"],
-            template=template,
-        )
+        from prompt_compaction import count_tokens, format_report
 
-        # insert user input into template
-        formatted_prompt = prompt_template.format(user_input=user_input)
-        return formatted_prompt
+        template_tokens = count_tokens(self._build_prompt(goal_code=goal_code, user_input=''),
+                                       self.prompt_compactor.model_name)
+        code, report = self.prompt_compactor.compact(self.code, template_tokens=template_tokens)
+
+        # compaction results are memoised, only report new ones
+        if report is not self.compaction_report:
+            self.compaction_report = report
+            print(format_report(report))
+
+        return self._build_prompt(goal_code=goal_code, user_input=code)
+    @property
+    def component_analyser(self):
+        '''
+        per-component llm analyses of the code, persisted in the cache directory. Created on first use.
+        :return: ComponentAnalyser
+        '''
+        if self._component_analyser is None:
+            from strategy_components import ComponentAnalyser
+            self._component_analyser = ComponentAnalyser(coding_agent=self.coding_agent,
+                                                         prompt_library=self.prompt_library,
+                                                         # placeholder answers of test mode are not persisted
+                                                         path=None if self.coding_agent.test_mode else
+                                                         os.path.join(self.settings['cache_dir'],
+                                                                      'component_analyses.json'),
+                                                         max_workers=self.settings.get('max_concurrency', 4))
+        return self._component_analyser
+    def _use_incremental(self, incremental):
+        if incremental is None:
+            return self.settings.get('incremental_analysis', False)
+        return incremental
+    @traced
+    def _incremental_analysis(self, goal_code, temperature):
+        '''
+        analyses the stored code component by component. Only components that changed since their last analysis are
+        sent to the llm, the answer is merged from the stored per-component results.
+        :param goal_code: str, component prompt template
+        :param temperature: float
+        :return: merged analysis: str
+        '''
+        from strategy_components import extract_components, merge_results
+
+        # the code may have been edited in memory since load_code(). Concurrent analyses (aget_strategy_feedback(),
+        # aget_strategy_description()) each work on their own components and statistics
+        components = extract_components(self.code)
+        stats = {}
+        results = self.component_analyser.analyse(components, goal_code=goal_code, temperature=temperature,
+                                                  stats=stats)
+        self.components = components
+
+        print(f"Incremental analysis: {stats['analysed']} of {stats['components']} components analysed, "
+              f"{stats['reused']} reused")
+        return merge_results(results)
     def load_boilerplate(self, boilerplate_type = 'basic'):
         '''
         load boilerplate code from a selection of backtrader boilerplates in the resources directory
@@ -147,19 +261,23 @@ class BtCopilot:
 
         self.code = self.load_code(f'{self.settings["resources_dir"]}/boilerplate_{boilerplate_type}.py')
         return
-    def set_datapipeline(self, user_input):
+    @traced
+    def set_datapipeline(self, user_input, universe = False):
         '''
         sets the datapipeline part of the composed prompt
         :param user_input: str
+        :param universe: bool, multi-symbol backtest: the generated code loads all symbol files in one call with
+        data_pipeline.add_universe() (parallel parsing, cached resampling, common calendar)
         :return:
         '''
         # generate boilerplate code
         new_prompt = self._build_prompt(user_input=user_input,
-                                       goal_code='set_datapipeline')
+                                       goal_code='set_datapipeline_universe' if universe else 'set_datapipeline')
 
         # append prompt element to entire prompt
         self.prompt_elements['datapipeline'] = new_prompt
         return
+    @traced
     def set_strategy(self, user_input):
         '''
         sets the strategy part of the composed prompt
@@ -173,6 +291,7 @@ class BtCopilot:
         # append prompt element to entire prompt
         self.prompt_elements['strategy'] = new_prompt
         return
+    @traced
     def set_analysers(self, user_input):
         '''
         sets the analyzer part of the composed prompt
@@ -194,38 +313,178 @@ class BtCopilot:
         '''
         self.prompt_elements['custom'] = prompt
         return
-    def build_code_from_prompt(self):
+    @traced
+    def build_code_from_prompt(self, candidates = None, temperatures = None):
         '''
         builds executable python backtesting code from the compiled prompt (compilation of prompt elements) by calling
         the coding agent on compiled_prompt.
-        :param temperature: flaot
+        With more than one candidate the code is generated speculatively: the candidates are generated and validated in
+        parallel and the first that passes validation and the smoke test is kept, see speculative_build().
+        :param candidates: int, completions generated at the same time, defaults to code_candidates in settings.yaml
+        :param temperatures: list of float, one per candidate, defaults to coding_temp for every candidate
         :return:
         '''
+        if temperatures is None:
+            candidates = candidates or self.settings.get('code_candidates', 1)
+            temperatures = [self.settings['coding_temp']] * max(1, candidates)
+        if len(temperatures) > 1:
+            result = self.speculative_build(temperatures)
+            self.code = result['code']
+            self.validation_report = result['report'] if result['ok'] else self._auto_fix()
+            return
+
         self.code = self.coding_agent.code(prompt = self.compiled_prompt,
-                                           temperature = self.settings['coding_temp'])
+                                           temperature = temperatures[0],
+                                           goal_code = 'build_code')
+        self.validation_report = self._auto_fix()
         return
-    def get_strategy_feedback(self , feedback_basis = 'code'):
+    @traced
+    def speculative_build(self, temperatures, smoke_test = True):
         '''
-        provides natural language feedback on the trading strategy.
-        This function can be called on either
-        A) the python code, or
-        B) the natural language description of the strategy.
+        generates one code candidate per temperature from the compiled prompt at the same time and returns the first
+        that passes validation. The smoke tests run in a pool of warm workers, one per candidate. Once a candidate
+        passes, the generation of the others is stopped. The client memory (code) is not changed.
+        :param temperatures: list of float
+        :param smoke_test: bool
+        :return: result: dict with keys ok, code, report, winner, runtime and candidates, see
+        speculative_generation.SpeculativeGenerator.generate()
+        '''
+        from backtest_runner import BacktestRunner
+        from code_validation import CodeValidator
+        from speculative_generation import SpeculativeGenerator
 
-        In case A) the strategy is extracted from the code, and feedback is provided based on this understanding of the
-        trading rules. The code stored in the bt_copilote client is used. Useful to load coad and analyze it.
+        runner = BacktestRunner(max_workers=min(len(temperatures), os.cpu_count() or 1),
+                                cache_dir=os.path.join(self.settings['cache_dir'], 'market_data'))
+        validator = CodeValidator(backtest_runner=runner, smoke_bars=self.settings.get('smoke_test_bars', 50))
+        generator = SpeculativeGenerator(coding_agent=self.coding_agent,
+                                         validator=validator,
+                                         temperatures=temperatures,
+                                         smoke_test=smoke_test)
+        result = generator.generate(self.compiled_prompt, goal_code='build_code')
 
-        In case B) the natural language description of the strategy is used. Useful to get feedback on strategy before
-        building code.
-        :param basis: str
-        :return: strategy_feedback: str
+        cancelled = sum(candidate['status'] == 'cancelled' for candidate in result['candidates'])
+        if result['ok']:
+            winner = result['candidates'][result['winner']]
+            print(f"Candidate {winner['index'] + 1} of {len(temperatures)} (temperature {winner['temperature']}) "
+                  f"passed validation after {result['runtime']:.1f} s, {cancelled} cancelled")
+        else:
+            print(f"None of {len(temperatures)} candidates passed validation after {result['runtime']:.1f} s")
+        return result
+    @traced
+    def generate_batch(self, batch, defaults = None, max_workers = 8, requests_per_minute = 60, max_retries = 4,
+                       resume = True):
+        '''
+        generates backtest code for a table of strategy descriptions concurrently. Every row is written to its own
+        file in <output_dir>/<project_name>_batch/ and recorded in manifest.jsonl in the same directory.
+        The client memory (prompt_elements, code) is not changed.
+
+        Example:
+            copilot.generate_batch('ideas.csv', defaults={'datapipeline': 'Use btc-usd.csv from yahoo finance.'})
+
+        :param batch: str (.csv or .jsonl file) or list of dict with the columns name, datapipeline, strategy,
+        analysers, custom
+        :param defaults: dict of descriptions used for empty columns
+        :param max_workers: int, concurrent llm calls
+        :param requests_per_minute: int, shared request budget, None disables throttling
+        :param max_retries: int, retries per row with exponential backoff
+        :param resume: bool, skip rows generated successfully by a previous run
+        :return: manifest entries: list of dict with keys index, name, file, ok, attempts, error, runtime
+        '''
+        from batch_generation import BatchGenerator, load_batch
+
+        rows = load_batch(batch) if isinstance(batch, str) else list(batch)
+        generator = BatchGenerator(copilot=self,
+                                   output_dir=os.path.join(self.settings["output_dir"],
+                                                           f'{self.settings["project_name"]}_batch'),
+                                   max_workers=max_workers,
+                                   requests_per_minute=requests_per_minute,
+                                   max_retries=max_retries)
+        return generator.run(rows, defaults=defaults, resume=resume)
+    @traced
+    def stream_code_from_prompt(self, save = True):
+        '''
+        streaming variant of build_code_from_prompt(). Yields the code chunk by chunk as it is generated.
+        With save=True every chunk is written and flushed to the project code file as it arrives.
+        The code in memory is only replaced once the generation is complete. Closing the generator early cancels
+        the generation and leaves the partial code in the file. If validate_code is enabled, the complete code is
+        validated and fixed like in build_code_from_prompt(), the file is only rewritten with a fix that passes.
+
+        Example:
+            for chunk in copilot.stream_code_from_prompt():
+                print(chunk, end='', flush=True)
+
+        :param save: bool
+        :return: generator of code chunks: str
+        '''
+        chunks = []
+        f = open(self._code_file_path(), 'w') if save else None
+        try:
+            for chunk in self.coding_agent.stream_code(prompt=self.compiled_prompt,
+                                                       temperature=self.settings['coding_temp'],
+                                                       goal_code='build_code'):
+                chunks.append(chunk)
+                if f is not None:
+                    f.write(chunk)
+                    f.flush()
+                yield chunk
+        finally:
+            if f is not None:
+                f.close()
+
+        self._complete_stream(chunks, save)
+        return
+    @traced
+    async def astream_code_from_prompt(self, save = True):
+        '''
+        async iterator variant of stream_code_from_prompt().
+        :param save: bool
+        :return: async iterator of code chunks: str
         '''
+        import asyncio
 
+        chunks = []
+        f = open(self._code_file_path(), 'w') if save else None
+        try:
+            async for chunk in self.coding_agent.astream_code(prompt=self.compiled_prompt,
+                                                              temperature=self.settings['coding_temp'],
+                                                              goal_code='build_code'):
+                chunks.append(chunk)
+                if f is not None:
+                    f.write(chunk)
+                    f.flush()
+                yield chunk
+        finally:
+            if f is not None:
+                f.close()
+
+        # validation and fixes call the llm and run the smoke test, keep them off the event loop
+        await asyncio.to_thread(self._complete_stream, chunks, save)
+        return
+    def _complete_stream(self, chunks, save):
+        '''
+        stores the code of a completed stream, validates and fixes it if enabled. The streamed file is only rewritten
+        with a fix that passes validation.
+        :param chunks: list of str
+        :param save: bool
+        :return:
+        '''
+        self.code = ''.join(chunks)
+        self.validation_report = self._auto_fix()
+        report = self.validation_report
+        if save and report is not None and report['ok'] and report['fix_iterations']:
+            self.save_code()
+        return
+    def _strategy_feedback_prompt(self, feedback_basis):
+        '''
+        builds the prompt for strategy feedback on either the stored code or the stored strategy description.
+        :param feedback_basis: str ('code' or 'description')
+        :return: prompt: str
+        '''
         # obtain feedback based on backtesting code (llm extracts strategy from code)
         if feedback_basis == 'code':
 
             # get prompt for strategy feedback on stored strategy description
-            prompt = self._build_prompt(goal_code='get_strategy_feedback_from_code',
-                                       user_input= self.code)
+            prompt = self._code_prompt(goal_code='get_strategy_feedback_from_code')
 
         # obtain feedback based on natural language description of strategy
         elif feedback_basis == 'description':
@@ -234,65 +493,296 @@ class BtCopilot:
             prompt = self._build_prompt(goal_code='get_strategy_feedback_from_description',
                                        user_input= self.prompt_elements['strategy'])
 
+        return prompt
+    @traced
+    def get_strategy_feedback(self , feedback_basis = 'code', incremental = None):
+        '''
+        provides natural language feedback on the trading strategy.
+        This function can be called on either
+        A) the python code, or
+        B) the natural language description of the strategy.
+
+        In case A) the strategy is extracted from the code, and feedback is provided based on this understanding of the
+        trading rules. The code stored in the bt_copilote client is used. Useful to load coad and analyze it.
+
+        In case B) the natural language description of the strategy is used. Useful to get feedback on strategy before
+        building code.
+        :param basis: str
+        :param incremental: bool, in case A) get feedback per code component and only re-query changed components.
+        Defaults to incremental_analysis in the settings.
+        :return: strategy_feedback: str
+        '''
+        if feedback_basis == 'code' and self._use_incremental(incremental):
+            return self._incremental_analysis(goal_code='get_component_feedback',
+                                              temperature=self.settings['strategy_feedback_temp'])
+
+        prompt = self._strategy_feedback_prompt(feedback_basis=feedback_basis)
+
         # execute LLM call
         strategy_feedback = self.coding_agent.simple_LLMcall(prompt = prompt,
-                                                             temperature= self.settings['strategy_feedback_temp'])
+                                                             temperature= self.settings['strategy_feedback_temp'],
+                                                             goal_code= f'get_strategy_feedback_from_{feedback_basis}')
 
         return strategy_feedback
-    def get_strategy_description(self):
+    @traced
+    def stream_strategy_feedback(self, feedback_basis = 'code'):
+        '''
+        streaming variant of get_strategy_feedback(). Yields the feedback chunk by chunk as it is generated.
+        :param feedback_basis: str
+        :return: generator of feedback chunks: str
+        '''
+        prompt = self._strategy_feedback_prompt(feedback_basis=feedback_basis)
+        yield from self.coding_agent.stream_LLMcall(prompt=prompt,
+                                                    temperature=self.settings['strategy_feedback_temp'],
+                                                    goal_code=f'get_strategy_feedback_from_{feedback_basis}')
+    @traced
+    async def astream_strategy_feedback(self, feedback_basis = 'code'):
+        '''
+        async iterator variant of stream_strategy_feedback().
+        :param feedback_basis: str
+        :return: async iterator of feedback chunks: str
+        '''
+        prompt = self._strategy_feedback_prompt(feedback_basis=feedback_basis)
+        async for chunk in self.coding_agent.astream_LLMcall(prompt=prompt,
+                                                             temperature=self.settings['strategy_feedback_temp'],
+                                                             goal_code=f'get_strategy_feedback_from_{feedback_basis}'):
+            yield chunk
+    @traced
+    async def aget_strategy_feedback(self, feedback_basis = 'code', incremental = None):
+        '''
+        async variant of get_strategy_feedback().
+        :param feedback_basis: str
+        :param incremental: bool
+        :return: strategy_feedback: str
+        '''
+        import asyncio
+
+        if feedback_basis == 'code' and self._use_incremental(incremental):
+            # create the shared analyser before the worker threads use it
+            self.component_analyser
+            return await asyncio.to_thread(self._incremental_analysis, 'get_component_feedback',
+                                           self.settings['strategy_feedback_temp'])
+
+        prompt = await asyncio.to_thread(self._strategy_feedback_prompt, feedback_basis)
+
+        # execute LLM call
+        strategy_feedback = await self.coding_agent.asimple_LLMcall(prompt=prompt,
+                                                                    temperature=self.settings['strategy_feedback_temp'],
+                                                                    goal_code=f'get_strategy_feedback_from_{feedback_basis}')
+        return strategy_feedback
+    @traced
+    def get_strategy_description(self, incremental = None):
         '''
         generates a natural language description of the trading strategy based on the loaded code.
         useful to quickly understand an implemented strategy
+        :param incremental: bool, describe the code per component and only re-query changed components.
+        Defaults to incremental_analysis in the settings.
         :return: strategy_description: str
         '''
+        if self._use_incremental(incremental):
+            return self._incremental_analysis(goal_code='get_component_description',
+                                              temperature=self.settings['strategy_descr_temp'])
 
         # get prompt for strategy description based on code
-        prompt = self._build_prompt(goal_code='get_strategy_description',
-                                   user_input=self.code)
+        prompt = self._code_prompt(goal_code='get_strategy_description')
 
         # execute LLM call
         strategy_description = self.coding_agent.simple_LLMcall(prompt=prompt,
-                                                                temperature= self.settings['strategy_descr_temp'])
+                                                                temperature= self.settings['strategy_descr_temp'],
+                                                                goal_code= 'get_strategy_description')
         return strategy_description
-    def visualise_strategy(self, vis_basis='code'):
+    @traced
+    async def aget_strategy_description(self, incremental = None):
+        '''
+        async variant of get_strategy_description().
+        :param incremental: bool
+        :return: strategy_description: str
+        '''
+        import asyncio
+
+        if self._use_incremental(incremental):
+            # create the shared analyser before the worker threads use it
+            self.component_analyser
+            return await asyncio.to_thread(self._incremental_analysis, 'get_component_description',
+                                           self.settings['strategy_descr_temp'])
+
+        # get prompt for strategy description based on code, compaction may call the llm
+        prompt = await asyncio.to_thread(self._code_prompt, 'get_strategy_description')
 
+        # execute LLM call
+        strategy_description = await self.coding_agent.asimple_LLMcall(prompt=prompt,
+                                                                       temperature=self.settings['strategy_descr_temp'],
+                                                                       goal_code='get_strategy_description')
+        return strategy_description
+    def _strategy_visualisation_prompt(self, vis_basis):
+        '''
+        builds the prompt asking for a graphviz plotting script of the strategy.
+        :param vis_basis: str ('code' or 'description')
+        :return: prompt: str
+        '''
         if vis_basis == 'code':
             # get prompt for strategy description based on code
-            prompt = self._build_prompt(goal_code='get_strategy_visualisation_from_code',
-                                        user_input=self.code)
+            prompt = self._code_prompt(goal_code='get_strategy_visualisation_from_code')
 
         elif vis_basis == 'description':
             # get prompt for strategy description based on code
             prompt = self._build_prompt(goal_code='get_strategy_visualisation_from_description',
                                         user_input=self.prompt_elements['strategy'])
 
-        # execute LLM call
-        visualisation_code = self.coding_agent.simple_LLMcall(prompt=prompt,
-                                                              temperature=self.settings['vis_strat_temp'])
-
+        return prompt
+    def _render_visualisation(self, visualisation_code):
+        '''
+        writes the generated plotting script to the output directory and runs it.
+        :param visualisation_code: str
+        :return:
+        '''
         # Define the path where the file will be saved
+        os.makedirs(self.settings["output_dir"], exist_ok=True)
         file_path = os.path.join(self.settings["output_dir"], f'{self.settings["project_name"]}_plotscript.py')
 
         # Write the code to a Python file at the defined path
         with open(file_path, 'w') as f:
             f.write(visualisation_code)
 
-        # Run the Python file using subprocess.run()
-        try:
-            result = subprocess.run(["python", file_path], capture_output=True, text=True)
-
-            # Print the output of the subprocess
+        # Run the plot script in the warm worker
+        result = self.backtest_runner.run(visualisation_code, cwd=os.path.abspath(self.settings["output_dir"]))
+        if result['ok']:
             print('Plotted flow chart')
-            print(result.stdout)
-        except Exception as e:
+            print(result['stdout'])
+        else:
             print(
-                f"An error occurred while visualising the strategy. Ensure graphviz is installed on your system: {str(e)}")
+                f"An error occurred while visualising the strategy. Ensure graphviz is installed on your system: {result['error']}")
         return
-    def autopilot(self):
+    def _render_flowchart(self):
+        '''
+        builds the flowchart of the code in memory locally, without llm call, and writes it to
+        <output_dir>/<project_name>_flowchart.gv (and .png if graphviz is installed). Charts are cached by code hash.
+        :return: path of the image, or of the DOT file if graphviz is not installed. None on failure.
+        '''
+        from strategy_flowchart import render_flowchart
+
+        try:
+            result = render_flowchart(self.code,
+                                      cache_dir=os.path.join(self.settings['cache_dir'], 'flowcharts'),
+                                      output_path=os.path.join(self.settings["output_dir"],
+                                                               f'{self.settings["project_name"]}_flowchart'))
+        except (SyntaxError, ValueError) as e:
+            print(f"An error occurred while visualising the strategy: {str(e)}")
+            return None
+        print(f"Plotted flow chart to {result['image'] or result['dot']}")
+        return result['image'] or result['dot']
+    @traced
+    def visualise_strategy(self, vis_basis='code'):
+        '''
+        renders a flowchart of the strategy.
+        vis_basis='code' builds the chart from the code in memory with ast, in milliseconds and without llm call.
+        vis_basis='description' asks the llm for a graphviz plotting script of the strategy description and runs it.
+        :param vis_basis: str ('code' or 'description')
+        :return: path of the chart for vis_basis='code', else None
+        '''
+        if vis_basis == 'code':
+            return self._render_flowchart()
+
+        prompt = self._strategy_visualisation_prompt(vis_basis=vis_basis)
+
+        # execute LLM call
+        visualisation_code = self.coding_agent.simple_LLMcall(prompt=prompt,
+                                                              temperature=self.settings['vis_strat_temp'],
+                                                              goal_code=f'get_strategy_visualisation_from_{vis_basis}')
+
+        self._render_visualisation(visualisation_code)
+        return
+    @traced
+    async def avisualise_strategy(self, vis_basis='code'):
+        '''
+        async variant of visualise_strategy(). Rendering runs in a worker thread.
+        :param vis_basis: str
+        :return: path of the chart for vis_basis='code', else None
+        '''
+        import asyncio
+
+        if vis_basis == 'code':
+            return await asyncio.to_thread(self._render_flowchart)
+
+        prompt = await asyncio.to_thread(self._strategy_visualisation_prompt, vis_basis)
+
+        # execute LLM call
+        visualisation_code = await self.coding_agent.asimple_LLMcall(prompt=prompt,
+                                                                     temperature=self.settings['vis_strat_temp'],
+                                                                     goal_code=f'get_strategy_visualisation_from_{vis_basis}')
+
+        await asyncio.to_thread(self._render_visualisation, visualisation_code)
+        return
+    @traced
+    async def gather_analyses(self, analyses, max_concurrency = None, timeout = None):
+        '''
+        runs a batch of independent analyses at the same time.
+        At most max_concurrency analyses are in flight, each one is given at most timeout seconds.
+        A failed or timed out analysis does not cancel the others, its exception is returned as result instead.
+
+        Example:
+            await copilot.gather_analyses({'description': copilot.aget_strategy_description(),
+                                           'feedback': copilot.aget_strategy_feedback(feedback_basis='code')})
+
+        :param analyses: dict mapping a name to an awaitable, e.g. {'description': copilot.aget_strategy_description()}
+        :param max_concurrency: int, defaults to settings['max_concurrency']
+        :param timeout: seconds per analysis. None uses settings['llm_timeout'], set llm_timeout to null in
+        settings.yaml to wait without a timeout.
+        :return: results: dict mapping the name to the result or the raised exception, check results with
+        isinstance(result, BaseException) before using them
+        '''
+        import asyncio
+
+        if max_concurrency is None:
+            max_concurrency = self.settings.get('max_concurrency', 4)
+        if timeout is None:
+            timeout = self.settings.get('llm_timeout')
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run_limited(awaitable):
+            async with semaphore:
+                return await asyncio.wait_for(awaitable, timeout=timeout)
+
+        names = list(analyses.keys())
+        results = await asyncio.gather(*(run_limited(analyses[name]) for name in names), return_exceptions=True)
+        return dict(zip(names, results))
+    @traced
+    def analyse_strategy(self, feedback_basis = 'code', visualise = True, vis_basis = 'code',
+                         max_concurrency = None, timeout = None):
+        '''
+        describes, reviews and (optionally) visualises the loaded strategy concurrently.
+        Takes as long as the slowest of the llm calls instead of their sum.
+        :param feedback_basis: str
+        :param visualise: bool, vis_basis='description' requires graphviz to be installed on your system
+        :param vis_basis: str
+        :param max_concurrency: int
+        :param timeout: seconds per analysis, see gather_analyses()
+        :return: results: dict with keys 'description', 'feedback' and, if visualised, 'visualisation'. A failed
+        analysis is returned as its exception, see gather_analyses()
+        '''
+        import asyncio
+
+        async def run_all():
+            analyses = {'description': self.aget_strategy_description(),
+                        'feedback': self.aget_strategy_feedback(feedback_basis=feedback_basis)}
+            if visualise:
+                analyses['visualisation'] = self.avisualise_strategy(vis_basis=vis_basis)
+            return await self.gather_analyses(analyses, max_concurrency=max_concurrency, timeout=timeout)
+
+        return asyncio.run(run_all())
+    @traced
+    def autopilot(self, resume = True):
         '''
         runs the bt_copilote autopilot, which guides user through required questions to set up a backtest.
+        Every answer and every finished step (prompt elements, composed prompt, code, feedback) is checkpointed to
+        <cache_dir>/sessions/<project_name>.json. Entering the same project name again resumes the session: previous
+        answers are offered as defaults and steps with unchanged inputs are taken from the session instead of calling
+        the llm again.
+        :param resume: bool, False discards a stored session of the project
         :return:
         '''
+        from session_store import SessionStore, session_path
 
         # Intro
         logo = '''
@@ -312,32 +802,776 @@ class BtCopilot:
         project_name = input("Please enter the name of your project: ")
         self.settings['project_name'] = project_name
 
-        # Data pipeline
-        datapipeline = input("Please describe the data sources you would like to load for your backtest: ")
-        self.prompt_elements['datapipeline'] = datapipeline
+        session = SessionStore(session_path(os.path.join(self.settings['cache_dir'], 'sessions'), project_name))
+        if not resume:
+            session.clear()
+        elif session.resumed:
+            print(f'Resuming the session of {project_name}. Press enter to keep the previous answer in brackets.')
+
+        def ask(name, question):
+            previous = session.answer(name)
+            if previous:
+                shown = previous if len(previous) <= 60 else f'{previous[:57]}...'
+                answer = input(f'{question} [{shown}]: ') or previous
+            else:
+                answer = input(f'{question}: ')
+            session.set_answer(name, answer)
+            return answer
+
+        # Data pipeline, strategy and analyzers
+        for element, set_element, question in (
+                ('datapipeline', self.set_datapipeline,
+                 'Please describe the data sources you would like to load for your backtest'),
+                ('strategy', self.set_strategy, 'Please describe your trading strategy rules'),
+                ('analysers', self.set_analysers, 'Please describe which analyzers you would like to include')):
+            user_input = ask(element, question)
 
-        # Strategy
-        strategy = input("Please describe your trading strategy rules: ")
-        self.prompt_elements['strategy'] = strategy
+            def build_element():
+                set_element(user_input)
+                return self.prompt_elements[element]
 
-        # Analyzers
-        analyzers = input("Please describe which analyzers you would like to include: ")
-        self.prompt_elements['analyzers'] = analyzers
+            # the template text is part of the inputs, an edited prompt library builds the element again
+            template = self.prompt_library.template(f'set_{element}')
+            self.prompt_elements[element], _ = session.step(element,
+                                                            {'user_input': user_input, 'template': template},
+                                                            build_element)
 
         print('---')
         print("That's a wrap!")
-        print("Would you like to build the code?")
+        build = ask('build', 'Would you like to build the code? (y/n)')
+        if not build.strip().lower().startswith('y'):
+            return
 
+        # compose prompt and show the code while it is generated
+        compose_inputs = {'elements': self.prompt_elements,
+                          'templates': [self.prompt_library.template('coding_context'),
+                                        self.prompt_library.template('submission_prompt_template')]}
+        self.compiled_prompt, _ = session.step('compose_prompt', compose_inputs,
+                                               lambda: self.compose_prompt(self.prompt_elements))
+        self.prompt = self.compiled_prompt
+
+        def build_code():
+            for chunk in self.stream_code_from_prompt(save=True):
+                print(chunk, end='', flush=True)
+            print()
+            return self.code
+
+        code_inputs = {'prompt': self.compiled_prompt,
+                       'model': self.coding_agent._model_key(self.settings['coding_temp']),
+                       'test_mode': self.coding_agent.test_mode,
+                       'validate_code': self.settings.get('validate_code', False)}
+        self.code, reused = session.step('build_code', code_inputs, build_code)
+        if reused:
+            print('Code unchanged since the last session, not generated again.')
+            if not os.path.exists(self._code_file_path()):
+                self.save_code()
+        print(f'Code saved to {self._code_file_path()}')
+
+        # Feedback
+        feedback = ask('feedback', 'Would you like feedback on the strategy? (y/n)')
+        if not feedback.strip().lower().startswith('y'):
+            return
+
+        def get_feedback():
+            chunks = []
+            for chunk in self.stream_strategy_feedback(feedback_basis='code'):
+                print(chunk, end='', flush=True)
+                chunks.append(chunk)
+            print()
+            return ''.join(chunks)
+
+        feedback_inputs = {'code': self.code,
+                           'model': self.coding_agent._model_key(self.settings['strategy_feedback_temp']),
+                           'test_mode': self.coding_agent.test_mode}
+        feedback, reused = session.step('feedback', feedback_inputs, get_feedback)
+        if reused:
+            print(feedback)
         return
-    def run_backtest(self):
+    @property
+    def code_validator(self):
+        '''
+        validator of generated code, runs smoke tests in the backtest worker. Created on first use.
+        :return: CodeValidator
+        '''
+        if self._code_validator is None:
+            from code_validation import CodeValidator
+            self._code_validator = CodeValidator(backtest_runner=self.backtest_runner,
+                                                 smoke_bars=self.settings.get('smoke_test_bars', 50))
+        return self._code_validator
+    @traced
+    def validate_code(self, smoke_test = True, code = None):
+        '''
+        checks the code in memory without running the full backtest: syntax, strategy and cerebro setup, undefined
+        names, data files and a smoke backtest over a few bars. Prints the errors of the first failing check.
+        :param smoke_test: bool
+        :param code: str, code to check instead of the code in memory
+        :return: report: dict with keys ok, stage, errors, timings, smoke_result
+        '''
+        from code_validation import format_errors
+
+        report = self.code_validator.validate(self.code if code is None else code, smoke_test=smoke_test)
+        if not report['ok']:
+            print(f"Code validation failed ({report['stage']}):\n{format_errors(report)}")
+        return report
+    @traced
+    def fix_code(self, max_iterations = None, smoke_test = True):
+        '''
+        validates the code in memory and sends the errors back to the coding agent until the code passes or the
+        iterations are used up. Every attempt fixes the previous one. The code in memory is only replaced by a fix
+        that passes, otherwise it is left unchanged.
+        :param max_iterations: int, llm fix attempts, defaults to max_fix_iterations in settings.yaml
+        :param smoke_test: bool
+        :return: report of the last validation, see validate_code(), with the additional key fix_iterations
+        '''
+        from code_validation import format_errors
+
+        if max_iterations is None:
+            max_iterations = self.settings.get('max_fix_iterations', 3)
+
+        report = self.validate_code(smoke_test=smoke_test)
+        code = self.code
+        iterations = 0
+        while not report['ok'] and iterations < max_iterations:
+            iterations += 1
+            print(f'Fixing code, attempt {iterations} of {max_iterations}')
+            prompt = self.prompt_library.format('fix_code', user_input=code, errors=format_errors(report))
+            # a fix of similar code is no fix of this code, the semantic cache is bypassed
+            fixed_code = self.coding_agent.code(prompt=prompt,
+                                                temperature=self.settings['coding_temp'],
+                                                goal_code='fix_code',
+                                                semantic=False)
+            if fixed_code.strip() == code.strip():
+                # the same answer again will not pass either
+                break
+            code = fixed_code
+            report = self.validate_code(smoke_test=smoke_test, code=code)
+
+        if report['ok'] and iterations:
+            self.code = code
+            print(f'Code fixed after {iterations} attempt(s)')
+        elif iterations:
+            print(f'No fix passed validation after {iterations} attempt(s), the code is unchanged')
+        report['fix_iterations'] = iterations
+        return report
+    def _auto_fix(self):
+        '''
+        runs fix_code() on newly generated code if validate_code is enabled in settings.yaml. Skipped in test mode,
+        where the coding agent answers with placeholder text.
+        :return: report or None
+        '''
+        if not self.settings.get('validate_code', False) or self.coding_agent.test_mode:
+            return None
+        return self.fix_code()
+    @property
+    def backtest_runner(self):
+        '''
+        warm worker process executing generated code, started on first use.
+        :return: BacktestRunner
+        '''
+        if self._backtest_runner is None:
+            from backtest_runner import BacktestRunner
+            self._backtest_runner = BacktestRunner(max_workers=1,
+                                                   cache_dir=os.path.join(self.settings['cache_dir'], 'market_data'))
+        return self._backtest_runner
+    @property
+    def results_store(self):
+        '''
+        store of recorded backtest runs in <cache_dir>/results.sqlite, opened on first use.
+        :return: ResultsStore
+        '''
+        if self._results_store is None:
+            from results_store import ResultsStore
+            self._results_store = ResultsStore(os.path.join(self.settings['cache_dir'], 'results.sqlite'))
+        return self._results_store
+    def _current_code(self):
+        '''
+        the code in memory, or the saved project file if nothing is loaded.
+        :return: code: str or None
+        '''
+        if self.code:
+            return self.code
+        try:
+            with open(self._code_file_path()) as f:
+                return f.read()
+        except FileNotFoundError:
+            print(f"No code in memory and no code file found at {self._code_file_path()}")
+            return None
+    @traced
+    def run_backtest(self, in_process = True, plot = False, timeout = None, reuse = True, profile = False):
         '''
         Runs the backtest by executing the python code.
-        :return:
+        By default the code in memory (or the saved project file if nothing is loaded) runs in a warm worker process
+        and the analyzer results are returned as python objects. in_process=False runs the saved project file in a
+        fresh python subprocess instead.
+        In-process runs are recorded in the results store with their equity curve and trades. A run of identical code
+        on unchanged data files is answered from the store.
+        With profile=True the backtest runs under cProfile and a hot-spot report of the strategy methods is printed.
+        Profiled runs always run and are not recorded, their runtime includes the profiler overhead.
+        :param in_process: bool
+        :param plot: bool, save cerebro.plot() output to <output_dir>/<project_name>_plot.png
+        :param timeout: seconds
+        :param reuse: bool, return the stored result of an identical run instead of running the backtest again
+        :param profile: bool, add a hot-spot report to the result, see backtest_profiler
+        :return: result: dict with keys ok, error, stdout, runtime, final_value, analyzers, runs, equity_curve, trades,
+        metrics and profile if profiled (None for subprocess)
+        '''
+        if not in_process:
+            try:
+                subprocess.run(["python3", self._code_file_path()])
+            except Exception as e:
+                print(f"An error occurred when trying to execute backtest: {str(e)}")
+            return None
+
+        code = self._current_code()
+        if code is None:
+            return None
+
+        plot_path = None
+        if plot:
+            plot_path = os.path.abspath(os.path.join(self.settings["output_dir"], f'{self.settings["project_name"]}_plot.png'))
+
+        from results_store import run_key
+
+        if profile:
+            from backtest_profiler import format_report
+            result = self.backtest_runner.run(code, plot_path=plot_path, timeout=timeout, record=True, profile=True)
+            print(result['stdout'], end='')
+            if not result['ok']:
+                print(f"An error occurred when trying to execute backtest: {result['error']}")
+            elif 'profile' in result:
+                print(format_report(result['profile']))
+            return result
+
+        fingerprint = self.results_store.data_fingerprint(code)
+        if reuse and not plot and fingerprint is not None:
+            result = self.results_store.get(run_key(code, {}, fingerprint))
+            if result is not None:
+                print(result['stdout'], end='')
+                print('Result of an identical run loaded from the results store.')
+                return result
+
+        result = self.backtest_runner.run(code, plot_path=plot_path, timeout=timeout, record=True)
+
+        print(result['stdout'], end='')
+        if not result['ok']:
+            print(f"An error occurred when trying to execute backtest: {result['error']}")
+        elif result['runs']:
+            self.results_store.record(code, {}, fingerprint,
+                                      metrics={**result['metrics'], 'final_value': result['final_value'],
+                                               'runtime': result['runtime']},
+                                      result=result, project=self.settings['project_name'])
+        return result
+    def benchmark_code(self, codes, repeats = 3, timeout = None):
+        '''
+        times full runs of versions of a backtest in the warm backtest worker. The versions run in alternating rounds,
+        so drift of the machine load affects all of them alike.
+        :param codes: list of str
+        :param repeats: int, rounds, the fastest run of each version counts
+        :param timeout: seconds per run
+        :return: list of (runtime: float or None if a run failed, result of the last run) per version
+        '''
+        runtimes = [[] for _ in codes]
+        results = [None for _ in codes]
+        for _ in range(repeats):
+            for index, code in enumerate(codes):
+                if results[index] is not None and not results[index]['ok']:
+                    continue
+                results[index] = self.backtest_runner.run(code, timeout=timeout, record=True)
+                runtimes[index].append(results[index]['runtime'])
+        return [(min(times) if result['ok'] else None, result) for times, result in zip(runtimes, results)]
+    @traced
+    def optimise_speed(self, repeats = 3, apply = True, timeout = None):
+        '''
+        profiles the backtest, sends the hot-spot report with the code to the coding agent for a faster version and
+        benchmarks both versions. The optimised code replaces the code in memory only if it passes validation,
+        produces identical results (final value, trades and metrics) and runs faster.
+        :param repeats: int, benchmark runs per version
+        :param apply: bool, replace the code in memory with an accepted optimisation
+        :param timeout: seconds per run
+        :return: report: dict with keys profile, code, original_runtime, optimised_runtime, speedup, differences and
+        applied, None if the original backtest fails
+        '''
+        from backtest_profiler import compare_results, format_report
+
+        code = self._current_code()
+        if code is None:
+            return None
+        profiled = self.backtest_runner.run(code, timeout=timeout, record=True, profile=True)
+        if not profiled['ok']:
+            print(f"An error occurred when trying to execute backtest: {profiled['error']}")
+            return None
+        profile_text = format_report(profiled['profile'])
+        print(profile_text)
+
+        prompt = self.prompt_library.format('optimise_code_speed', user_input=code, profile=profile_text)
+        # a faster version of similar code is not a faster version of this code, the semantic cache is bypassed
+        optimised_code = self.coding_agent.code(prompt=prompt,
+                                                temperature=self.settings['coding_temp'],
+                                                goal_code='optimise_code_speed',
+                                                semantic=False)
+        report = {'profile': profiled['profile'], 'code': optimised_code, 'original_runtime': None,
+                  'optimised_runtime': None, 'speedup': None, 'differences': [], 'applied': False}
+
+        validation = self.code_validator.validate(optimised_code)
+        if not validation['ok']:
+            from code_validation import format_errors
+            print(f"Optimised code rejected, validation failed ({validation['stage']}):\n{format_errors(validation)}")
+            report['differences'] = ['optimised code is invalid']
+            return report
+
+        (report['original_runtime'], original), (report['optimised_runtime'], optimised) = \
+            self.benchmark_code([code, optimised_code], repeats=repeats, timeout=timeout)
+        if report['optimised_runtime'] is None:
+            print(f"Optimised code rejected, the backtest failed: {optimised['error']}")
+            report['differences'] = ['optimised backtest failed']
+            return report
+
+        report['speedup'] = report['original_runtime'] / report['optimised_runtime']
+        report['differences'] = compare_results(original, optimised)
+        print(f"Original {report['original_runtime']:.3f} s, optimised {report['optimised_runtime']:.3f} s "
+              f"({report['speedup']:.2f}x)")
+        if report['differences']:
+            print('Optimised code rejected, the results differ: ' + '; '.join(report['differences']))
+        elif report['speedup'] <= 1:
+            print('Optimised code rejected, it is not faster')
+        elif apply:
+            self.code = optimised_code
+            report['applied'] = True
+            print('Optimised code applied, results are identical')
+        return report
+    @traced
+    def optimise_strategy(self, param_grid = None, random_space = None, n_iter = 50, max_workers = None,
+                          data_dir = None, resume = True, engine = 'auto'):
+        '''
+        sweeps the params of the strategy in the stored code over a grid or a random-search space.
+        Combinations run in parallel across all cores, results are checkpointed to
+        <output_dir>/<project_name>_sweep.jsonl so an interrupted sweep resumes. The rows are recorded in the results
+        store.
+
+        Example:
+            results = copilot.optimise_strategy(param_grid={'pfast': [5, 10, 15], 'pslow': [30, 50]})
+            results.sort_values('sharpe', ascending=False)
+
+        :param param_grid: dict mapping param name to list of values
+        :param random_space: dict mapping param name to list of choices or (low, high) bounds
+        :param n_iter: int, number of random-search draws
+        :param max_workers: int, defaults to all cores
+        :param data_dir: str, directory of the data files referenced in the code
+        :param resume: bool, reuse completed combinations of a previous sweep
+        :param engine: 'auto' screens simple signal strategies with the vectorized engine and runs everything else
+        in backtrader, 'backtrader' and 'vectorized' force an engine
+        :return: results: pandas.DataFrame
+        '''
+        from optimiser import ParameterSweep, parameter_grid, random_search
+
+        if param_grid is not None:
+            combinations = parameter_grid(param_grid)
+        elif random_space is not None:
+            combinations = random_search(random_space, n_iter=n_iter)
+        else:
+            raise ValueError('provide either param_grid or random_space')
+
+        os.makedirs(self.settings["output_dir"], exist_ok=True)
+        checkpoint_path = os.path.join(self.settings["output_dir"], f'{self.settings["project_name"]}_sweep.jsonl')
+        if not resume and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        sweep = ParameterSweep(code=self.code,
+                               data_dir=data_dir,
+                               max_workers=max_workers,
+                               checkpoint_path=checkpoint_path,
+                               cache_dir=os.path.join(self.settings['cache_dir'], 'market_data'),
+                               engine=engine)
+        results = sweep.run(combinations)
+
+        fingerprint = self.results_store.data_fingerprint(self.code, cwd=data_dir)
+        names = sorted({name for params in combinations for name in params})
+        self.results_store.record_many([{'code': self.code,
+                                         'params': {name: row[name] for name in names if name in row},
+                                         'data_fingerprint': fingerprint,
+                                         'metrics': row,
+                                         'engine': row['engine'],
+                                         'project': self.settings['project_name']}
+                                        for row in results.to_dict('records')])
+        return results
+    @traced
+    def walk_forward(self, param_grid = None, random_space = None, n_iter = 50, in_sample = '1Y', out_of_sample = '3M',
+                     anchored = False, metric = 'sharpe', maximise = True, max_workers = None, data_dir = None):
+        '''
+        walk-forward test of the strategy in the stored code: the params are optimised on every in-sample window and
+        the best combination is evaluated on the following out-of-sample window. All windows run in parallel.
+
+        Example:
+            result = copilot.walk_forward(param_grid={'pfast': [5, 10, 20], 'pslow': [30, 50]},
+                                          in_sample='1Y', out_of_sample='6M')
+            result['windows'], result['metrics'], result['equity_curve'].plot()
+
+        :param param_grid: dict mapping param name to list of values
+        :param random_space: dict mapping param name to list of choices or (low, high) bounds
+        :param n_iter: int, number of random-search draws
+        :param in_sample: window length such as '90D', '6M' or '2Y'
+        :param out_of_sample: window length
+        :param anchored: bool, in-sample windows start with the data instead of rolling
+        :param metric: str, in-sample ranking, e.g. 'sharpe', 'total_return' or 'max_drawdown' with maximise=False
+        :param maximise: bool
+        :param max_workers: int, defaults to all cores
+        :param data_dir: str, directory of the data files referenced in the code
+        :return: result: dict with keys windows (pandas.DataFrame), equity_curve (pandas.Series of the chained
+        out-of-sample equity), metrics and trades, see walk_forward.WalkForward.run()
+        '''
+        from optimiser import parameter_grid, random_search
+        from walk_forward import WalkForward
+
+        if param_grid is not None:
+            combinations = parameter_grid(param_grid)
+        elif random_space is not None:
+            combinations = random_search(random_space, n_iter=n_iter)
+        else:
+            raise ValueError('provide either param_grid or random_space')
+
+        engine = WalkForward(code=self.code,
+                             data_dir=data_dir,
+                             max_workers=max_workers,
+                             cache_dir=os.path.join(self.settings['cache_dir'], 'market_data'))
+        return engine.run(combinations, in_sample=in_sample, out_of_sample=out_of_sample, anchored=anchored,
+                          metric=metric, maximise=maximise)
+    @traced
+    def robustness(self, result = None, n_simulations = 10000, methods = ('bootstrap', 'reshuffle', 'perturb'),
+                   block_size = 1, noise = 0.5, confidence = 0.95, max_workers = None, seed = None):
         '''
+        Monte Carlo robustness analysis of a backtest: the bar returns are bootstrapped and perturbed and the closed
+        trades reshuffled to get confidence intervals of the final PnL, max drawdown and Sharpe ratio.
+
+        Example:
+            report = copilot.robustness(n_simulations=100000)
+            report['bootstrap']['max_drawdown']['upper']
+
+        :param result: dict returned by run_backtest(), None runs the backtest (or loads it from the results store)
+        :param n_simulations: int, simulations per method
+        :param methods: subset of 'bootstrap', 'reshuffle' and 'perturb'
+        :param block_size: int, bars per block of the bootstrap
+        :param noise: float, standard deviation of the perturbation as a multiple of the bar return deviation
+        :param confidence: float, width of the confidence intervals
+        :param max_workers: int, worker processes for large jobs, None runs in process
+        :param seed: int, seed for reproducible simulations
+        :return: report: dict, see robustness.MonteCarlo.run(), None if the backtest failed
+        '''
+        from robustness import MonteCarlo
+
+        if result is None:
+            result = self.run_backtest()
+        if result is None or not result['ok']:
+            return None
+        analysis = MonteCarlo.from_result(result, n_simulations=n_simulations, methods=methods,
+                                          block_size=block_size, noise=noise, confidence=confidence,
+                                          max_workers=max_workers, seed=seed)
+        return analysis.run()
+
+
+def _parse_grid(assignments):
+    '''
+    parses name=v1,v2 command line assignments into a param grid.
+    :param assignments: list of str
+    :return: param_grid: dict
+    '''
+    import ast
+    param_grid = {}
+    for assignment in assignments:
+        name, _, values = assignment.partition('=')
+        if not values:
+            raise ValueError(f'invalid grid assignment {assignment}, expected name=v1,v2')
+        parsed = []
+        for value in values.split(','):
+            try:
+                parsed.append(ast.literal_eval(value))
+            except (ValueError, SyntaxError):
+                parsed.append(value)
+        param_grid[name.strip()] = parsed
+    return param_grid
+
+
+def main(argv = None):
+    '''
+    command line entry point. Heavy dependencies are only imported by the commands that need them.
+
+    Examples:
+        python -m bt_copilot describe resources/example_backtest.py
+        python -m bt_copilot build --datapipeline "..." --strategy "..." --analysers "..."
+        python -m bt_copilot batch ideas.csv --datapipeline "..." --rpm 500
+        python -m bt_copilot validate outputs/myBacktest.py --fix
+        python -m bt_copilot speedup outputs/myBacktest.py --repeats 3
+        python -m bt_copilot optimise outputs/myBacktest.py --grid pfast=5,10,15 --grid pslow=30,50
+        python -m bt_copilot walkforward outputs/myBacktest.py --grid pfast=5,10 --in-sample 1Y --out-of-sample 3M
+        python -m bt_copilot robustness outputs/myBacktest.py --simulations 100000
+        python -m bt_copilot results --by sharpe --where "max_drawdown<20" --limit 50
+        python -m bt_copilot importtime --budget-ms 50
+
+    :param argv: list of str, defaults to sys.argv[1:]
+    :return: exit code: int
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='bt_copilot', description='backtrader copilot command line interface')
+    parser.add_argument('--test-mode', action='store_true', help='answer llm calls with placeholder text')
+    parser.add_argument('--trace', metavar='FILE', help='record llm call metrics and spans to a JSONL file and '
+                                                      'print a latency, token and cost summary')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name, help_text in (('describe', 'describe the strategy of a backtest file'),
+                            ('feedback', 'get feedback on the strategy of a backtest file'),
+                            ('visualise', 'render a flowchart of the strategy of a backtest file')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('file')
+        if name != 'visualise':
+            command.add_argument('--incremental', action='store_true',
+                                 help='analyse per code component and only re-query changed components')
+
+    build = commands.add_parser('build', help='generate backtest code from natural language descriptions')
+    build.add_argument('--datapipeline', required=True)
+    build.add_argument('--strategy', required=True)
+    build.add_argument('--analysers', required=True)
+    build.add_argument('--universe', action='store_true',
+                       help='multi-symbol data: load all symbol files with data_pipeline.add_universe()')
+    build.add_argument('--custom', default='')
+    build.add_argument('--project', help='project name used for the output file')
+    build.add_argument('--no-stream', action='store_true', help='print the code once it is complete')
+    build.add_argument('--candidates', type=int, help='generate several candidates in parallel and keep the first '
+                                                      'that passes validation')
+    build.add_argument('--temperatures', help='comma separated temperature per candidate, e.g. 0.2,0.5,0.8')
+
+    batch = commands.add_parser('batch', help='generate code for every row of a CSV or JSONL file of descriptions')
+    batch.add_argument('file')
+    batch.add_argument('--datapipeline', default='', help='used for rows without a datapipeline description')
+    batch.add_argument('--analysers', default='', help='used for rows without an analysers description')
+    batch.add_argument('--project', help='project name used for the output directory')
+    batch.add_argument('--workers', type=int, default=8)
+    batch.add_argument('--rpm', type=int, default=60, help='requests per minute')
+    batch.add_argument('--retries', type=int, default=4)
+    batch.add_argument('--no-resume', action='store_true')
+
+    validate = commands.add_parser('validate', help='check a backtest file with static checks and a smoke test')
+    validate.add_argument('file')
+    validate.add_argument('--fix', action='store_true', help='let the coding agent fix errors and update the file')
+    validate.add_argument('--no-smoke-test', action='store_true')
+
+    run = commands.add_parser('run', help='run a backtest file')
+    run.add_argument('file')
+    run.add_argument('--plot', action='store_true')
+    run.add_argument('--subprocess', action='store_true', help='run in a fresh python process')
+    run.add_argument('--no-reuse', action='store_true', help='run again even if an identical run is stored')
+    run.add_argument('--profile', action='store_true', help='print a hot-spot report of the strategy methods')
+    speed = commands.add_parser('speedup', help='profile a backtest file, let the coding agent optimise the hot spots '
+                                                'and keep the faster code if the results are identical')
+    speed.add_argument('file')
+    speed.add_argument('--repeats', type=int, default=3, help='benchmark runs per version')
+    speed.add_argument('--dry-run', action='store_true', help='benchmark the optimised code without writing it')
+
+    optimise = commands.add_parser('optimise', help='sweep the strategy params of a backtest file')
+    optimise.add_argument('file')
+    optimise.add_argument('--grid', action='append', required=True, metavar='NAME=V1,V2')
+    optimise.add_argument('--engine', default='auto', choices=('auto', 'backtrader', 'vectorized'))
+    optimise.add_argument('--workers', type=int)
+
+    walkforward = commands.add_parser('walkforward', help='optimise on rolling in-sample windows and evaluate '
+                                                          'out of sample')
+    walkforward.add_argument('file')
+    walkforward.add_argument('--grid', action='append', required=True, metavar='NAME=V1,V2')
+    walkforward.add_argument('--in-sample', default='1Y', help='window length such as 90D, 6M or 2Y')
+    walkforward.add_argument('--out-of-sample', default='3M')
+    walkforward.add_argument('--anchored', action='store_true', help='in-sample windows start with the data')
+    walkforward.add_argument('--metric', default='sharpe')
+    walkforward.add_argument('--minimise', action='store_true', help='select the lowest metric, e.g. max_drawdown')
+    walkforward.add_argument('--workers', type=int)
+
+    robustness = commands.add_parser('robustness', help='Monte Carlo confidence intervals of the PnL, drawdown and '
+                                                        'Sharpe ratio of a backtest file')
+    robustness.add_argument('file')
+    robustness.add_argument('--simulations', type=int, default=10000, help='simulations per method')
+    robustness.add_argument('--method', action='append', choices=['bootstrap', 'reshuffle', 'perturb'],
+                            help='defaults to all methods')
+    robustness.add_argument('--block-size', type=int, default=1, help='bars per block of the bootstrap')
+    robustness.add_argument('--confidence', type=float, default=0.95)
+    robustness.add_argument('--workers', type=int)
+    robustness.add_argument('--seed', type=int)
+
+    results = commands.add_parser('results', help='query the recorded backtest runs')
+    results.add_argument('--by', default='sharpe', help='column to sort by')
+    results.add_argument('--ascending', action='store_true')
+    results.add_argument('--where', action='append', default=[], metavar='CONDITION',
+                         help='filter such as "max_drawdown<20", repeat to combine')
+    results.add_argument('--limit', type=int, default=50)
+
+    autopilot = commands.add_parser('autopilot', help='guided backtest setup, resumes the session of a project')
+    autopilot.add_argument('--no-resume', action='store_true', help='discard the stored session of the project')
+
+    importtime = commands.add_parser('importtime', help='check the import time of the copilot against a budget')
+    importtime.add_argument('--budget-ms', type=float, default=50.0)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'importtime':
+        from import_budget import check_import_budget
+        return 0 if check_import_budget(args.budget_ms) else 1
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+
+    from coding_agent import SimpleCodingAgent
+    from llm_cache import LLMResponseCache
+
+    metrics = None
+    if args.trace:
+        from metrics import MetricsRegistry
+        metrics = MetricsRegistry(trace_path=args.trace)
+
+    coding_agent = SimpleCodingAgent(API_KEY=os.getenv('API_KEY'), test_mode=args.test_mode, metrics=metrics)
+    copilot = BtCopilot(coding_agent=coding_agent)
+    coding_agent.cache = LLMResponseCache(path=os.path.join(copilot.settings['cache_dir'], 'llm_responses.sqlite'))
+    if copilot.settings.get('semantic_cache', False):
+        from semantic_cache import SemanticCache
+        coding_agent.semantic_cache = SemanticCache(path=os.path.join(copilot.settings['cache_dir'],
+                                                                      'semantic_responses.sqlite'),
+                                                    threshold=copilot.settings.get('semantic_cache_threshold', 0.9))
+
+    if getattr(args, 'file', None):
+        copilot.load_code(args.file)
+        if not copilot.code:
+            return 1
+
+    if args.command == 'describe':
+        print(copilot.get_strategy_description(incremental=args.incremental or None))
+    elif args.command == 'feedback' and args.incremental:
+        print(copilot.get_strategy_feedback(feedback_basis='code', incremental=True))
+    elif args.command == 'feedback':
+        for chunk in copilot.stream_strategy_feedback(feedback_basis='code'):
+            print(chunk, end='', flush=True)
+        print()
+    elif args.command == 'visualise':
+        copilot.visualise_strategy(vis_basis='code')
+    elif args.command == 'build':
+        if args.project:
+            copilot.settings['project_name'] = args.project
+        copilot.set_datapipeline(args.datapipeline, universe=args.universe)
+        copilot.set_strategy(args.strategy)
+        copilot.set_analysers(args.analysers)
+        if args.custom:
+            copilot.set_custom_prompt(args.custom)
+        copilot.compose_prompt_from_elements()
+        temperatures = [float(value) for value in args.temperatures.split(',')] if args.temperatures else None
+        if args.no_stream or args.candidates or temperatures or copilot.settings.get('code_candidates', 1) > 1:
+            copilot.build_code_from_prompt(candidates=args.candidates, temperatures=temperatures)
+            copilot.save_code()
+            print(copilot.code)
+        else:
+            for chunk in copilot.stream_code_from_prompt(save=True):
+                print(chunk, end='', flush=True)
+            print()
+        print(f'Code saved to {copilot._code_file_path()}')
+    elif args.command == 'batch':
+        if args.project:
+            copilot.settings['project_name'] = args.project
+        entries = copilot.generate_batch(args.file,
+                                         defaults={'datapipeline': args.datapipeline, 'analysers': args.analysers},
+                                         max_workers=args.workers,
+                                         requests_per_minute=args.rpm,
+                                         max_retries=args.retries,
+                                         resume=not args.no_resume)
+        failed = [entry for entry in entries if not entry['ok']]
+        print(f'{len(entries) - len(failed)} of {len(entries)} generated')
+        if failed:
+            return 1
+    elif args.command == 'validate':
+        if args.fix:
+            report = copilot.fix_code(smoke_test=not args.no_smoke_test)
+            if report['ok'] and report['fix_iterations']:
+                with open(args.file, 'w') as f:
+                    f.write(copilot.code)
+                print(f'Code written to {args.file}')
+        else:
+            report = copilot.validate_code(smoke_test=not args.no_smoke_test)
+        timings = ', '.join(f'{stage} {seconds * 1000:.1f} ms' for stage, seconds in report['timings'].items())
+        print(f"{'Valid' if report['ok'] else 'Invalid'} ({timings})")
+        if not report['ok']:
+            return 1
+    elif args.command == 'run':
+        if args.subprocess:
+            subprocess.run(['python3', args.file])
+        else:
+            result = copilot.run_backtest(plot=args.plot, reuse=not args.no_reuse, profile=args.profile)
+            if result is None or not result['ok']:
+                return 1
+            if result['final_value'] is not None:
+                print(f"Final value: {result['final_value']:.2f}")
+    elif args.command == 'speedup':
+        report = copilot.optimise_speed(repeats=args.repeats, apply=not args.dry_run)
+        if report is None:
+            return 1
+        if report['applied']:
+            with open(args.file, 'w') as f:
+                f.write(copilot.code)
+            print(f'Code written to {args.file}')
+    elif args.command == 'optimise':
+        results = copilot.optimise_strategy(param_grid=_parse_grid(args.grid), max_workers=args.workers,
+                                            data_dir=os.path.dirname(os.path.abspath(args.file)),
+                                            engine=args.engine)
+        print(results.to_string())
+    elif args.command == 'walkforward':
+        result = copilot.walk_forward(param_grid=_parse_grid(args.grid), in_sample=args.in_sample,
+                                      out_of_sample=args.out_of_sample, anchored=args.anchored, metric=args.metric,
+                                      maximise=not args.minimise, max_workers=args.workers,
+                                      data_dir=os.path.dirname(os.path.abspath(args.file)))
+        print(result['windows'].to_string())
+        print('Out of sample: ' + ', '.join(f'{key} {value:.4g}' for key, value in result['metrics'].items()
+                                            if value is not None))
+    elif args.command == 'robustness':
+        from robustness import report_frame
+        report = copilot.robustness(n_simulations=args.simulations,
+                                    methods=args.method or ('bootstrap', 'reshuffle', 'perturb'),
+                                    block_size=args.block_size, confidence=args.confidence, max_workers=args.workers,
+                                    seed=args.seed)
+        if report is None:
+            return 1
+        print(report_frame(report).to_string(index=False))
+        print('Probability of loss: ' + ', '.join(f"{method} {results['probability_of_loss']:.1%}"
+                                                  for method, results in report.items()))
+    elif args.command == 'results':
+        import re
+        import pandas as pd
+        where = []
+        for condition in args.where:
+            match = re.fullmatch(r'\s*(\w+)\s*(<=|>=|!=|==|<|>|=)\s*(.+?)\s*', condition)
+            if match is None:
+                print(f'Invalid condition {condition}, expected e.g. "max_drawdown<20"')
+                return 1
+            column, operator, value = match.groups()
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+            where.append((column, operator, value))
         try:
-            subprocess.run(["python3", f"{self.settings['project_name']}.py"])
-        except Exception as e:
-            print(f"An error occurred when trying to execute backtest: {str(e)}")
+            rows = copilot.results_store.query(where=where, order_by=args.by, descending=not args.ascending,
+                                               limit=args.limit)
+        except ValueError as e:
+            print(str(e))
+            return 1
+        if rows:
+            print(pd.DataFrame(rows).drop(columns=['run_key', 'code_sha', 'data_fingerprint']).to_string(index=False))
+        else:
+            print('No recorded runs match.')
+    elif args.command == 'autopilot':
+        copilot.autopilot(resume=not args.no_resume)
 
+    if copilot._backtest_runner is not None:
+        copilot._backtest_runner.close()
+    if metrics is not None:
+        metrics.report()
+    return 0
 
 
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+import threading
+import openai
+import requests
+from langchain.llms import OpenAI
+
+"""
+Long-lived llm clients for the coding agent.
+Clients are created once per (model, temperature) and share one keep-alive HTTP session,
+so repeated calls skip client setup and the TLS/HTTP connection handshake.
+The openai package takes its session from the global openai.requestssession and keeps it per thread, a session
+cannot be passed per request. The session is therefore process-wide: it is created by the first pool, shared by all
+pools of the process and stays installed, closing the last pool only closes its connections.
+"""
+
+# keep-alive session of the process, see _shared_session()
+_shared = {'session': None, 'adapter': None, 'pools': 0}
+_shared_lock = threading.Lock()
+
+
+def _shared_session(pool_size):
+    '''
+    returns the keep-alive session of the process, creating and installing it for the openai package on first use.
+    :param pool_size: int, open keep-alive connections per host, only used by the first pool
+    :return: (session: requests.Session, adapter: requests.adapters.HTTPAdapter)
+    '''
+    with _shared_lock:
+        if _shared['session'] is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                    pool_maxsize=pool_size,
+                                                    max_retries=2)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _shared.update(session=session, adapter=adapter)
+        # the openai package sends all requests through this session
+        openai.requestssession = _shared['session']
+        _shared['pools'] += 1
+        return _shared['session'], _shared['adapter']
+
+
+class LLMClientPool:
+    """
+    Pool of langchain OpenAI clients keyed by model and temperature.
+    All clients send their requests through a single requests.Session with a bounded keep-alive connection pool.
+    The session is shared by all pools of the process, one pool per process is enough
+    (see SimpleCodingAgent.client_pool).
+    """
+    def __init__(self, API_KEY, max_tokens = 2000, pool_size = 8, api_base = None):
+        """
+        Constructs a new instance of the client pool.
+        Args:
+            API_KEY: OpenAI API key
+            max_tokens: maximum number of tokens per completion
+            pool_size: maximum number of cached clients and of open keep-alive connections per host. The connection
+            limit is set by the first pool of the process.
+            api_base: optional base url of the completions endpoint, e.g. a local mock server
+        """
+
+        self.API_KEY = API_KEY
+        self.max_tokens = max_tokens
+        self.pool_size = pool_size
+        self.api_base = api_base
+
+        # clients in least recently used order
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+        # client counters
+        self.clients_created = 0
+        self.clients_reused = 0
+
+        # keep-alive session shared by all clients of the process
+        self.session, self._adapter = _shared_session(pool_size)
+        self._closed = False
+
+    def get(self, model_name, temperature):
+        '''
+        returns the client for model and temperature, creating it on first use.
+        :param model_name: str
+        :param temperature: float
+        :return: client: langchain.llms.OpenAI
+        '''
+        key = (model_name, round(float(temperature), 4))
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                self.clients_reused += 1
+                return client
+
+            kwargs = {'openai_api_key': self.API_KEY,
+                      'model_name': model_name,
+                      'max_tokens': self.max_tokens,
+                      'temperature': temperature}
+            if self.api_base:
+                kwargs['openai_api_base'] = self.api_base
+            client = OpenAI(**kwargs)
+
+            self._clients[key] = client
+            self.clients_created += 1
+
+            # drop least recently used client once the pool is full
+            if len(self._clients) > self.pool_size:
+                self._clients.popitem(last=False)
+
+        return client
+
+    def stats(self):
+        '''
+        reports client and connection reuse counters. Connections are counted for the shared session of the process.
+        :return: stats: dict
+        '''
+        connections_opened = 0
+        requests_sent = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            try:
+                connection_pool = pools[key]
+            except KeyError:
+                continue
+            connections_opened += connection_pool.num_connections
+            requests_sent += connection_pool.num_requests
+
+        return {'clients_created': self.clients_created,
+                'clients_reused': self.clients_reused,
+                'connections_opened': connections_opened,
+                'requests_sent': requests_sent,
+                'connections_reused': max(requests_sent - connections_opened, 0)}
+
+    def close(self):
+        '''
+        drops the clients. The pooled connections are closed with the last open pool of the process, the session stays
+        installed and reconnects on the next request.
+        :return:
+        '''
+        with self._lock:
+            self._clients.clear()
+        with _shared_lock:
+            if self._closed:
+                return
+            self._closed = True
+            _shared['pools'] -= 1
+            if _shared['pools'] == 0:
+                self.session.close()
+        return
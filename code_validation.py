@@ -0,0 +1,299 @@
+import ast
+import builtins
+import glob
+import os
+import time
+
+"""
+Validation of generated backtest code before it is executed.
+Cheap checks run first and stop at the first failing stage: syntax (ast/compile), structure (a bt.Strategy subclass
+and a Cerebro setup with data, strategy and run), undefined names and referenced data files. Only code that passes all
+static checks gets a short smoke backtest in the warm worker, limited to a few bars after the indicator warm-up.
+The error messages are written to be sent back to the coding agent, see BtCopilot.fix_code().
+"""
+
+# calls that add data feeds to cerebro, add_universe() is in data_pipeline
+_DATA_CALLS = {'adddata', 'resampledata', 'replaydata', 'chaindata', 'rolloverdata', 'add_universe'}
+_STRATEGY_CALLS = {'addstrategy', 'optstrategy', 'add_signal', 'signal_strategy'}
+# functions whose first positional argument is a file to be read
+_FILE_READERS = {'read_csv', 'read_parquet', 'read_excel', 'read_feather'}
+
+
+def _call_chain(node):
+    '''
+    names of an attribute access, e.g. bt.feeds.YahooFinanceCSVData -> ['bt', 'feeds', 'YahooFinanceCSVData'].
+    :param node: ast node
+    :return: chain: list of str
+    '''
+    chain = []
+    while isinstance(node, ast.Attribute):
+        chain.insert(0, node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        chain.insert(0, node.id)
+    return chain
+
+
+def _calls(tree):
+    '''
+    last names of all calls in the tree.
+    :param tree: ast.Module
+    :return: names: set of str
+    '''
+    return {chain[-1] for node in ast.walk(tree) if isinstance(node, ast.Call)
+            for chain in [_call_chain(node.func)] if chain}
+
+
+def check_syntax(code):
+    '''
+    parses and compiles the code.
+    :param code: str
+    :return: (tree or None, errors: list of str)
+    '''
+    try:
+        tree = ast.parse(code)
+        compile(tree, '<generated backtest>', 'exec')
+    except SyntaxError as e:
+        line = f': {e.text.strip()}' if e.text else ''
+        return None, [f'SyntaxError in line {e.lineno}: {e.msg}{line}']
+    except ValueError as e:
+        # e.g. null bytes in the source
+        return None, [f'Code cannot be compiled: {str(e)}']
+    return tree, []
+
+
+def check_structure(tree):
+    '''
+    checks that the code defines a strategy and sets up and runs cerebro.
+    :param tree: ast.Module
+    :return: errors: list of str
+    '''
+    errors = []
+    strategies = [node.name for node in ast.walk(tree) if isinstance(node, ast.ClassDef)
+                  and any('Strategy' in ast.unparse(base) for base in node.bases)]
+    if not strategies:
+        errors.append('No strategy class found: define a subclass of bt.Strategy.')
+
+    calls = _calls(tree)
+    if 'Cerebro' not in calls:
+        errors.append('No Cerebro instance found: create one with cerebro = bt.Cerebro().')
+    else:
+        if not calls & _DATA_CALLS:
+            errors.append('No data feed is added to cerebro: call cerebro.adddata(data).')
+        if strategies and not calls & _STRATEGY_CALLS:
+            errors.append(f'The strategy {strategies[0]} is never added to cerebro: call '
+                          f'cerebro.addstrategy({strategies[0]}).')
+        if 'run' not in calls:
+            errors.append('The backtest is never started: call cerebro.run().')
+    return errors
+
+
+def _bound_names(tree):
+    '''
+    all names the code binds anywhere: assignments, imports, definitions, arguments, loop and exception targets.
+    :param tree: ast.Module
+    :return: names: set of str
+    '''
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update((alias.asname or alias.name).split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, ast.MatchAs) and node.name:
+            names.add(node.name)
+    return names
+
+
+def check_names(tree):
+    '''
+    finds names that are used but never defined or imported, typically a missing import.
+    Scopes are not distinguished, so only names unknown to the whole module are reported.
+    :param tree: ast.Module
+    :return: errors: list of str
+    '''
+    if any(isinstance(node, ast.ImportFrom) and any(alias.name == '*' for alias in node.names)
+           for node in ast.walk(tree)):
+        # star imports can define any name
+        return []
+
+    known = _bound_names(tree) | set(dir(builtins)) | {'__file__', '__name__'}
+    errors = []
+    reported = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in known \
+                and node.id not in reported:
+            reported.add(node.id)
+            errors.append(f"Name '{node.id}' is used in line {node.lineno} but never defined or imported.")
+    return errors
+
+
+def _string_constants(tree):
+    '''
+    top level assignments of string literals, e.g. data_path = 'BTC-USD.csv'.
+    :param tree: ast.Module
+    :return: constants: dict
+    '''
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    constants[target.id] = node.value.value
+    return constants
+
+
+def data_files(tree):
+    '''
+    data files referenced by the code: string dataname arguments of feeds, files read with pandas and the symbol
+    files of data_pipeline.add_universe().
+    Paths that are built at runtime are not found.
+    :param tree: ast.Module
+    :return: paths: list of (path: str, line: int)
+    '''
+    constants = _string_constants(tree)
+
+    def value(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return node.value
+        if isinstance(node, ast.Name):
+            return constants.get(node.id)
+        return None
+
+    paths = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        chain = _call_chain(node.func)
+        candidates = [keyword.value for keyword in node.keywords
+                      if keyword.arg in ('dataname', 'filepath_or_buffer', 'sources')]
+        if chain and chain[-1] in _FILE_READERS and node.args:
+            candidates.append(node.args[0])
+        if chain and chain[-1] == 'add_universe' and len(node.args) > 1:
+            # data_pipeline.add_universe(cerebro, sources): directory or glob pattern of symbol files
+            candidates.append(node.args[1])
+        for candidate in candidates:
+            path = value(candidate)
+            if path and '://' not in path:
+                paths.append((path, node.lineno))
+    return paths
+
+
+def check_data_files(tree, cwd = None):
+    '''
+    checks that the referenced data files exist.
+    :param tree: ast.Module
+    :param cwd: str, directory relative paths are resolved in, defaults to the current directory
+    :return: errors: list of str
+    '''
+    cwd = cwd or os.getcwd()
+    errors = []
+    for path, line in data_files(tree):
+        if os.path.exists(os.path.join(cwd, path)) or glob.glob(os.path.join(cwd, path)):
+            continue
+        available = sorted(name for name in os.listdir(cwd) if name.lower().endswith(('.csv', '.txt', '.parquet')))
+        hint = f" Available data files: {', '.join(available[:10])}." if available else ''
+        errors.append(f"Data file '{path}' in line {line} does not exist (working directory {cwd}).{hint}")
+    return errors
+
+
+def _short_traceback(error):
+    '''
+    reduces a traceback to the frames in the generated code and the exception.
+    :param error: str, formatted traceback
+    :return: str
+    '''
+    lines = error.rstrip().splitlines()
+    frames = [line.strip() for line in lines if line.strip().startswith('File "<generated backtest>"')]
+    return '\n'.join(frames[-3:] + lines[-1:])
+
+
+class CodeValidator:
+    """
+    Runs the validation stages on generated code and reports the first failing stage.
+    """
+    def __init__(self, backtest_runner = None, cwd = None, smoke_bars = 50, smoke_timeout = 60):
+        """
+        Constructs a new code validator.
+        Args:
+            backtest_runner: BacktestRunner for the smoke test, None skips the smoke test
+            cwd: working directory of the backtest, relative data paths are resolved in it
+            smoke_bars: bars the strategy runs after its indicator warm-up in the smoke test
+            smoke_timeout: seconds before the smoke test counts as failed
+        """
+        self.backtest_runner = backtest_runner
+        self.cwd = cwd
+        self.smoke_bars = smoke_bars
+        self.smoke_timeout = smoke_timeout
+
+    def validate(self, code, smoke_test = True):
+        '''
+        validates generated code.
+        :param code: str
+        :param smoke_test: bool, run the short smoke backtest after the static checks
+        :return: report: dict with keys ok, stage (first failing stage or None), errors (list of str), timings
+        (seconds per stage) and smoke_result (result dict of the smoke run or None)
+        '''
+        report = {'ok': True, 'stage': None, 'errors': [], 'timings': {}, 'smoke_result': None}
+
+        def run_stage(stage, check, *args):
+            start = time.perf_counter()
+            errors = check(*args)
+            report['timings'][stage] = time.perf_counter() - start
+            if errors:
+                report.update(ok=False, stage=stage, errors=errors)
+            return not errors
+
+        start = time.perf_counter()
+        tree, errors = check_syntax(code)
+        report['timings']['syntax'] = time.perf_counter() - start
+        if errors:
+            report.update(ok=False, stage='syntax', errors=errors)
+            return report
+
+        if not (run_stage('structure', check_structure, tree) and run_stage('names', check_names, tree)
+                and run_stage('data_files', check_data_files, tree, self.cwd)):
+            return report
+
+        if smoke_test and self.backtest_runner is not None:
+            run_stage('smoke_test', self._smoke_test, code, report)
+        return report
+
+    def _smoke_test(self, code, report):
+        '''
+        runs the backtest for a few bars in the warm worker.
+        :return: errors: list of str
+        '''
+        result = self.backtest_runner.run(code, cwd=self.cwd, timeout=self.smoke_timeout, max_bars=self.smoke_bars)
+        report['smoke_result'] = result
+        return smoke_test_errors(result)
+
+
+def smoke_test_errors(result):
+    '''
+    errors of a smoke backtest.
+    :param result: dict, see backtest_runner.execute_code()
+    :return: errors: list of str
+    '''
+    if not result['ok']:
+        return [f"The backtest failed when running:\n{_short_traceback(result['error'])}"]
+    if not result['runs']:
+        return ['The backtest finished without running cerebro: make sure cerebro.run() is reached.']
+    return []
+
+
+def format_errors(report):
+    '''
+    formats the errors of a validation report for a fix prompt or console output.
+    :param report: dict, see CodeValidator.validate()
+    :return: text: str
+    '''
+    return '\n'.join(f'- {error}' for error in report['errors'])
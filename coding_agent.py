@@ -1,6 +1,6 @@
-from langchain.llms import OpenAI
 import os
-import lorem
+import time
+from llm_cache import LLMResponseCache
 
 """
 The agent that codes out certain tasks.
@@ -13,11 +13,21 @@ class SimpleCodingAgent:
     Other agents can extend this to more complex, iterative coding strategies.
 
     """
-    def __init__(self,API_KEY,test_mode = False):
+    def __init__(self,API_KEY,test_mode = False, cache = None, model_name = 'text-davinci-003', max_tokens = 2000,
+                 pool_size = 8, api_base = None, metrics = None, semantic_cache = None):
         """
         Constructs a new instance of the simple_coding_agent.
         Args:
-            None
+            API_KEY: OpenAI API key
+            test_mode: if True, no llm calls are sent and dummy results are returned
+            cache: optional LLMResponseCache. Identical requests are answered from the cache instead of the API.
+            model_name: OpenAI completion model
+            max_tokens: maximum number of tokens per completion
+            pool_size: number of long-lived llm clients and keep-alive connections kept by the agent
+            api_base: optional base url of the completions endpoint, e.g. a local mock server
+            metrics: optional MetricsRegistry recording latency, tokens and cost of every call
+            semantic_cache: optional SemanticCache. Code requests that are worded differently but mean the same as an
+            earlier one are answered with the earlier code.
         """
 
         # set OpenAI API key
@@ -26,52 +36,369 @@ class SimpleCodingAgent:
         # set test_mode variable. If True --> no llm calls are sent and dummy results are returned.
         self.test_mode = test_mode
 
-    def code(self,prompt,temperature):
+        # model settings, these are part of the cache key
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+
+        # set response cache. None --> every call is sent to the llm.
+        self.cache = cache
+
+        # near-duplicate code requests, namespaced by goal_code. None --> only identical requests are cached.
+        self.semantic_cache = semantic_cache
+
+        # long-lived llm clients sharing one keep-alive http session, created on first llm call
+        self.pool_size = pool_size
+        self.api_base = api_base
+        self._client_pool = None
+
+        # per-call instrumentation. None --> nothing is recorded.
+        self.metrics = metrics
+
+    @property
+    def client_pool(self):
+        '''
+        pool of long-lived llm clients. Created on first use, so the openai and langchain imports are only paid
+        when an llm call is made.
+        :return: LLMClientPool
+        '''
+        if self._client_pool is None:
+            from client_pool import LLMClientPool
+            self._client_pool = LLMClientPool(API_KEY=self.API_KEY,
+                                              max_tokens=self.max_tokens,
+                                              pool_size=self.pool_size,
+                                              api_base=self.api_base)
+        return self._client_pool
+
+    def code(self,prompt,temperature, goal_code = None, semantic = True):
         '''
         takes input prompt and returns code-snippet.
         :param prompt: string
+        :param goal_code: string, recorded with the call metrics
+        :param semantic: bool, answer near-duplicates of earlier requests from the semantic cache, if one is set
         :return: code: string
         '''
 
-        if self.test_mode == False:
-            # LLM calls are active
+        code_snippet = self._complete(prompt=prompt, temperature=temperature, goal_code=goal_code, semantic=semantic)
 
-            # initiate llm
-            llm = OpenAI(openai_api_key = self.API_KEY,
-                         max_tokens=2000,
-                         temperature = temperature)
+        return code_snippet
 
-            # run llm call
-            code_snippet = llm(prompt=prompt)
+    def simple_LLMcall(self,prompt,temperature, goal_code = None):
+        '''
+        takes input prompt and returns llm response.
+        :param prompt: string
+        :param goal_code: string, recorded with the call metrics
+        :return: code: string
+        '''
 
-        else:
-        # LLM calls are deactivated. Only dummy code is returned.
-            code_snippet = lorem.paragraph()
+        llm_response = self._complete(prompt=prompt, temperature=temperature, goal_code=goal_code)
 
+        return llm_response
 
-        return code_snippet
+    def _complete(self, prompt, temperature, goal_code, semantic = False):
+        '''
+        answers a prompt in one piece and records the call metrics.
+        :param prompt: string
+        :param temperature: float
+        :param goal_code: string
+        :param semantic: bool, look the prompt up in the semantic cache
+        :return: llm response: string
+        '''
+        start = time.perf_counter()
+        llm_response = ''
+        cache_hit = False
+        error = None
+        try:
+            if self.test_mode == False:
+                # LLM calls are active
+                llm_response, cache_hit = self._call_llm(prompt=prompt, temperature=temperature, goal_code=goal_code,
+                                                         semantic=semantic)
 
-    def simple_LLMcall(self,prompt,temperature):
+            else:
+                # LLM calls are deactivated. Only dummy code is returned.
+                import lorem
+                llm_response = lorem.paragraph()
+        except Exception as e:
+            error = f'{type(e).__name__}: {str(e)}'
+            raise
+        finally:
+            self._record_call(prompt=prompt, response=llm_response, goal_code=goal_code, start=start,
+                              cache_hit=cache_hit, error=error)
+
+        return llm_response
+
+    def _record_call(self, prompt, response, goal_code, start, first_chunk = None, cache_hit = False, error = None,
+                     streamed = False):
         '''
-        takes input prompt and returns llm response.
+        records a call in the metrics registry, if one is set.
+        :param start: perf_counter at request time
+        :param first_chunk: perf_counter when the first chunk arrived, None for non-streamed calls
+        :return:
+        '''
+        if self.metrics is None:
+            return
+        end = time.perf_counter()
+        self.metrics.record_call(model_name=self.model_name,
+                                 prompt=prompt,
+                                 completion=response,
+                                 latency=end - start,
+                                 time_to_first_token=None if first_chunk is None else first_chunk - start,
+                                 goal_code=goal_code,
+                                 cache_hit=cache_hit,
+                                 error=error,
+                                 streamed=streamed,
+                                 test_mode=self.test_mode)
+        return
+
+    async def acode(self, prompt, temperature, goal_code = None):
+        '''
+        async variant of code(). The blocking llm call runs in a worker thread, so several calls can be in flight.
         :param prompt: string
+        :param temperature: float
+        :param goal_code: string
         :return: code: string
         '''
+        import asyncio
+        return await asyncio.to_thread(self.code, prompt, temperature, goal_code)
 
-        if self.test_mode == False:
-            # LLM calls are active
+    async def asimple_LLMcall(self, prompt, temperature, goal_code = None):
+        '''
+        async variant of simple_LLMcall(). The blocking llm call runs in a worker thread.
+        :param prompt: string
+        :param temperature: float
+        :param goal_code: string
+        :return: llm response: string
+        '''
+        import asyncio
+        return await asyncio.to_thread(self.simple_LLMcall, prompt, temperature, goal_code)
 
-            # initiate llm
-            llm = OpenAI(openai_api_key=self.API_KEY,
-                         max_tokens=2000,
-                         temperature = temperature)
+    def stream_code(self, prompt, temperature, goal_code = None, cached = True):
+        '''
+        takes input prompt and yields the code-snippet chunk by chunk as it is generated.
+        Closing the generator early stops the generation.
+        :param prompt: string
+        :param temperature: float
+        :param goal_code: string
+        :param cached: bool, False bypasses the response and semantic caches, e.g. for further samples of a prompt
+        :return: generator of code chunks: string
+        '''
+        return self._stream(prompt=prompt, temperature=temperature, goal_code=goal_code, semantic=True, cached=cached)
 
-            # run llm call
-            llm_response = llm(prompt=prompt)
+    def stream_LLMcall(self, prompt, temperature, goal_code = None):
+        '''
+        takes input prompt and yields the llm response chunk by chunk as it is generated.
+        :param prompt: string
+        :param temperature: float
+        :param goal_code: string
+        :return: generator of response chunks: string
+        '''
+        return self._stream(prompt=prompt, temperature=temperature, goal_code=goal_code)
 
-        else:
-            # LLM calls are deactivated. Only dummy code is returned.
-            llm_response = lorem.paragraph()
+    def astream_code(self, prompt, temperature, goal_code = None):
+        '''
+        async iterator variant of stream_code().
+        :param prompt: string
+        :param temperature: float
+        :param goal_code: string
+        :return: async iterator of code chunks: string
+        '''
+        return self._aiterate(self.stream_code(prompt=prompt, temperature=temperature, goal_code=goal_code))
 
-        return llm_response
+    def astream_LLMcall(self, prompt, temperature, goal_code = None):
+        '''
+        async iterator variant of stream_LLMcall().
+        :param prompt: string
+        :param temperature: float
+        :param goal_code: string
+        :return: async iterator of response chunks: string
+        '''
+        return self._aiterate(self.stream_LLMcall(prompt=prompt, temperature=temperature, goal_code=goal_code))
+
+    def _stream(self, prompt, temperature, goal_code = None, semantic = False, cached = True):
+        '''
+        yields the llm response in chunks and records the call metrics, including the time to the first chunk.
+        :param prompt: string
+        :param temperature: float
+        :param goal_code: string
+        :param semantic: bool, look the prompt up in the semantic cache
+        :param cached: bool, use the response and semantic caches
+        :return: generator of response chunks: string
+        '''
+        start = time.perf_counter()
+        first_chunk = None
+        chunks = []
+        cache_hit = []
+        error = None
+        try:
+            for chunk in self._stream_chunks(prompt=prompt, temperature=temperature, cache_hit=cache_hit,
+                                             goal_code=goal_code, semantic=semantic, cached=cached):
+                if first_chunk is None:
+                    first_chunk = time.perf_counter()
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            error = f'{type(e).__name__}: {str(e)}'
+            raise
+        finally:
+            self._record_call(prompt=prompt, response=''.join(chunks), goal_code=goal_code, start=start,
+                              first_chunk=first_chunk, cache_hit=bool(cache_hit), error=error, streamed=True)
+        return
+
+    def _stream_chunks(self, prompt, temperature, cache_hit, goal_code = None, semantic = False, cached = True):
+        '''
+        yields the llm response in chunks. Cached responses are yielded in one chunk, complete streamed responses are
+        written to the cache. Responses of generations that were stopped early are not cached.
+        :param prompt: string
+        :param temperature: float
+        :param cache_hit: list, receives True if the response came from the cache
+        :param goal_code: string, namespace in the semantic cache
+        :param semantic: bool, look the prompt up in the semantic cache
+        :param cached: bool, use the response and semantic caches
+        :return: generator of response chunks: string
+        '''
+
+        if self.test_mode == True:
+            # LLM calls are deactivated. Dummy text is streamed word by word.
+            import lorem
+            for word in lorem.paragraph().split(' '):
+                yield word + ' '
+            return
+
+        cache = self.cache if cached else None
+        if cache is not None:
+            key = LLMResponseCache.make_key(prompt=prompt,
+                                            temperature=temperature,
+                                            model=self.model_name,
+                                            max_tokens=self.max_tokens)
+            cached_response = cache.get(key)
+            if cached_response is not None:
+                cache_hit.append(True)
+                yield cached_response
+                return
+
+        semantic = semantic and cached and self.semantic_cache is not None
+        if semantic:
+            cached_response, _ = self.semantic_cache.lookup(prompt, namespace=goal_code or 'default',
+                                                            model_key=self._model_key(temperature))
+            if cached_response is not None:
+                cache_hit.append(True)
+                yield cached_response
+                return
+
+        # reuse pooled llm client
+        llm = self.client_pool.get(model_name=self.model_name, temperature=temperature)
+
+        chunks = []
+        stream = llm.stream(prompt)
+        try:
+            for response in stream:
+                chunk = response['choices'][0]['text']
+                if chunk:
+                    chunks.append(chunk)
+                    yield chunk
+        finally:
+            # stop receiving tokens if the consumer closed the generator
+            stream.close()
+
+        if cache is not None:
+            cache.set(key, ''.join(chunks))
+        if semantic:
+            self.semantic_cache.set(prompt, ''.join(chunks), namespace=goal_code or 'default',
+                                    model_key=self._model_key(temperature))
+        return
+
+    async def _aiterate(self, generator):
+        '''
+        consumes a blocking generator in a worker thread and re-yields its items on the event loop.
+        Leaving the async iteration early closes the generator.
+        :param generator: generator
+        :return: async iterator
+        '''
+        import asyncio
+        import contextvars
+        import threading
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def put(kind, value):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, (kind, value))
+            except RuntimeError:
+                # event loop is already closed, nobody is listening anymore
+                stop.set()
+
+        def produce():
+            try:
+                for item in generator:
+                    if stop.is_set():
+                        break
+                    put('item', item)
+                put('done', None)
+            except Exception as e:
+                put('error', e)
+            finally:
+                generator.close()
+
+        # the producer runs in the context of the caller, so metrics spans are inherited
+        loop.run_in_executor(None, contextvars.copy_context().run, produce)
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind == 'done':
+                    break
+                if kind == 'error':
+                    raise value
+                yield value
+        finally:
+            # the producer closes the generator before its next chunk
+            stop.set()
+
+    def _model_key(self, temperature):
+        '''
+        model settings a semantic cache hit must share with the request.
+        :param temperature: float
+        :return: str
+        '''
+        return f'{self.model_name}|{self.max_tokens}|{float(temperature)}'
+
+    def _call_llm(self, prompt, temperature, goal_code = None, semantic = False):
+        '''
+        sends the prompt to the llm, or answers it from the response cache if the identical request was made before.
+        With semantic=True a near-duplicate request stored in the semantic cache answers it as well.
+        :param prompt: string
+        :param temperature: float
+        :param goal_code: string, namespace in the semantic cache
+        :param semantic: bool
+        :return: (llm response: string, cache hit: bool)
+        '''
+
+        if self.cache is not None:
+            key = LLMResponseCache.make_key(prompt=prompt,
+                                            temperature=temperature,
+                                            model=self.model_name,
+                                            max_tokens=self.max_tokens)
+            cached_response = self.cache.get(key)
+            if cached_response is not None:
+                return cached_response, True
+
+        semantic = semantic and self.semantic_cache is not None
+        if semantic:
+            cached_response, _ = self.semantic_cache.lookup(prompt, namespace=goal_code or 'default',
+                                                            model_key=self._model_key(temperature))
+            if cached_response is not None:
+                return cached_response, True
+
+        # reuse pooled llm client
+        llm = self.client_pool.get(model_name=self.model_name, temperature=temperature)
+
+        # run llm call
+        llm_response = llm(prompt=prompt)
+
+        if self.cache is not None:
+            self.cache.set(key, llm_response)
+        if semantic:
+            self.semantic_cache.set(prompt, llm_response, namespace=goal_code or 'default',
+                                    model_key=self._model_key(temperature))
 
+        return llm_response, False
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import backtrader as bt
+import numpy as np
+
+"""
+Shared market data cache for backtest runs.
+A CSV feed is parsed once with its own backtrader feed class and stored as one NumPy .npy file per line
+(datetime, open, high, low, close, volume, openinterest). Runs memory-map these files, so concurrent worker processes
+share the same pages instead of re-parsing or copying the data.
+Cache entries are invalidated when the source file changes (mtime and size, confirmed by its sha256 hash).
+"""
+
+DEFAULT_CACHE_DIR = os.path.join('.bt_copilot_cache', 'market_data')
+
+# lines stored for every feed
+LINES = ('datetime', 'open', 'high', 'low', 'close', 'volume', 'openinterest')
+
+# feed classes as shipped by backtrader, unaffected by feeds the backtest runner redirects to the cache
+_SOURCE_FEEDS = {name: feed for name, feed in vars(bt.feeds).items() if isinstance(feed, type)}
+
+
+def file_sha256(path):
+    '''
+    hashes a file in chunks.
+    :param path: str
+    :return: sha256 hex digest: str
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _parse_source(path, source_feed, source_kwargs):
+    '''
+    parses the complete source file with its backtrader feed class.
+    :param path: str
+    :param source_feed: str, name of the feed class in bt.feeds
+    :param source_kwargs: dict
+    :return: arrays: dict mapping line name to numpy array
+    '''
+    feed = _SOURCE_FEEDS.get(source_feed, getattr(bt.feeds, source_feed))(dataname=path, **source_kwargs)
+
+    # feeds need an environment to start, a throwaway cerebro provides it
+    bt.Cerebro().adddata(feed)
+    feed._start()
+    feed.preload()
+    arrays = {line: np.asarray(getattr(feed.lines, line).array, dtype=np.float64) for line in LINES}
+    feed.stop()
+    return arrays
+
+
+class MarketDataCache:
+    """
+    Converts data files into memory-mapped columnar arrays and keeps them up to date with their source.
+    """
+    def __init__(self, cache_dir = DEFAULT_CACHE_DIR):
+        """
+        Constructs a new instance of the market data cache.
+        Args:
+            cache_dir: directory holding one sub directory of .npy files per cached source
+        """
+        self.cache_dir = cache_dir
+
+    def _entry_dir(self, path, source_feed, source_kwargs):
+        '''
+        cache directory of a source file parsed with a specific feed configuration.
+        :return: entry directory: str
+        '''
+        identity = json.dumps({'path': os.path.abspath(path), 'feed': source_feed, 'kwargs': source_kwargs},
+                              sort_keys=True, default=str)
+        digest = hashlib.sha1(identity.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.cache_dir, f'{os.path.basename(path)}-{digest}')
+
+    def _is_valid(self, entry_dir, path):
+        '''
+        checks that a cache entry was built from the current version of the source file.
+        :return: valid: bool
+        '''
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        stat = os.stat(path)
+        if meta['mtime'] == stat.st_mtime and meta['size'] == stat.st_size:
+            return True
+
+        # touched but possibly unchanged file: confirm by content
+        if meta['size'] == stat.st_size and meta['sha256'] == file_sha256(path):
+            meta['mtime'] = stat.st_mtime
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+            return True
+
+        return False
+
+    def _build(self, entry_dir, path, source_feed, source_kwargs):
+        '''
+        parses the source and writes the cache entry. The entry is written to a temporary directory first and then
+        moved into place, so concurrent readers never see a partial entry.
+        :return:
+        '''
+        stat = os.stat(path)
+        arrays = _parse_source(path, source_feed, source_kwargs)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        for line, values in arrays.items():
+            np.save(os.path.join(tmp_dir, f'{line}.npy'), values)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'source': os.path.abspath(path),
+                       'mtime': stat.st_mtime,
+                       'size': stat.st_size,
+                       'sha256': file_sha256(path),
+                       'feed': source_feed,
+                       'kwargs': source_kwargs,
+                       'bars': len(arrays['datetime'])}, f, default=str)
+
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process built the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    def load(self, path, source_feed = 'YahooFinanceCSVData', source_kwargs = None):
+        '''
+        returns the memory-mapped lines of a data file, converting it first if required.
+        :param path: str, source data file
+        :param source_feed: str, name of the backtrader feed class that parses the source
+        :param source_kwargs: dict, parameters of the source feed (without dataname, fromdate and todate)
+        :return: arrays: dict mapping line name to read-only memory-mapped numpy array
+        '''
+        source_kwargs = source_kwargs or {}
+        entry_dir = self._entry_dir(path, source_feed, source_kwargs)
+
+        if not self._is_valid(entry_dir, path):
+            self._build(entry_dir, path, source_feed, source_kwargs)
+
+        return {line: np.load(os.path.join(entry_dir, f'{line}.npy'), mmap_mode='r') for line in LINES}
+
+    def is_cached(self, path, source_feed = 'YahooFinanceCSVData', source_kwargs = None):
+        '''
+        checks whether a data file is cached in its current version.
+        :param path: str
+        :param source_feed: str
+        :param source_kwargs: dict
+        :return: cached: bool
+        '''
+        return self._is_valid(self._entry_dir(path, source_feed, source_kwargs or {}), path)
+
+    def load_derived(self, path, name, derive, source_feed = 'YahooFinanceCSVData', source_kwargs = None):
+        '''
+        returns arrays derived from a cached data file (e.g. resampled bars), computing them on first use only.
+        Derived arrays are stored inside the entry of the source and are discarded when the source changes.
+        :param path: str, source data file
+        :param name: str, identifies the derivation, e.g. resample-W
+        :param derive: function mapping the source arrays to a dict of arrays for every line in LINES
+        :param source_feed: str
+        :param source_kwargs: dict
+        :return: arrays: dict mapping line name to read-only memory-mapped numpy array
+        '''
+        source_kwargs = source_kwargs or {}
+        arrays = self.load(path, source_feed=source_feed, source_kwargs=source_kwargs)
+        entry_dir = self._entry_dir(path, source_feed, source_kwargs)
+        derived_dir = os.path.join(entry_dir, name)
+
+        if not os.path.isdir(derived_dir):
+            derived = derive(arrays)
+            tmp_dir = tempfile.mkdtemp(dir=entry_dir, prefix='.tmp-')
+            for line in LINES:
+                np.save(os.path.join(tmp_dir, f'{line}.npy'), np.asarray(derived[line], dtype=np.float64))
+            try:
+                os.rename(tmp_dir, derived_dir)
+            except OSError:
+                # another process derived the same arrays in the meantime
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return {line: np.load(os.path.join(derived_dir, f'{line}.npy'), mmap_mode='r') for line in LINES}
+
+
+class MemmapData(bt.feed.DataBase):
+    """
+    Backtrader data feed reading from the memory-mapped market data cache.
+    Drop-in replacement for CSV feeds in generated code:
+
+        data = MemmapData(dataname='BTC-USD.csv', fromdate=datetime(2020, 1, 1), todate=datetime(2022, 12, 31))
+
+    The CSV file is parsed with sourcefeed (and sourcekwargs) on first use only.
+    """
+    params = (('cache_dir', DEFAULT_CACHE_DIR),
+              ('sourcefeed', 'YahooFinanceCSVData'),
+              ('sourcekwargs', None),)
+
+    def start(self):
+        super(MemmapData, self).start()
+        cache = MarketDataCache(cache_dir=self.p.cache_dir)
+        self._arrays = cache.load(self.p.dataname,
+                                  source_feed=self.p.sourcefeed,
+                                  source_kwargs=dict(self.p.sourcekwargs or {}))
+        self._idx = None
+
+    def _load(self):
+        if self._idx is None:
+            # skip bars before fromdate without iterating them
+            self._idx = int(np.searchsorted(self._arrays['datetime'], self.fromdate, side='left'))
+
+        if self._idx >= len(self._arrays['datetime']):
+            return False
+
+        i = self._idx
+        for line in LINES:
+            getattr(self.lines, line)[0] = float(self._arrays[line][i])
+        self._idx += 1
+        return True
+
+    def stop(self):
+        super(MemmapData, self).stop()
+        self._arrays = None
+
+
+def memmap_feed_kwargs(feed_spec, feed_cls = None):
+    '''
+    translates a CSV feed spec (see strategy_loader.parse_backtest_spec) into MemmapData keyword arguments.
+    :param feed_spec: dict
+    :param feed_cls: feed class, looked up in bt.feeds by name if not given
+    :return: kwargs: dict, or None if the feed does not read a CSV file
+    '''
+    if feed_cls is None:
+        feed_cls = getattr(bt.feeds, feed_spec['feed'], None)
+    if feed_cls is None or not issubclass(feed_cls, bt.feed.CSVDataBase):
+        return None
+    if not isinstance(feed_spec['kwargs'].get('dataname'), str):
+        return None
+
+    own_params = set(MemmapData.params._getkeys())
+    kwargs = {key: value for key, value in feed_spec['kwargs'].items() if key in own_params}
+    kwargs['sourcefeed'] = feed_spec['feed']
+    kwargs['sourcekwargs'] = {key: value for key, value in feed_spec['kwargs'].items()
+                              if key not in own_params}
+    return kwargs
@@ -0,0 +1,320 @@
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+import backtrader as bt
+import numpy as np
+from data_cache import DEFAULT_CACHE_DIR, LINES, MarketDataCache
+
+"""
+Multi-symbol data pipeline for portfolio backtests.
+Symbol files are parsed in parallel worker processes into the memory-mapped market data cache (data_cache), resampled
+to higher timeframes once (the resampled bars are cached next to the source bars), aligned on a common calendar and
+handed to backtrader as ready feeds in one call. Generated code uses it like this:
+
+    from data_pipeline import add_universe
+    feeds = add_universe(cerebro, 'data/', fromdate=datetime(2020, 1, 1), resample=['W'])
+
+Each symbol gets a feed named after its file (data/BTC-USD.csv -> BTC-USD), resampled feeds are named <symbol>_<rule>.
+"""
+
+# resampling rules: backtrader timeframe and compression of the resampled feed
+TIMEFRAMES = {'D': (bt.TimeFrame.Days, 1),
+              'W': (bt.TimeFrame.Weeks, 1),
+              'M': (bt.TimeFrame.Months, 1),
+              'Q': (bt.TimeFrame.Months, 3),
+              'Y': (bt.TimeFrame.Years, 1)}
+
+# backtrader datetime values are proleptic gregorian ordinals, this one is 1970-01-01
+_EPOCH_ORDINAL = 719163
+
+_DATA_EXTENSIONS = ('.csv', '.txt')
+
+
+def resolve_sources(sources):
+    '''
+    maps symbols to data files.
+    :param sources: directory, glob pattern, list of files or dict mapping symbol to file
+    :return: sources: dict mapping symbol to file, sorted by symbol
+    '''
+    if isinstance(sources, dict):
+        return dict(sorted(sources.items()))
+    if isinstance(sources, str):
+        if os.path.isdir(sources):
+            paths = [os.path.join(sources, name) for name in os.listdir(sources)
+                     if name.lower().endswith(_DATA_EXTENSIONS)]
+        else:
+            paths = glob.glob(sources)
+    else:
+        paths = list(sources)
+    return dict(sorted((os.path.splitext(os.path.basename(path))[0], path) for path in paths))
+
+
+def _period_keys(datetimes, rule):
+    '''
+    period of every bar for a resampling rule.
+    :param datetimes: numpy array of backtrader datetime values
+    :param rule: str, key of TIMEFRAMES
+    :return: integer keys: numpy array, equal for bars of the same period
+    '''
+    days = np.floor(datetimes).astype(np.int64)
+    if rule == 'D':
+        return days
+    if rule == 'W':
+        # ordinal 1 is a monday, weeks run monday to sunday
+        return (days - 1) // 7
+    months = (days - _EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    if rule == 'M':
+        return months
+    if rule == 'Q':
+        return months // 3
+    if rule == 'Y':
+        return months // 12
+    raise ValueError(f"unknown resampling rule {rule}, use one of {', '.join(TIMEFRAMES)}")
+
+
+def resample_arrays(arrays, rule):
+    '''
+    aggregates bars to a higher timeframe: first open, highest high, lowest low, last close, summed volume, last open
+    interest. The resampled bar carries the datetime of the last bar of its period, as with cerebro.resampledata().
+    :param arrays: dict mapping line name to numpy array, sorted by datetime
+    :param rule: str, key of TIMEFRAMES
+    :return: arrays: dict
+    '''
+    datetimes = np.asarray(arrays['datetime'])
+    if len(datetimes) == 0:
+        return {line: np.asarray(arrays[line]) for line in LINES}
+
+    keys = _period_keys(datetimes, rule)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)] - 1
+    return {'datetime': datetimes[ends],
+            'open': np.asarray(arrays['open'])[starts],
+            'high': np.maximum.reduceat(np.asarray(arrays['high']), starts),
+            'low': np.minimum.reduceat(np.asarray(arrays['low']), starts),
+            'close': np.asarray(arrays['close'])[ends],
+            'volume': np.add.reduceat(np.asarray(arrays['volume']), starts),
+            'openinterest': np.asarray(arrays['openinterest'])[ends]}
+
+
+def align_arrays(universe, how = 'union', fill = 'ffill', rule = None):
+    '''
+    puts all symbols on a common calendar.
+    With fill='ffill', bars missing inside the trading history of a symbol repeat the previous close with zero volume;
+    bars before the first and after the last bar of a symbol are NaN and skipped by the feed.
+    Resampled bars carry the datetime of the last source bar of their period, which differs between symbols with
+    different trading calendars (friday for stocks, sunday for crypto). With a rule the symbols are aligned on their
+    periods instead, one bar per period: a symbol keeps its own datetime and filled bars get the latest datetime any
+    symbol has in that period.
+    :param universe: dict mapping symbol to arrays
+    :param how: 'union' (every datetime of any symbol) or 'intersection' (datetimes all symbols have)
+    :param fill: 'ffill' or None (missing bars are NaN)
+    :param rule: resampling rule of the bars (key of TIMEFRAMES) or None to align on the datetimes
+    :return: universe: dict mapping symbol to aligned arrays
+    '''
+    if not universe:
+        return {}
+    keys = {symbol: np.asarray(arrays['datetime']) if rule is None else _period_keys(np.asarray(arrays['datetime']),
+                                                                                       rule)
+            for symbol, arrays in universe.items()}
+    combine = {'union': np.union1d, 'intersection': np.intersect1d}[how]
+    calendar = None
+    for symbol_keys in keys.values():
+        calendar = symbol_keys if calendar is None else combine(calendar, symbol_keys)
+
+    # position of every calendar entry in the bars of each symbol
+    matches = {}
+    period_end = np.full(len(calendar), -np.inf)
+    for symbol, symbol_keys in keys.items():
+        if len(symbol_keys) == 0:
+            continue
+        position = np.minimum(np.searchsorted(symbol_keys, calendar), len(symbol_keys) - 1)
+        exact = symbol_keys[position] == calendar
+        matches[symbol] = position, exact
+        if rule is not None:
+            datetimes = np.asarray(universe[symbol]['datetime'])
+            period_end[exact] = np.maximum(period_end[exact], datetimes[position[exact]])
+
+    aligned = {}
+    for symbol, arrays in universe.items():
+        symbol_keys = keys[symbol]
+        result = {'datetime': calendar}
+        if len(symbol_keys) == 0:
+            if rule is not None:
+                result['datetime'] = period_end
+            result.update({line: np.full(len(calendar), np.nan) for line in LINES[1:]})
+            aligned[symbol] = result
+            continue
+
+        position, exact = matches[symbol]
+        previous = np.searchsorted(symbol_keys, calendar, side='right') - 1
+        gaps = ~exact & (previous >= 0) & (calendar <= symbol_keys[-1]) if fill == 'ffill' else np.zeros_like(exact)
+        if rule is not None:
+            result['datetime'] = np.where(exact, np.asarray(arrays['datetime'])[position], period_end)
+
+        for line in LINES[1:]:
+            values = np.full(len(calendar), np.nan)
+            values[exact] = np.asarray(arrays[line])[position[exact]]
+            if line in ('open', 'high', 'low', 'close'):
+                values[gaps] = np.asarray(arrays['close'])[previous[gaps]]
+            elif line == 'volume':
+                values[gaps] = 0.0
+            else:
+                values[gaps] = np.asarray(arrays[line])[previous[gaps]]
+            result[line] = values
+        aligned[symbol] = result
+    return aligned
+
+
+class ArrayData(bt.feed.DataBase):
+    """
+    Backtrader data feed over prepared arrays (see DataPipeline). Bars with a NaN close are skipped.
+    """
+    params = (('arrays', None),)
+
+    def start(self):
+        super(ArrayData, self).start()
+        self._idx = None
+
+    def _load(self):
+        arrays = self.p.arrays
+        if self._idx is None:
+            # skip bars before fromdate without iterating them
+            self._idx = int(np.searchsorted(arrays['datetime'], self.fromdate, side='left'))
+
+        while self._idx < len(arrays['datetime']) and np.isnan(arrays['close'][self._idx]):
+            self._idx += 1
+        if self._idx >= len(arrays['datetime']):
+            return False
+
+        i = self._idx
+        for line in LINES:
+            getattr(self.lines, line)[0] = float(arrays[line][i])
+        self._idx += 1
+        return True
+
+
+def _cache_symbol(cache_dir, path, source_feed, source_kwargs, rules):
+    '''
+    parses a data file and its resampled versions into the cache. Runs in a worker process.
+    :return: path: str
+    '''
+    cache = MarketDataCache(cache_dir=cache_dir)
+    cache.load(path, source_feed=source_feed, source_kwargs=source_kwargs)
+    for rule in rules:
+        cache.load_derived(path, f'resample-{rule}', lambda arrays, rule=rule: resample_arrays(arrays, rule),
+                           source_feed=source_feed, source_kwargs=source_kwargs)
+    return path
+
+
+class DataPipeline:
+    """
+    Loads a universe of symbol files in parallel into the market data cache and builds aligned backtrader feeds.
+    """
+    def __init__(self, cache_dir = DEFAULT_CACHE_DIR, source_feed = 'YahooFinanceCSVData', source_kwargs = None,
+                 max_workers = None):
+        """
+        Constructs a new data pipeline.
+        Args:
+            cache_dir: market data cache directory
+            source_feed: name of the backtrader feed class that parses the symbol files
+            source_kwargs: parameters of the source feed (without dataname, fromdate and todate)
+            max_workers: processes parsing uncached files, defaults to the number of CPUs
+        """
+        self.cache = MarketDataCache(cache_dir=cache_dir)
+        self.source_feed = source_feed
+        self.source_kwargs = source_kwargs or {}
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+    def prepare(self, sources, rules = ()):
+        '''
+        parses all uncached symbol files (and their resampled versions) into the cache, in parallel.
+        :param sources: see resolve_sources()
+        :param rules: resampling rules, keys of TIMEFRAMES
+        :return: sources: dict mapping symbol to file
+        '''
+        sources = resolve_sources(sources)
+        for rule in rules:
+            if rule not in TIMEFRAMES:
+                raise ValueError(f"unknown resampling rule {rule}, use one of {', '.join(TIMEFRAMES)}")
+
+        pending = [path for path in sources.values()
+                   if not self.cache.is_cached(path, self.source_feed, self.source_kwargs)]
+        jobs = [(self.cache.cache_dir, path, self.source_feed, self.source_kwargs, tuple(rules)) for path in pending]
+        if len(jobs) > 1 and self.max_workers > 1:
+            with ProcessPoolExecutor(max_workers=min(self.max_workers, len(jobs))) as executor:
+                for future in [executor.submit(_cache_symbol, *job) for job in jobs]:
+                    future.result()
+        else:
+            for job in jobs:
+                _cache_symbol(*job)
+        return sources
+
+    def load(self, sources, rule = None):
+        '''
+        memory-maps the bars of every symbol, parsing uncached files first.
+        :param sources: see resolve_sources()
+        :param rule: resampling rule or None for the bars as stored in the files
+        :return: universe: dict mapping symbol to arrays
+        '''
+        sources = self.prepare(sources, rules=[rule] if rule else [])
+        if rule is None:
+            return {symbol: self.cache.load(path, source_feed=self.source_feed, source_kwargs=self.source_kwargs)
+                    for symbol, path in sources.items()}
+        return {symbol: self.cache.load_derived(path, f'resample-{rule}',
+                                                lambda arrays: resample_arrays(arrays, rule),
+                                                source_feed=self.source_feed, source_kwargs=self.source_kwargs)
+                for symbol, path in sources.items()}
+
+    def feeds(self, sources, fromdate = None, todate = None, resample = (), how = 'union', fill = 'ffill'):
+        '''
+        builds aligned backtrader feeds for a universe.
+        :param sources: see resolve_sources()
+        :param fromdate: datetime or None
+        :param todate: datetime or None
+        :param resample: resampling rules, one extra feed per symbol and rule
+        :param how: calendar alignment, see align_arrays(). None keeps every symbol on its own calendar. Resampled
+        feeds are aligned on their periods.
+        :param fill: gap filling, see align_arrays()
+        :return: feeds: dict mapping feed name to ArrayData, source timeframe feeds first
+        '''
+        sources = self.prepare(sources, rules=resample)
+        feed_kwargs = {key: value for key, value in (('fromdate', fromdate), ('todate', todate)) if value is not None}
+
+        feeds = {}
+        for rule in [None] + list(resample):
+            universe = self.load(sources, rule=rule)
+            if how is not None:
+                universe = align_arrays(universe, how=how, fill=fill, rule=rule)
+            kwargs = dict(feed_kwargs)
+            if rule is not None:
+                kwargs['timeframe'], kwargs['compression'] = TIMEFRAMES[rule]
+            for symbol, arrays in universe.items():
+                name = symbol if rule is None else f'{symbol}_{rule}'
+                feeds[name] = ArrayData(arrays=arrays, name=name, **kwargs)
+        return feeds
+
+
+def add_universe(cerebro, sources, fromdate = None, todate = None, resample = (), how = 'union', fill = 'ffill',
+                 source_feed = 'YahooFinanceCSVData', source_kwargs = None, cache_dir = DEFAULT_CACHE_DIR,
+                 max_workers = None):
+    '''
+    adds one aligned feed per symbol (and per resampling rule) to cerebro in one call.
+    :param cerebro: bt.Cerebro
+    :param sources: directory, glob pattern, list of files or dict mapping symbol to file
+    :param fromdate: datetime or None
+    :param todate: datetime or None
+    :param resample: resampling rules, e.g. ['W', 'M'], see TIMEFRAMES
+    :param how: 'union', 'intersection' or None, see align_arrays()
+    :param fill: 'ffill' or None
+    :param source_feed: name of the backtrader feed class that parses the files
+    :param source_kwargs: dict, parameters of the source feed
+    :param cache_dir: str
+    :param max_workers: processes parsing uncached files
+    :return: feeds: dict mapping feed name to feed, in the order they were added
+    '''
+    pipeline = DataPipeline(cache_dir=cache_dir, source_feed=source_feed, source_kwargs=source_kwargs,
+                            max_workers=max_workers)
+    feeds = pipeline.feeds(sources, fromdate=fromdate, todate=todate, resample=resample, how=how, fill=fill)
+    for name, feed in feeds.items():
+        cerebro.adddata(feed, name=name)
+    return feeds
@@ -0,0 +1,78 @@
+import os
+import re
+import subprocess
+import sys
+
+"""
+Import-time budget check for the copilot CLI.
+Runs a fresh interpreter with -X importtime and fails if importing the entry point exceeds the budget,
+so heavy dependencies that creep back into module level imports are caught.
+"""
+
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def measure_import_time(module = 'bt_copilot', python = sys.executable, runs = 3):
+    '''
+    measures the cumulative import time of a module in fresh interpreters. The fastest run is reported to reduce noise.
+    :param module: str
+    :param python: str, interpreter executable
+    :param runs: int
+    :return: measurement: dict with total_ms and the slowest top level imports as (name, cumulative_ms)
+    '''
+    best = None
+    for _ in range(runs):
+        result = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            raise RuntimeError(f'importing {module} failed: {result.stderr.strip().splitlines()[-1]}')
+
+        # -X importtime prints children before their parent, the subtree of the module ends at its own line
+        subtree = []
+        total_ms = None
+        for line in result.stderr.splitlines():
+            match = _IMPORTTIME_LINE.match(line)
+            if not match:
+                continue
+            name, depth, cumulative_ms = match.group(4), len(match.group(3)), int(match.group(2)) / 1000.0
+            if depth == 1:
+                if name == module:
+                    total_ms = cumulative_ms
+                    break
+                subtree = []
+            else:
+                subtree.append((name, depth, cumulative_ms))
+
+        if total_ms is None:
+            # already imported during interpreter startup
+            total_ms = 0.0
+
+        if best is None or total_ms < best['total_ms']:
+            direct_imports = sorted(((name, cumulative_ms) for name, depth, cumulative_ms in subtree if depth == 3),
+                                    key=lambda item: item[1], reverse=True)
+            best = {'module': module, 'total_ms': total_ms, 'top': direct_imports[:10]}
+    return best
+
+
+def check_import_budget(budget_ms, module = 'bt_copilot'):
+    '''
+    prints an import time report and checks it against the budget.
+    :param budget_ms: float
+    :param module: str
+    :return: within budget: bool
+    '''
+    measurement = measure_import_time(module=module)
+    print(f"import {module}: {measurement['total_ms']:.1f} ms (budget {budget_ms:.1f} ms)")
+    for name, cumulative in measurement['top']:
+        print(f"  {cumulative:8.1f} ms  {name}")
+
+    if measurement['total_ms'] > budget_ms:
+        print(f"Import time budget exceeded by {measurement['total_ms'] - budget_ms:.1f} ms")
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 50.0
+    sys.exit(0 if check_import_budget(budget) else 1)
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+"""
+On-disk cache for LLM responses.
+Responses are content-addressed: the key is a hash of the full request (prompt, temperature, model, max_tokens),
+so an identical request is answered from disk instead of the API.
+"""
+
+class LLMResponseCache:
+    """
+    SQLite backed response cache with size- and age-based eviction and hit/miss statistics.
+    A single cache file can be shared by several coding agents.
+    """
+    def __init__(self, path, max_entries = 10000, max_bytes = 100 * 1024 * 1024, max_age_seconds = 30 * 24 * 3600):
+        """
+        Constructs a new instance of the response cache.
+        Args:
+            path: location of the SQLite cache file. Parent directories are created if required.
+            max_entries: maximum number of cached responses. Least recently used entries are evicted first.
+            max_bytes: maximum total size of the cached responses in bytes.
+            max_age_seconds: entries older than this are treated as misses and evicted. None disables expiry.
+        """
+
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+
+        # hit/miss counters of this instance
+        self.hits = 0
+        self.misses = 0
+
+        # sqlite connections are shared between threads of the async api, access is serialised
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                  key TEXT PRIMARY KEY,
+                                  response TEXT NOT NULL,
+                                  size INTEGER NOT NULL,
+                                  created REAL NOT NULL,
+                                  last_access REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(prompt, temperature, model, max_tokens):
+        '''
+        builds the content address of a request.
+        :param prompt: str
+        :param temperature: float
+        :param model: str
+        :param max_tokens: int
+        :return: key: str (sha256 hex digest)
+        '''
+        request = json.dumps({'prompt': prompt,
+                              'temperature': float(temperature),
+                              'model': model,
+                              'max_tokens': max_tokens},
+                             sort_keys=True)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''
+        looks up a cached response.
+        :param key: str
+        :return: response: str, or None on a miss
+        '''
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+
+            if row is not None and self.max_age_seconds is not None and now - row[1] > self.max_age_seconds:
+                # expired entries are removed on access
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._conn.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, response):
+        '''
+        stores a response and applies the eviction policy.
+        :param key: str
+        :param response: str
+        :return:
+        '''
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses (key, response, size, created, last_access) '
+                               'VALUES (?, ?, ?, ?, ?)', (key, response, size, now, now))
+            self._evict(now)
+            self._conn.commit()
+        return
+
+    def _evict(self, now):
+        '''
+        removes expired entries, then least recently used entries until the size limits are met.
+        Must be called with the lock held.
+        :param now: float
+        :return:
+        '''
+        if self.max_age_seconds is not None:
+            self._conn.execute('DELETE FROM responses WHERE created < ?', (now - self.max_age_seconds,))
+
+        entries, total_bytes = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        if entries <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+
+        rows = self._conn.execute('SELECT key, size FROM responses ORDER BY last_access ASC').fetchall()
+        to_delete = []
+        for key, size in rows:
+            if entries <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            entries -= 1
+            total_bytes -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', to_delete)
+        return
+
+    def clear(self):
+        '''
+        removes all cached responses and resets the statistics.
+        :return:
+        '''
+        with self._lock:
+            self._conn.execute('DELETE FROM responses')
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+        return
+
+    def stats(self):
+        '''
+        reports hit/miss statistics and the current size of the cache.
+        :return: stats: dict
+        '''
+        with self._lock:
+            entries, total_bytes = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': entries,
+                'bytes': total_bytes}
+
+    def close(self):
+        '''
+        closes the underlying database connection.
+        :return:
+        '''
+        with self._lock:
+            self._conn.close()
+        return
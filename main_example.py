@@ -1,5 +1,7 @@
 from bt_copilot import BtCopilot
 from coding_agent import SimpleCodingAgent
+from llm_cache import LLMResponseCache
+from metrics import MetricsRegistry
 from dotenv import load_dotenv
 import os
 
@@ -17,9 +19,17 @@ import os
 
 load_dotenv()
 
+# Initialise on-disk response cache. Repeated identical llm requests are answered from disk.
+llm_cache = LLMResponseCache(path = os.path.join('.bt_copilot_cache', 'llm_responses.sqlite'))
+
+# Initialise metrics registry. Latency, tokens and cost of every llm call are recorded and traced to file.
+metrics = MetricsRegistry(trace_path = os.path.join('.bt_copilot_cache', 'trace.jsonl'))
+
 # Initialise coding agent
 coding_agent = SimpleCodingAgent(API_KEY = os.getenv("API_KEY"),
-                                 test_mode = False)
+                                 test_mode = False,
+                                 cache = llm_cache,
+                                 metrics = metrics)
 
 # Initialise copilot client
 copilot = BtCopilot(coding_agent = coding_agent)
@@ -33,13 +43,19 @@ copilot = BtCopilot(coding_agent = coding_agent)
 copilot.load_code('resources/example_backtest.py')
 
 
-# Describe strategy in natural language
-generated_description = copilot.get_strategy_description()
+# Describe strategy in natural language and get feedback on the loaded code.
+# Both llm calls are independent and run concurrently.
+analyses = copilot.analyse_strategy(feedback_basis = 'code', visualise = False)
+# a failed or timed out analysis is returned as its exception
+for name, result in analyses.items():
+    if isinstance(result, BaseException):
+        raise RuntimeError(f'Strategy {name} failed') from result
+generated_description = analyses['description']
 print(generated_description)
 
-# Visualise strategy based on stored backtrader code
-# IMPORTANT: Requires graphviz to be installed on your system
-# copilot.visualise_strategy(vis_basis = 'code')
+# Visualise strategy based on stored backtrader code, built locally without llm call.
+# Rendering the image requires graphviz to be installed on your system, otherwise only the DOT file is written.
+copilot.visualise_strategy(vis_basis = 'code')
 
 copilot.prompt_elements['strategy'] = generated_description
 copilot.visualise_strategy(vis_basis = 'description')
@@ -50,8 +66,8 @@ copilot.visualise_strategy(vis_basis = 'description')
 --------------------------------------------------------------------------
 '''
 
-# Based on loaded backtesting code
-feedback_from_code = copilot.get_strategy_feedback(feedback_basis = 'code')
+# Based on loaded backtesting code (obtained concurrently with the description above)
+feedback_from_code = analyses['feedback']
 print(feedback_from_code)
 
 # Based on natural language description of strategy rules
@@ -95,3 +111,8 @@ copilot.save_code()
 # Execute backtest
 # copilot.run_backtest()
 
+# Report response cache statistics
+print(llm_cache.stats())
+
+# Report latency (p50/p95/p99), token and cost summaries per goal_code and per copilot method
+metrics.report()
@@ -0,0 +1,413 @@
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+from collections import deque
+
+"""
+Latency, token and cost instrumentation.
+The coding agent records every llm call (goal_code, prompt and completion tokens, latency, time to first token,
+cache hit, retry, estimated cost) in a MetricsRegistry. BtCopilot methods are wrapped in spans with trace and parent
+ids in the OpenTelemetry style, llm calls are linked to the span they were made in. Records can be summarised
+(p50/p95/p99), written to a JSONL trace file as they happen and, if the opentelemetry package is installed,
+mirrored as real OpenTelemetry spans.
+"""
+
+# USD per 1000 tokens (prompt, completion)
+MODEL_PRICES_PER_1K = {'text-davinci-003': (0.02, 0.02),
+                       'text-davinci-002': (0.02, 0.02),
+                       'gpt-3.5-turbo-instruct': (0.0015, 0.002),
+                       'gpt-3.5-turbo': (0.0015, 0.002),
+                       'gpt-3.5-turbo-16k': (0.003, 0.004),
+                       'gpt-4': (0.03, 0.06),
+                       'gpt-4-32k': (0.06, 0.12)}
+
+# span the current code runs in, propagated into asyncio tasks and asyncio.to_thread workers
+_current_span = contextvars.ContextVar('bt_copilot_span', default=None)
+
+
+def estimate_cost(model_name, prompt_tokens, completion_tokens):
+    '''
+    estimated price of a call.
+    :param model_name: str
+    :param prompt_tokens: int
+    :param completion_tokens: int
+    :return: cost in USD: float, None for models without a known price
+    '''
+    prices = MODEL_PRICES_PER_1K.get(model_name)
+    if prices is None:
+        return None
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1000.0
+
+
+def percentile(values, q):
+    '''
+    percentile with linear interpolation between closest ranks.
+    :param values: list of float
+    :param q: float between 0 and 100
+    :return: percentile: float, None for an empty list
+    '''
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    rank = (len(values) - 1) * q / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def current_span():
+    '''
+    :return: the active span record: dict or None
+    '''
+    return _current_span.get()
+
+
+class MetricsRegistry:
+    """
+    In-process registry of llm call records and spans.
+    """
+    def __init__(self, max_records = 100000, trace_path = None, opentelemetry = False):
+        """
+        Constructs a new metrics registry.
+        Args:
+            max_records: number of call and span records kept in memory, older records are dropped
+            trace_path: optional JSONL file every record is appended to when it is completed
+            opentelemetry: also emit spans through the opentelemetry api, if the package is installed
+        """
+        self.max_records = max_records
+        self.trace_path = trace_path
+        self.calls = deque(maxlen=max_records)
+        self.spans = deque(maxlen=max_records)
+        self._failed_prompts = set()
+        self._lock = threading.Lock()
+
+        self._tracer = None
+        if opentelemetry:
+            try:
+                from opentelemetry import trace
+                self._tracer = trace.get_tracer('bt_copilot')
+            except ImportError:
+                print("opentelemetry is not installed, spans are only recorded in the registry")
+
+    def _export(self, record):
+        if self.trace_path is None:
+            return
+        import json
+        directory = os.path.dirname(os.path.abspath(self.trace_path))
+        os.makedirs(directory, exist_ok=True)
+        with open(self.trace_path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+        return
+
+    def record_call(self, model_name, prompt, completion, latency, time_to_first_token = None, goal_code = None,
+                    cache_hit = False, error = None, streamed = False, test_mode = False):
+        '''
+        records one llm call.
+        :param model_name: str
+        :param prompt: str
+        :param completion: str, the (partial) response
+        :param latency: seconds from request to complete response
+        :param time_to_first_token: seconds from request to first chunk, the latency for non-streamed calls
+        :param goal_code: str, defaults to the name of the enclosing span
+        :param cache_hit: bool, answered from the response cache
+        :param error: str or None
+        :param streamed: bool
+        :param test_mode: bool, placeholder answer without llm call
+        :return: record: dict
+        '''
+        import hashlib
+        from prompt_compaction import count_tokens
+
+        span = _current_span.get()
+        prompt_sha1 = hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+        prompt_tokens = count_tokens(prompt, model_name)
+        completion_tokens = count_tokens(completion, model_name) if completion else 0
+
+        # cached and placeholder answers cost nothing
+        cost = 0.0 if cache_hit or test_mode else estimate_cost(model_name, prompt_tokens, completion_tokens)
+
+        with self._lock:
+            # a call repeating a failed prompt is a retry
+            retry = prompt_sha1 in self._failed_prompts
+            if error is not None:
+                self._failed_prompts.add(prompt_sha1)
+            else:
+                self._failed_prompts.discard(prompt_sha1)
+
+            record = {'type': 'llm_call',
+                      'timestamp': time.time(),
+                      'goal_code': goal_code or (span['name'] if span else None),
+                      'model': model_name,
+                      'prompt_tokens': prompt_tokens,
+                      'completion_tokens': completion_tokens,
+                      'latency': latency,
+                      'time_to_first_token': time_to_first_token if time_to_first_token is not None else latency,
+                      'cache_hit': cache_hit,
+                      'retry': retry,
+                      'error': error,
+                      'streamed': streamed,
+                      'test_mode': test_mode,
+                      'cost': cost,
+                      'prompt_sha1': prompt_sha1,
+                      'trace_id': span['trace_id'] if span else None,
+                      'span_id': span['span_id'] if span else None}
+            self.calls.append(record)
+            self._export(record)
+        return record
+
+    def start_span(self, name, **attributes):
+        '''
+        starts a span as child of the active span. Use span() unless start and end happen in different places.
+        :param name: str
+        :param attributes: span attributes
+        :return: (span record, context token)
+        '''
+        parent = _current_span.get()
+        record = {'type': 'span',
+                  'name': name,
+                  'trace_id': parent['trace_id'] if parent else os.urandom(16).hex(),
+                  'span_id': os.urandom(8).hex(),
+                  'parent_span_id': parent['span_id'] if parent else None,
+                  'start_time': time.time(),
+                  'end_time': None,
+                  'duration': None,
+                  'status': 'ok',
+                  'error': None,
+                  'attributes': dict(attributes),
+                  '_start': time.perf_counter()}
+        if self._tracer is not None:
+            record['_otel'] = self._tracer.start_span(name, attributes={key: str(value)
+                                                                        for key, value in attributes.items()})
+        return record, _current_span.set(record)
+
+    def end_span(self, record, token, error = None):
+        '''
+        ends a span started with start_span().
+        :param record: span record
+        :param token: context token returned by start_span()
+        :param error: exception or None
+        :return:
+        '''
+        record['duration'] = time.perf_counter() - record.pop('_start')
+        record['end_time'] = record['start_time'] + record['duration']
+        if isinstance(error, GeneratorExit):
+            # consumer stopped a streaming method early
+            record['status'] = 'cancelled'
+        elif error is not None:
+            record['status'] = 'error'
+            record['error'] = f'{type(error).__name__}: {str(error)}'
+
+        otel_span = record.pop('_otel', None)
+        if otel_span is not None:
+            if error is not None and not isinstance(error, GeneratorExit):
+                otel_span.record_exception(error)
+            otel_span.end()
+
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # generators can be finished in another context than they were started in
+            _current_span.set(None)
+
+        with self._lock:
+            self.spans.append(record)
+            self._export(record)
+        return
+
+    def span(self, name, **attributes):
+        '''
+        context manager recording a span.
+
+        Example:
+            with metrics.span('screen_ideas', ideas=200):
+                ...
+
+        :param name: str
+        :param attributes: span attributes
+        :return: context manager yielding the span record
+        '''
+        return _SpanContext(self, name, attributes)
+
+    def summary(self, group_by = 'goal_code'):
+        '''
+        summarises the recorded llm calls.
+        :param group_by: record field the calls are grouped by, None for one group 'all'
+        :return: summary: dict mapping group to dict with count, errors, retries, cache_hit_rate, prompt_tokens,
+        completion_tokens, cost and p50/p95/p99 of latency and time_to_first_token
+        '''
+        with self._lock:
+            calls = list(self.calls)
+
+        groups = {}
+        for call in calls:
+            groups.setdefault(call.get(group_by) if group_by else 'all', []).append(call)
+
+        summary = {}
+        for group, group_calls in groups.items():
+            latencies = [call['latency'] for call in group_calls]
+            ttfts = [call['time_to_first_token'] for call in group_calls]
+            costs = [call['cost'] for call in group_calls if call['cost'] is not None]
+            summary[group] = {'count': len(group_calls),
+                              'errors': sum(call['error'] is not None for call in group_calls),
+                              'retries': sum(call['retry'] for call in group_calls),
+                              'cache_hit_rate': sum(call['cache_hit'] for call in group_calls) / len(group_calls),
+                              'prompt_tokens': sum(call['prompt_tokens'] for call in group_calls),
+                              'completion_tokens': sum(call['completion_tokens'] for call in group_calls),
+                              'cost': sum(costs),
+                              'latency_p50': percentile(latencies, 50),
+                              'latency_p95': percentile(latencies, 95),
+                              'latency_p99': percentile(latencies, 99),
+                              'ttft_p50': percentile(ttfts, 50),
+                              'ttft_p95': percentile(ttfts, 95),
+                              'ttft_p99': percentile(ttfts, 99)}
+        return summary
+
+    def span_summary(self):
+        '''
+        summarises span durations by span name, e.g. to find slow BtCopilot workflows.
+        :return: summary: dict mapping span name to dict with count, errors and p50/p95/p99 duration
+        '''
+        with self._lock:
+            spans = list(self.spans)
+
+        groups = {}
+        for span in spans:
+            groups.setdefault(span['name'], []).append(span)
+        return {name: {'count': len(group),
+                       'errors': sum(span['status'] == 'error' for span in group),
+                       'duration_p50': percentile([span['duration'] for span in group], 50),
+                       'duration_p95': percentile([span['duration'] for span in group], 95),
+                       'duration_p99': percentile([span['duration'] for span in group], 99)}
+                for name, group in groups.items()}
+
+    def report(self):
+        '''
+        prints the call and span summaries.
+        :return:
+        '''
+        for group, stats in self.summary().items():
+            cost = f"${stats['cost']:.4f}"
+            print(f"{group}: {stats['count']} calls, p50/p95/p99 latency "
+                  f"{_ms(stats['latency_p50'])}/{_ms(stats['latency_p95'])}/{_ms(stats['latency_p99'])}, "
+                  f"ttft p50 {_ms(stats['ttft_p50'])}, tokens {stats['prompt_tokens']}+{stats['completion_tokens']}, "
+                  f"cache hits {stats['cache_hit_rate']:.0%}, retries {stats['retries']}, errors {stats['errors']}, "
+                  f"cost {cost}")
+        for name, stats in self.span_summary().items():
+            print(f"span {name}: {stats['count']}x, p50/p95 {_ms(stats['duration_p50'])}/{_ms(stats['duration_p95'])}")
+        return
+
+    def export_jsonl(self, path):
+        '''
+        writes all records in memory to a JSONL file.
+        :param path: str
+        :return: number of records written: int
+        '''
+        import json
+
+        with self._lock:
+            records = list(self.spans) + list(self.calls)
+        records.sort(key=lambda record: record.get('start_time', record.get('timestamp')))
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + '\n')
+        return len(records)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.spans.clear()
+            self._failed_prompts.clear()
+        return
+
+
+def _ms(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.0f}ms'
+
+
+class _SpanContext:
+    def __init__(self, registry, name, attributes):
+        self.registry = registry
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.record, self.token = self.registry.start_span(self.name, **self.attributes)
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.end_span(self.record, self.token, error=exc)
+        return False
+
+
+def traced(function):
+    '''
+    decorator recording a span for every call of a BtCopilot method. The registry is taken from
+    self.coding_agent.metrics, methods run untraced if it is None. Works for plain, async, generator and async
+    generator methods; spans of generators cover the complete iteration.
+    :param function: method
+    :return: wrapped method
+    '''
+    name = function.__name__
+
+    def registry_of(self):
+        return getattr(getattr(self, 'coding_agent', None), 'metrics', None)
+
+    if inspect.isasyncgenfunction(function):
+        @functools.wraps(function)
+        async def wrapper(self, *args, **kwargs):
+            registry = registry_of(self)
+            if registry is None:
+                async for item in function(self, *args, **kwargs):
+                    yield item
+                return
+            record, token = registry.start_span(name)
+            error = None
+            try:
+                async for item in function(self, *args, **kwargs):
+                    yield item
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                registry.end_span(record, token, error=error)
+
+    elif inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(self, *args, **kwargs):
+            registry = registry_of(self)
+            if registry is None:
+                return await function(self, *args, **kwargs)
+            with registry.span(name):
+                return await function(self, *args, **kwargs)
+
+    elif inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            registry = registry_of(self)
+            if registry is None:
+                return (yield from function(self, *args, **kwargs))
+            record, token = registry.start_span(name)
+            error = None
+            try:
+                return (yield from function(self, *args, **kwargs))
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                registry.end_span(record, token, error=error)
+
+    else:
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            registry = registry_of(self)
+            if registry is None:
+                return function(self, *args, **kwargs)
+            with registry.span(name):
+                return function(self, *args, **kwargs)
+
+    return wrapper
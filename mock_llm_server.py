@@ -0,0 +1,182 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+
+"""
+Local mock of the OpenAI completions endpoint.
+Used to measure client pooling, connection reuse and end-to-end performance offline: point the coding agent at
+MockLLMServer.api_base. Latency profiles model the time to first token and the token rate of real endpoints, with
+seeded jitter so benchmark runs are reproducible.
+"""
+
+# time to first token (seconds), generated tokens per second and relative jitter of both
+LATENCY_PROFILES = {'instant': {'ttft': 0.0, 'tokens_per_second': None, 'jitter': 0.0},
+                    'fast': {'ttft': 0.15, 'tokens_per_second': 150.0, 'jitter': 0.1},
+                    'typical': {'ttft': 0.5, 'tokens_per_second': 50.0, 'jitter': 0.2},
+                    'slow': {'ttft': 1.5, 'tokens_per_second': 20.0, 'jitter': 0.3}}
+
+class _CompletionsHandler(BaseHTTPRequestHandler):
+    """
+    Answers POST /v1/completions with a canned completion. Connections are kept alive (HTTP/1.1).
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        if not self.path.rstrip('/').endswith('/completions'):
+            self._send_json(404, {'error': {'message': f'unknown path {self.path}'}})
+            return
+
+        server = self.server
+        with server.lock:
+            server.requests_served += 1
+            request_number = server.requests_served
+
+        prompt = body.get('prompt', '')
+        prompt = prompt[0] if isinstance(prompt, list) and prompt else str(prompt)
+        text = server.responder(prompt) if server.responder is not None else server.response_text
+        first_token_latency, token_latency = server.latencies(request_number)
+
+        if first_token_latency:
+            time.sleep(first_token_latency)
+
+        if body.get('stream'):
+            self._send_stream(text, body, token_latency)
+            return
+
+        # non-streamed responses arrive once all tokens are generated
+        if token_latency:
+            time.sleep(token_latency * len(text.split()))
+
+        response = {'id': f'cmpl-mock-{server.requests_served}',
+                    'object': 'text_completion',
+                    'created': int(time.time()),
+                    'model': body.get('model', 'mock'),
+                    'choices': [{'text': text, 'index': 0, 'logprobs': None, 'finish_reason': 'stop'}],
+                    'usage': {'prompt_tokens': len(str(body.get('prompt', '')).split()),
+                              'completion_tokens': len(text.split()),
+                              'total_tokens': len(str(body.get('prompt', '')).split()) + len(text.split())}}
+        self._send_json(200, response)
+
+    def _send_stream(self, text, body, token_latency):
+        '''
+        streams the completion as server-sent events, one word per event.
+        '''
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        words = text.split(' ')
+        try:
+            for i, word in enumerate(words):
+                if token_latency and word:
+                    time.sleep(token_latency)
+                chunk = {'id': 'cmpl-mock-stream',
+                         'object': 'text_completion',
+                         'created': int(time.time()),
+                         'model': body.get('model', 'mock'),
+                         'choices': [{'text': word if i == 0 else ' ' + word, 'index': 0, 'logprobs': None,
+                                      'finish_reason': 'stop' if i == len(words) - 1 else None}]}
+                self._write_chunk(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            self._write_chunk(b'data: [DONE]\n\n')
+            self._write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            # client stopped the generation early
+            self.close_connection = True
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):X}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # keep benchmark output clean
+        return
+
+
+class MockLLMServer:
+    """
+    Threaded local completions server. Can be used as a context manager.
+    """
+    def __init__(self, response_text = 'mock completion', latency = 0.0, token_latency = 0.0, host = '127.0.0.1',
+                 port = 0, profile = None, responder = None, seed = 0):
+        """
+        Constructs a new instance of the mock server.
+        Args:
+            response_text: completion text returned for every request
+            latency: seconds to wait before answering a request
+            token_latency: seconds to generate each word, streamed or not
+            host: interface to bind to
+            port: port to bind to, 0 picks a free port
+            profile: name of a LATENCY_PROFILES entry or a dict with the same keys. Replaces latency and
+            token_latency. Words are counted as tokens.
+            responder: optional function mapping the prompt to the completion text, replaces response_text
+            seed: seed of the profile jitter, the n-th request always gets the same latencies
+        """
+        self._server = ThreadingHTTPServer((host, port), _CompletionsHandler)
+        self._server.daemon_threads = True
+        self._server.lock = threading.Lock()
+        self._server.requests_served = 0
+        self._server.response_text = response_text
+        self._server.responder = responder
+        self._server.latencies = self._latencies
+        self._thread = None
+
+        self.latency = latency
+        self.token_latency = token_latency
+        self.profile = LATENCY_PROFILES[profile] if isinstance(profile, str) else profile
+        self.seed = seed
+
+    def _latencies(self, request_number):
+        '''
+        latencies of a request.
+        :param request_number: int, position of the request since the server started
+        :return: (seconds to first token, seconds per further token)
+        '''
+        if self.profile is None:
+            return self.latency, self.token_latency
+
+        rng = random.Random(self.seed * 1000003 + request_number)
+        jitter = self.profile.get('jitter', 0.0)
+        first_token_latency = self.profile['ttft'] * (1.0 + rng.uniform(-jitter, jitter))
+        tokens_per_second = self.profile.get('tokens_per_second')
+        if not tokens_per_second:
+            return first_token_latency, 0.0
+        return first_token_latency, (1.0 / tokens_per_second) * (1.0 + rng.uniform(-jitter, jitter))
+
+    @property
+    def api_base(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    @property
+    def requests_served(self):
+        return self._server.requests_served
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        return
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,300 @@
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import backtrader as bt
+import pandas as pd
+import data_cache
+import strategy_loader
+import vector_backtest
+
+"""
+Parameter-sweep optimisation engine for generated backtests.
+The strategy params of a generated backtest are swept over a grid or a random-search space.
+Combinations run across a process pool. CSV feeds are converted once into the memory-mapped market data cache and
+shared by all workers, other feeds are parsed once per worker and reused for all its runs.
+Completed combinations are checkpointed, an interrupted sweep resumes where it stopped.
+Strategies within the subset of vector_backtest can be screened with the vectorized engine instead.
+"""
+
+# analyzers attached to every sweep run, their results are flattened into the result table
+SWEEP_ANALYZERS = (('sharpe', bt.analyzers.SharpeRatio, {}),
+                   ('drawdown', bt.analyzers.DrawDown, {}),
+                   ('returns', bt.analyzers.Returns, {}),
+                   ('trades', bt.analyzers.TradeAnalyzer, {}))
+
+# state of a worker process, set once by _init_worker
+_worker = {}
+
+
+def parameter_grid(grid):
+    '''
+    expands a parameter grid into all combinations.
+    Example: parameter_grid({'pfast': [5, 10], 'pslow': [20, 30]}) returns 4 combinations.
+    :param grid: dict mapping param name to a list of values
+    :return: combinations: list of dict
+    '''
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def random_search(space, n_iter, seed = None):
+    '''
+    draws random parameter combinations from a search space.
+    Each param is either a list of choices or a (low, high) tuple. Integer bounds draw integers, float bounds draw
+    uniformly distributed floats.
+    Example: random_search({'pfast': (5, 20), 'stop_loss': (0.05, 0.2), 'pslow': [30, 50]}, n_iter=100)
+    :param space: dict
+    :param n_iter: int
+    :param seed: int
+    :return: combinations: list of dict, duplicates removed
+    '''
+    rng = random.Random(seed)
+    combinations = []
+    seen = set()
+    for _ in range(n_iter):
+        params = {}
+        for name, values in space.items():
+            if isinstance(values, tuple) and len(values) == 2:
+                low, high = values
+                if isinstance(low, int) and isinstance(high, int):
+                    params[name] = rng.randint(low, high)
+                else:
+                    params[name] = rng.uniform(low, high)
+            else:
+                params[name] = rng.choice(list(values))
+        key = params_key(params)
+        if key not in seen:
+            seen.add(key)
+            combinations.append(params)
+    return combinations
+
+
+def params_key(params):
+    '''
+    canonical identifier of a parameter combination, used for checkpointing.
+    :param params: dict
+    :return: key: str
+    '''
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def flatten_analysis(analyzers):
+    '''
+    flattens the sweep analyzers of a finished strategy into one result row.
+    :param analyzers: strategy.analyzers
+    :return: row: dict
+    '''
+    sharpe = analyzers.sharpe.get_analysis()
+    drawdown = analyzers.drawdown.get_analysis()
+    returns = analyzers.returns.get_analysis()
+    trades = analyzers.trades.get_analysis()
+
+    total = trades.get('total', {})
+    pnl = trades.get('pnl', {}).get('net', {})
+    return {'sharpe': sharpe.get('sharperatio'),
+            'max_drawdown': drawdown.get('max', {}).get('drawdown'),
+            'max_moneydown': drawdown.get('max', {}).get('moneydown'),
+            'total_return': returns.get('rtot'),
+            'annual_return': returns.get('rnorm'),
+            'total_trades': total.get('closed', 0),
+            'won_trades': trades.get('won', {}).get('total', 0),
+            'lost_trades': trades.get('lost', {}).get('total', 0),
+            'pnl_net': pnl.get('total', 0.0)}
+
+
+def _feed_factory(feed_spec, data_dir, cache_dir):
+    '''
+    returns a function creating a fresh data feed for each run without parsing the source again.
+    :param feed_spec: dict
+    :param data_dir: str
+    :param cache_dir: str, market data cache directory
+    :return: factory: callable, keyword arguments such as fromdate/todate replace those of the spec
+    '''
+    kwargs = data_cache.memmap_feed_kwargs(feed_spec)
+    if kwargs is None:
+        bars = strategy_loader.preload_feed(feed_spec, data_dir)
+        return lambda **overrides: bt.feeds.PandasData(dataname=bars, **overrides)
+
+    kwargs['dataname'] = strategy_loader.resolve_data_path(kwargs['dataname'], data_dir)
+    kwargs['cache_dir'] = cache_dir
+    return lambda **overrides: data_cache.MemmapData(**{**kwargs, **overrides})
+
+
+def prepare_feeds(spec, data_dir, cache_dir):
+    '''
+    converts the CSV feeds of a spec into the memory-mapped market data cache before workers start, so they only
+    memory-map the result.
+    :param spec: dict, see strategy_loader.parse_backtest_spec()
+    :param data_dir: str
+    :param cache_dir: str
+    :return:
+    '''
+    cache = data_cache.MarketDataCache(cache_dir=cache_dir)
+    for feed_spec in spec['feeds']:
+        kwargs = data_cache.memmap_feed_kwargs(feed_spec)
+        if kwargs is not None:
+            cache.load(strategy_loader.resolve_data_path(kwargs['dataname'], data_dir),
+                       source_feed=kwargs['sourcefeed'],
+                       source_kwargs=kwargs['sourcekwargs'])
+    return
+
+
+def _init_worker(code, data_dir, cache_dir):
+    '''
+    loads strategy, Cerebro setup and data feeds once per worker process.
+    :param code: str
+    :param data_dir: str
+    :param cache_dir: str
+    :return:
+    '''
+    spec = strategy_loader.parse_backtest_spec(code)
+    _worker['spec'] = spec
+    _worker['strategy'] = strategy_loader.load_strategy_classes(code)[spec['strategy']]
+    _worker['feeds'] = [_feed_factory(feed_spec, data_dir, cache_dir) for feed_spec in spec['feeds']]
+
+
+def _run_combination(params):
+    '''
+    runs one parameter combination in a worker process.
+    :param params: dict
+    :return: row: dict
+    '''
+    spec = _worker['spec']
+
+    cerebro = bt.Cerebro(stdstats=False)
+    for make_feed in _worker['feeds']:
+        cerebro.adddata(make_feed())
+    cerebro.addstrategy(_worker['strategy'], **{**spec['strategy_kwargs'], **params})
+    strategy_loader.configure_cerebro(cerebro, spec, analyzers=False)
+    for name, analyzer, kwargs in SWEEP_ANALYZERS:
+        cerebro.addanalyzer(analyzer, _name=name, **kwargs)
+
+    # generated strategies log every order, keep the worker output quiet
+    with contextlib.redirect_stdout(io.StringIO()):
+        strategy = cerebro.run()[0]
+
+    row = dict(params)
+    row.update(flatten_analysis(strategy.analyzers))
+    row['final_value'] = cerebro.broker.getvalue()
+    return row
+
+
+class ParameterSweep:
+    """
+    Runs a generated strategy over many parameter combinations in parallel and collects the analyzer results
+    in a pandas DataFrame.
+    """
+    def __init__(self, code, data_dir = None, max_workers = None, checkpoint_path = None,
+                 cache_dir = data_cache.DEFAULT_CACHE_DIR, engine = 'backtrader'):
+        """
+        Constructs a new parameter sweep.
+        Args:
+            code: generated backtrader code containing the strategy and the Cerebro setup
+            data_dir: directory in which relative data file names are looked up
+            max_workers: number of worker processes, defaults to all cores
+            checkpoint_path: optional JSONL file. Completed combinations are appended, an interrupted sweep resumes.
+            cache_dir: market data cache directory
+            engine: 'backtrader', 'vectorized' or 'auto' (vectorized if the strategy is supported, else backtrader)
+        """
+        self.code = code
+        self.data_dir = data_dir
+        self.max_workers = max_workers or os.cpu_count()
+        self.checkpoint_path = checkpoint_path
+        self.cache_dir = cache_dir
+
+        # checkpointed results are only reused for the same code
+        self.code_hash = hashlib.sha1(code.encode('utf-8')).hexdigest()[:12]
+
+        self.spec = strategy_loader.parse_backtest_spec(code)
+        if self.spec['strategy'] is None:
+            raise ValueError('no cerebro.addstrategy(...) call found in the code')
+        if not self.spec['feeds']:
+            raise ValueError('no bt.feeds data feed found in the code')
+
+        if engine == 'auto':
+            engine = 'vectorized' if vector_backtest.detect_signal_strategy(code) is not None else 'backtrader'
+        elif engine == 'vectorized' and vector_backtest.detect_signal_strategy(code) is None:
+            raise ValueError('strategy is not supported by the vectorized engine')
+        self.engine = engine
+
+    def _load_checkpoint(self):
+        '''
+        reads the rows of completed combinations from the checkpoint file.
+        :return: rows: dict mapping checkpoint key to row
+        '''
+        rows = {}
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of an interrupted sweep may be incomplete
+                        continue
+                    rows[record['key']] = record['row']
+        return rows
+
+    def _execute(self, pending):
+        '''
+        runs the pending combinations with the selected engine.
+        :param pending: list of (key, params)
+        :return: generator of (key, row) in order of completion
+        '''
+        if self.engine == 'vectorized':
+            # fast enough to run in process, moving averages are shared between combinations
+            engine = vector_backtest.VectorizedBacktest(self.code, data_dir=self.data_dir, cache_dir=self.cache_dir)
+            for key, params in pending:
+                yield key, engine.run(params)
+            return
+
+        with ProcessPoolExecutor(max_workers=min(self.max_workers, len(pending)),
+                                 initializer=_init_worker,
+                                 initargs=(self.code, self.data_dir, self.cache_dir)) as executor:
+            futures = {executor.submit(_run_combination, params): key for key, params in pending}
+            for future in as_completed(futures):
+                try:
+                    row = future.result()
+                except Exception as e:
+                    print(f"Parameter combination failed: {str(e)}")
+                    continue
+                yield futures[future], row
+
+    def run(self, combinations):
+        '''
+        runs all combinations that are not yet in the checkpoint.
+        :param combinations: list of dict, e.g. from parameter_grid() or random_search()
+        :return: results: pandas.DataFrame, one row per combination
+        '''
+        completed = self._load_checkpoint()
+        keys = [f'{self.code_hash}-{self.engine}-{params_key(params)}' for params in combinations]
+        pending = [(key, params) for key, params in zip(keys, combinations) if key not in completed]
+
+        if pending:
+            prepare_feeds(self.spec, self.data_dir, self.cache_dir)
+
+            checkpoint = open(self.checkpoint_path, 'a+') if self.checkpoint_path else None
+            try:
+                if checkpoint is not None and checkpoint.tell() > 0:
+                    checkpoint.seek(checkpoint.tell() - 1)
+                    if checkpoint.read(1) != '\n':
+                        # end the incomplete last line of an interrupted sweep, the next record must not be part of it
+                        checkpoint.write('\n')
+                for key, row in self._execute(pending):
+                    row['engine'] = self.engine
+                    completed[key] = row
+                    if checkpoint is not None:
+                        checkpoint.write(json.dumps({'key': key, 'row': row}, default=str) + '\n')
+                        checkpoint.flush()
+            finally:
+                if checkpoint is not None:
+                    checkpoint.close()
+
+        return pd.DataFrame([completed[key] for key in keys if key in completed])
@@ -0,0 +1,385 @@
+import ast
+import contextvars
+import hashlib
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Token-budget-aware compaction of strategy code before it is sent to the llm.
+Code that fits the prompt budget is sent unchanged.
+Stage 1 strips comments, docstrings and logging with the ast module and keeps only the parts that define the strategy:
+strategy classes with their params, indicators and trading logic, and the Cerebro configuration with the names it
+uses.
+Stage 2, only if the code still exceeds the prompt budget, splits it into chunks that are summarised by the llm
+(map) and joined into one summary (reduce).
+"""
+
+# context window of the completion models (prompt and completion tokens)
+MODEL_CONTEXT_TOKENS = {'text-davinci-003': 4097,
+                        'text-davinci-002': 4097,
+                        'gpt-3.5-turbo-instruct': 4096,
+                        'gpt-3.5-turbo': 4096,
+                        'gpt-3.5-turbo-16k': 16384,
+                        'gpt-4': 8192,
+                        'gpt-4-32k': 32768}
+
+# strategy methods that only report and do not change trading decisions
+REPORTING_METHODS = {'log', 'notify_cashvalue', 'notify_fund', 'notify_store', 'notify_data', 'notify_timer'}
+
+# calls treated as logging statements
+LOGGING_CALLS = {'print', 'log', 'pprint', 'info', 'debug', 'warning', 'plot'}
+
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+def count_tokens(text, model_name = 'text-davinci-003'):
+    '''
+    counts the tokens of a text with the tokenizer of the model. Without tiktoken installed the count is estimated
+    at four characters per token.
+    :param text: str
+    :param model_name: str
+    :return: tokens: int
+    '''
+    encoder = _get_encoder(model_name)
+    if encoder is None:
+        return math.ceil(len(text) / 4)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def tokenizer_name(model_name = 'text-davinci-003'):
+    '''
+    :param model_name: str
+    :return: name of the tokenizer used by count_tokens(): str
+    '''
+    encoder = _get_encoder(model_name)
+    return 'estimate' if encoder is None else encoder.name
+
+
+def _get_encoder(model_name):
+    with _encoders_lock:
+        if model_name not in _encoders:
+            try:
+                import tiktoken
+                try:
+                    _encoders[model_name] = tiktoken.encoding_for_model(model_name)
+                except KeyError:
+                    _encoders[model_name] = tiktoken.get_encoding('cl100k_base')
+            except ImportError:
+                _encoders[model_name] = None
+        return _encoders[model_name]
+
+
+def _call_name(node):
+    '''
+    name of the called function of a call expression, e.g. 'log' for self.log(...).
+    :param node: ast.Call
+    :return: name: str or None
+    '''
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    return None
+
+
+def _is_logging(statement):
+    return (isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Call)
+            and _call_name(statement.value) in LOGGING_CALLS)
+
+
+def _is_docstring(statement):
+    return (isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Constant)
+            and isinstance(statement.value.value, str))
+
+
+def _is_trivial(body):
+    return all(isinstance(statement, ast.Pass) or (isinstance(statement, ast.Return) and statement.value is None)
+               for statement in body)
+
+
+class _Compactor(ast.NodeTransformer):
+    """
+    Removes docstrings, logging statements and reporting methods. Bodies left empty are filled with pass.
+    """
+    def _strip_body(self, body):
+        kept = []
+        for statement in body:
+            if _is_docstring(statement) or _is_logging(statement):
+                continue
+            statement = self.visit(statement)
+            if statement is None:
+                continue
+            kept.append(statement)
+        return kept
+
+    def generic_visit(self, node):
+        for field in ('body', 'orelse', 'finalbody'):
+            body = getattr(node, field, None)
+            if isinstance(body, list) and body and isinstance(body[0], ast.stmt):
+                stripped = self._strip_body(body)
+                setattr(node, field, stripped if stripped or field != 'body' else [ast.Pass()])
+        for field, value in ast.iter_fields(node):
+            if field in ('body', 'orelse', 'finalbody'):
+                continue
+            if isinstance(value, ast.AST):
+                setattr(node, field, self.visit(value))
+        if isinstance(node, ast.Try):
+            node.handlers = [self.visit(handler) for handler in node.handlers]
+        return node
+
+    def visit_FunctionDef(self, node):
+        if node.name in REPORTING_METHODS:
+            return None
+        node = self.generic_visit(node)
+        # notify_order, notify_trade, stop, ... reduced to logging only
+        if node.name != '__init__' and node.name != 'next' and _is_trivial(node.body):
+            return None
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_If(self, node):
+        node = self.generic_visit(node)
+        # branches that only logged, `if ...: return` guards are kept
+        if all(isinstance(statement, ast.Pass) for statement in node.body) and not node.orelse:
+            return None
+        return node
+
+
+def _is_main_guard(statement):
+    return (isinstance(statement, ast.If) and isinstance(statement.test, ast.Compare)
+            and isinstance(statement.test.left, ast.Name) and statement.test.left.id == '__name__')
+
+
+def _uses_name(statement, names):
+    return any(isinstance(node, ast.Name) and node.id in names for node in ast.walk(statement))
+
+
+def _loaded_names(statement):
+    return {node.id for node in ast.walk(statement) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+
+
+def _assigned_names(statement):
+    '''
+    module level names bound by an assignment, including tuple targets.
+    :return: set of str
+    '''
+    if isinstance(statement, ast.Assign):
+        targets = statement.targets
+    elif isinstance(statement, (ast.AnnAssign, ast.AugAssign)):
+        targets = [statement.target]
+    else:
+        return set()
+    return {node.id for target in targets for node in ast.walk(target) if isinstance(node, ast.Name)}
+
+
+def strip_code(code, strategy_only = True):
+    '''
+    removes comments, docstrings, logging statements and reporting methods from python code.
+    With strategy_only=True only imports, class and function definitions, the statements configuring Cerebro and the
+    assignments of the names they use (directly or through other kept assignments) are kept at module level.
+    Code that cannot be parsed is returned unchanged.
+    :param code: str
+    :param strategy_only: bool
+    :return: compacted code: str
+    '''
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code
+
+    # statements under `if __name__ == '__main__':` belong to the module level
+    statements = []
+    for statement in tree.body:
+        if _is_main_guard(statement):
+            statements.extend(statement.body)
+        else:
+            statements.append(statement)
+
+    if strategy_only:
+        # names bound to Cerebro instances and to objects passed to them (feeds, sizers, ...)
+        cerebro_names = {'cerebro'}
+        for statement in statements:
+            if isinstance(statement, ast.Assign) and isinstance(statement.value, ast.Call) \
+                    and _call_name(statement.value) == 'Cerebro':
+                cerebro_names.update(target.id for target in statement.targets if isinstance(target, ast.Name))
+
+        def configures(statement):
+            return _uses_name(statement, cerebro_names) and not _is_logging(statement) \
+                and not isinstance(statement, (ast.For, ast.While, ast.With))
+
+        kept = {index for index, statement in enumerate(statements)
+                if isinstance(statement, (ast.Import, ast.ImportFrom, ast.ClassDef, ast.FunctionDef))
+                or configures(statement) or _assigned_names(statement) & cerebro_names}
+
+        # follow the names used by kept statements to their assignments, e.g. PATH in dataname=PATH and the
+        # constants PATH is built from, until no new assignment is kept
+        loaded = set()
+        pending = set(kept)
+        while pending:
+            for index in pending:
+                loaded |= _loaded_names(statements[index])
+            pending = {index for index, statement in enumerate(statements)
+                       if index not in kept and _assigned_names(statement) & loaded}
+            kept |= pending
+        statements = [statement for index, statement in enumerate(statements) if index in kept]
+
+    tree.body = statements
+    tree = _Compactor().visit(tree)
+    ast.fix_missing_locations(tree)
+    return ast.unparse(tree)
+
+
+def chunk_code(code, max_tokens, model_name = 'text-davinci-003'):
+    '''
+    splits code into chunks of at most max_tokens tokens along top level statements. Statements that are too large
+    on their own are split by lines.
+    :param code: str
+    :param max_tokens: int
+    :param model_name: str
+    :return: chunks: list of str
+    '''
+    try:
+        tree = ast.parse(code)
+        lines = code.splitlines()
+        segments = ['\n'.join(lines[statement.lineno - 1:statement.end_lineno]) for statement in tree.body]
+    except SyntaxError:
+        segments = code.splitlines()
+
+    pieces = []
+    for segment in segments:
+        if count_tokens(segment, model_name) <= max_tokens:
+            pieces.append(segment)
+        else:
+            pieces.extend(segment.splitlines())
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece in pieces:
+        tokens = count_tokens(piece, model_name) + 1
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append('\n'.join(current))
+            current = []
+            current_tokens = 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+class PromptCompactor:
+    """
+    Fits strategy code into the prompt budget of the model.
+    Results are memoised per code, so concurrent analyses of the same code compact it once.
+    """
+    def __init__(self, coding_agent, prompt_library, temperature = 0.0, context_tokens = None, max_workers = 4):
+        """
+        Constructs a new prompt compactor.
+        Args:
+            coding_agent: agent answering the map-reduce summarisation prompts
+            prompt_library: PromptLibrary with the summarise_code_chunk and combine_code_summaries templates
+            temperature: temperature of the summarisation calls
+            context_tokens: context window of the model, looked up in MODEL_CONTEXT_TOKENS if not given
+            max_workers: concurrent summarisation calls
+        """
+        self.coding_agent = coding_agent
+        self.prompt_library = prompt_library
+        self.temperature = temperature
+        self.model_name = getattr(coding_agent, 'model_name', 'text-davinci-003')
+        self.context_tokens = context_tokens or MODEL_CONTEXT_TOKENS.get(self.model_name, 4097)
+        self.max_workers = max_workers
+
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def prompt_budget(self, template_tokens = 0):
+        '''
+        tokens available for the code in a prompt.
+        :param template_tokens: tokens of the prompt template without the code
+        :return: tokens: int
+        '''
+        completion_tokens = getattr(self.coding_agent, 'max_tokens', 0)
+        return self.context_tokens - completion_tokens - template_tokens
+
+    def _summarise(self, code, budget):
+        '''
+        map-reduce summarisation of code that does not fit into the budget.
+        :return: summary: str
+        '''
+        # chunk prompts carry their own template, leave room for it
+        chunk_budget = max(budget, 200) - count_tokens(self.prompt_library.template('summarise_code_chunk'),
+                                                       self.model_name)
+        chunks = chunk_code(code, max_tokens=max(chunk_budget, 100), model_name=self.model_name)
+
+        def summarise(chunk):
+            prompt = self.prompt_library.format('summarise_code_chunk', user_input=chunk)
+            return self.coding_agent.simple_LLMcall(prompt=prompt, temperature=self.temperature,
+                                                   goal_code='summarise_code_chunk')
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, summarise, chunk) for chunk in chunks]
+            summaries = [future.result() for future in futures]
+
+        combined = '\n'.join(summaries)
+        if count_tokens(combined, self.model_name) > budget and len(chunks) > 1:
+            prompt = self.prompt_library.format('combine_code_summaries', user_input=combined)
+            combined = self.coding_agent.simple_LLMcall(prompt=prompt, temperature=self.temperature,
+                                                        goal_code='combine_code_summaries')
+        return combined
+
+    def compact(self, code, template_tokens = 0, strategy_only = True):
+        '''
+        compacts code to fit the prompt budget. Code that fits is returned unchanged.
+        :param code: str
+        :param template_tokens: tokens of the prompt template the code is inserted into
+        :param strategy_only: bool, see strip_code()
+        :return: (compacted code, report): report is a dict with the keys tokens_before, tokens_after, budget, stage
+        (unchanged, stripped or map_reduce), chunks and tokenizer
+        '''
+        budget = self.prompt_budget(template_tokens)
+        key = (hashlib.sha1(code.encode('utf-8')).hexdigest(), strategy_only)
+        with self._lock:
+            # a result compacted for another template is reused if it fits this budget as well
+            if key in self._memo and self._memo[key][1]['tokens_after'] <= budget:
+                return self._memo[key]
+
+        tokens_before = count_tokens(code, self.model_name)
+        compacted = code
+        stage = 'unchanged'
+        chunks = 0
+        # code that fits is sent as written
+        if tokens_before > budget:
+            compacted = strip_code(code, strategy_only=strategy_only)
+            stage = 'stripped'
+        if count_tokens(compacted, self.model_name) > budget:
+            chunks = len(chunk_code(compacted, max_tokens=max(budget, 100), model_name=self.model_name))
+            compacted = self._summarise(compacted, budget)
+            stage = 'map_reduce'
+
+        report = {'tokens_before': tokens_before,
+                  'tokens_after': count_tokens(compacted, self.model_name),
+                  'budget': budget,
+                  'stage': stage,
+                  'chunks': chunks,
+                  'tokenizer': tokenizer_name(self.model_name)}
+        with self._lock:
+            self._memo[key] = (compacted, report)
+        return compacted, report
+
+
+def format_report(report):
+    '''
+    one line summary of a compaction report.
+    :param report: dict, see PromptCompactor.compact()
+    :return: str
+    '''
+    before, after = report['tokens_before'], report['tokens_after']
+    saved = 100.0 * (before - after) / before if before else 0.0
+    text = f"Prompt compaction: {before} -> {after} tokens ({saved:.0f}% saved, {report['stage']}"
+    if report['chunks']:
+        text += f", {report['chunks']} chunks"
+    return text + f", budget {report['budget']}, tokenizer {report['tokenizer']})"
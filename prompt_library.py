@@ -0,0 +1,176 @@
+import csv
+import os
+import string
+
+"""
+Indexed prompt library.
+The prompt library CSV (goal_code, prompt) is loaded once into a dict of precompiled PromptTemplate objects.
+The library is validated at load time and reloaded automatically when the CSV file changes.
+"""
+
+# goal codes used by bt_copilot and the input variables their templates must use
+REQUIRED_TEMPLATES = {'get_strategy_description': {'user_input'},
+                      'get_strategy_feedback_from_code': {'user_input'},
+                      'get_strategy_feedback_from_description': {'user_input'},
+                      'get_strategy_visualisation_from_code': {'user_input'},
+                      'get_strategy_visualisation_from_description': {'user_input'},
+                      'submission_prompt_template': {'context', 'combined_prompt'},
+                      'coding_context': set(),
+                      'set_datapipeline': {'user_input'},
+                      'set_datapipeline_universe': {'user_input'},
+                      'set_strategy': {'user_input'},
+                      'set_analysers': {'user_input'},
+                      'summarise_code_chunk': {'user_input'},
+                      'combine_code_summaries': {'user_input'},
+                      'get_component_description': {'component', 'user_input'},
+                      'get_component_feedback': {'component', 'user_input'},
+                      'fix_code': {'errors', 'user_input'},
+                      'optimise_code_speed': {'profile', 'user_input'}}
+
+
+class PromptLibraryError(ValueError):
+    """
+    Raised when the prompt library file is missing goal codes or contains invalid templates.
+    """
+
+
+def template_variables(template):
+    '''
+    extracts the input variables of a python format string template.
+    :param template: str
+    :return: variables: set of str
+    '''
+    return {field for _, field, _, _ in string.Formatter().parse(template) if field}
+
+
+class PromptLibrary:
+    """
+    Prompt templates indexed by goal_code.
+    """
+    def __init__(self, path, required_templates = REQUIRED_TEMPLATES, auto_reload = True):
+        """
+        Loads and validates the prompt library.
+        Args:
+            path: prompt library CSV file with the columns goal_code and prompt
+            required_templates: dict mapping required goal codes to the input variables of their template
+            auto_reload: reload the library when the file changes
+        """
+        self.path = path
+        self.required_templates = required_templates
+        self.auto_reload = auto_reload
+
+        self.templates = {}
+        self._compiled = {}
+        self._mtime = None
+        self.load()
+
+    def load(self):
+        '''
+        reads, validates and compiles the prompt library file.
+        Raises FileNotFoundError if the file does not exist and PromptLibraryError if it is invalid.
+        :return:
+        '''
+        mtime = os.stat(self.path).st_mtime
+        templates = {}
+        problems = []
+
+        with open(self.path, newline='') as f:
+            for line_number, row in enumerate(csv.DictReader(f), start=2):
+                goal_code = (row.get('goal_code') or '').strip()
+                prompt = row.get('prompt') or ''
+                if not goal_code and not prompt.strip():
+                    # empty rows are allowed
+                    continue
+                if not goal_code:
+                    problems.append(f'line {line_number}: prompt without goal_code')
+                    continue
+                if goal_code in templates:
+                    problems.append(f'line {line_number}: duplicate goal_code {goal_code}')
+                    continue
+                templates[goal_code] = prompt
+
+        for goal_code, variables in self.required_templates.items():
+            if goal_code not in templates:
+                problems.append(f'missing goal_code {goal_code}')
+                continue
+            try:
+                found = template_variables(templates[goal_code])
+            except ValueError as e:
+                problems.append(f'{goal_code}: invalid template ({str(e)})')
+                continue
+            if found != set(variables):
+                problems.append(f'{goal_code}: template uses {sorted(found)}, expected {sorted(variables)}')
+
+        if problems:
+            raise PromptLibraryError(f'invalid prompt library {self.path}: ' + '; '.join(problems))
+
+        from langchain.prompts import PromptTemplate
+
+        compiled = {}
+        for goal_code, prompt in templates.items():
+            try:
+                compiled[goal_code] = PromptTemplate(input_variables=sorted(template_variables(prompt)),
+                                                     template=prompt)
+            except ValueError as e:
+                raise PromptLibraryError(f'invalid prompt library {self.path}: {goal_code}: {str(e)}')
+
+        self.templates = templates
+        self._compiled = compiled
+        self._mtime = mtime
+        return
+
+    def _reload_if_changed(self):
+        '''
+        reloads the library if the file was modified. An invalid new version is reported and the previous one kept.
+        :return:
+        '''
+        if not self.auto_reload:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime != self._mtime:
+            try:
+                self.load()
+            except PromptLibraryError as e:
+                print(f"Prompt library not reloaded: {str(e)}")
+                self._mtime = mtime
+        return
+
+    def get(self, goal_code):
+        '''
+        returns the precompiled template of a goal code.
+        :param goal_code: str
+        :return: template: PromptTemplate
+        '''
+        self._reload_if_changed()
+        try:
+            return self._compiled[goal_code]
+        except KeyError:
+            raise KeyError(f'goal_code {goal_code} not found in prompt library {self.path}')
+
+    def template(self, goal_code):
+        '''
+        returns the raw template string of a goal code.
+        :param goal_code: str
+        :return: template: str
+        '''
+        return self.get(goal_code).template
+
+    def format(self, goal_code, **kwargs):
+        '''
+        fills the template of a goal code.
+        :param goal_code: str
+        :param kwargs: input variables
+        :return: prompt: str
+        '''
+        return self.get(goal_code).format(**kwargs)
+
+    def __contains__(self, goal_code):
+        self._reload_if_changed()
+        return goal_code in self._compiled
+
+    def goal_codes(self):
+        self._reload_if_changed()
+        return list(self._compiled.keys())
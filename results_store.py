@@ -0,0 +1,323 @@
+import ast
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+"""
+Store of backtest results with indexed querying.
+Every run is recorded with the hash of its code, its params, a fingerprint of its data files and the metrics of
+optimiser.flatten_analysis(), so single runs and sweep rows are directly comparable. The full result (analyzer output,
+equity curve, trade list, stdout) is kept compressed in a separate table and only read for a single run.
+A run is identified by its run key, the hash of code, params, data fingerprint and engine: an identical combination is
+answered from the store instead of running the backtest again.
+"""
+
+# metric columns of the runs table: the keys of optimiser.flatten_analysis() plus final value and runtime
+METRICS = ('sharpe', 'max_drawdown', 'max_moneydown', 'total_return', 'annual_return', 'total_trades', 'won_trades',
+           'lost_trades', 'pnl_net', 'final_value', 'runtime')
+
+# columns that queries can filter and sort on
+COLUMNS = METRICS + ('id', 'run_key', 'code_sha', 'data_fingerprint', 'project', 'engine', 'created')
+
+_OPERATORS = {'<': '<', '<=': '<=', '>': '>', '>=': '>=', '=': '=', '==': '=', '!=': '!='}
+
+# indexed sort keys, every index ends with the key so top-n queries read it in order and stop early
+_INDEXED = ('sharpe', 'max_drawdown', 'total_return', 'annual_return', 'pnl_net', 'final_value', 'created')
+
+
+def code_sha(code):
+    '''
+    hash of the backtest code.
+    :param code: str
+    :return: str (sha256 hex digest)
+    '''
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def run_key(code, params, data_fingerprint, engine = 'backtrader'):
+    '''
+    identifier of a run: identical code, params, data and engine give the same result.
+    :param code: str
+    :param params: dict, strategy params set outside of the code, e.g. by a sweep
+    :param data_fingerprint: str, see ResultsStore.data_fingerprint()
+    :param engine: str
+    :return: key: str (sha256 hex digest)
+    '''
+    run = json.dumps({'code': code_sha(code),
+                      'params': params,
+                      'data': data_fingerprint,
+                      'engine': engine},
+                     sort_keys=True, default=str)
+    return hashlib.sha256(run.encode('utf-8')).hexdigest()
+
+
+def _expand(path):
+    '''
+    files behind a data path: the file itself, all files of a directory or the matches of a glob pattern.
+    :param path: str
+    :return: files: list of str, empty if nothing exists
+    '''
+    if os.path.isfile(path):
+        return [path]
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if os.path.isfile(os.path.join(path, name)))
+    return sorted(match for match in glob.glob(path) if os.path.isfile(match))
+
+
+class ResultsStore:
+    """
+    SQLite backed store of backtest runs. One row per run with indexed metric columns, details stored compressed.
+    A single store file can be shared by several copilots.
+    """
+    def __init__(self, path):
+        """
+        Constructs a new results store.
+        Args:
+            path: location of the SQLite file. Parent directories are created if required.
+        """
+        self.path = path
+
+        # sqlite connection is shared between threads, access is serialised
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(f'''CREATE TABLE IF NOT EXISTS runs (
+                                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                   run_key TEXT NOT NULL UNIQUE,
+                                   code_sha TEXT NOT NULL,
+                                   params TEXT NOT NULL,
+                                   data_fingerprint TEXT,
+                                   engine TEXT NOT NULL,
+                                   project TEXT,
+                                   created REAL NOT NULL,
+                                   ok INTEGER NOT NULL,
+                                   {', '.join(f'{metric} REAL' for metric in METRICS)})''')
+        # full results, only written for runs with details
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS run_details (
+                                  run_key TEXT PRIMARY KEY,
+                                  result BLOB NOT NULL)''')
+        # content hashes of data files, recomputed when size or modification time change
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS file_hashes (
+                                  path TEXT PRIMARY KEY,
+                                  size INTEGER NOT NULL,
+                                  mtime REAL NOT NULL,
+                                  sha TEXT NOT NULL)''')
+        for column in _INDEXED:
+            self._conn.execute(f'CREATE INDEX IF NOT EXISTS idx_runs_{column} ON runs (ok, {column})')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_runs_code_sha ON runs (code_sha, sharpe)')
+        self._conn.commit()
+
+    def _file_hash(self, path):
+        '''
+        content hash of a file, memoised by size and modification time.
+        Must be called with the lock held.
+        :param path: str, absolute path
+        :return: sha: str
+        '''
+        stat = os.stat(path)
+        row = self._conn.execute('SELECT size, mtime, sha FROM file_hashes WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return row[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        sha = sha.hexdigest()
+        self._conn.execute('INSERT OR REPLACE INTO file_hashes (path, size, mtime, sha) VALUES (?, ?, ?, ?)',
+                           (path, stat.st_size, stat.st_mtime, sha))
+        self._conn.commit()
+        return sha
+
+    def data_fingerprint(self, code, cwd = None):
+        '''
+        fingerprint of the data files referenced by the code, see code_validation.data_files().
+        :param code: str
+        :param cwd: str, directory relative paths are resolved in, defaults to the current directory
+        :return: fingerprint: str, or None if the code cannot be parsed, references no data file or a file is missing.
+        Runs without a fingerprint are recorded but never reused.
+        '''
+        from code_validation import data_files
+
+        cwd = cwd or os.getcwd()
+        try:
+            tree = ast.parse(code)
+        except (SyntaxError, ValueError):
+            return None
+
+        files = []
+        for path, _ in data_files(tree):
+            expanded = _expand(os.path.join(cwd, path))
+            if not expanded:
+                return None
+            files.extend(expanded)
+        if not files:
+            return None
+
+        with self._lock:
+            hashes = [self._file_hash(os.path.abspath(path)) for path in files]
+        return hashlib.sha256('\n'.join(hashes).encode('utf-8')).hexdigest()
+
+    def record(self, code, params, data_fingerprint, metrics, result = None, engine = 'backtrader', project = None):
+        '''
+        records a run, replacing an earlier run with the same run key.
+        :param code: str
+        :param params: dict
+        :param data_fingerprint: str or None
+        :param metrics: dict with keys of METRICS, missing metrics are stored as NULL
+        :param result: optional full result dict of BacktestRunner.run(), returned by get()
+        :param engine: str
+        :param project: str
+        :return: key: str, see run_key()
+        '''
+        return self.record_many([{'code': code, 'params': params, 'data_fingerprint': data_fingerprint,
+                                  'metrics': metrics, 'result': result, 'engine': engine, 'project': project}])[0]
+
+    def record_many(self, runs):
+        '''
+        records many runs in one transaction, e.g. the rows of a parameter sweep.
+        :param runs: list of dict with the arguments of record()
+        :return: keys: list of str
+        '''
+        now = time.time()
+        rows = []
+        details = []
+        keys = []
+        for run in runs:
+            engine = run.get('engine') or 'backtrader'
+            params = run.get('params') or {}
+            key = run_key(run['code'], params, run['data_fingerprint'], engine)
+            result = run.get('result')
+            metrics = run['metrics']
+            rows.append((key, code_sha(run['code']), json.dumps(params, sort_keys=True, default=str),
+                         run['data_fingerprint'], engine, run.get('project'), now,
+                         int(result['ok']) if result is not None else 1,
+                         *(metrics.get(metric) for metric in METRICS)))
+            if result is not None:
+                details.append((key, zlib.compress(json.dumps(result, default=str).encode('utf-8'))))
+            keys.append(key)
+
+        columns = ('run_key', 'code_sha', 'params', 'data_fingerprint', 'engine', 'project', 'created', 'ok') + METRICS
+        with self._lock:
+            self._conn.executemany(f"INSERT OR REPLACE INTO runs ({', '.join(columns)}) "
+                                   f"VALUES ({', '.join('?' * len(columns))})", rows)
+            self._conn.executemany('INSERT OR REPLACE INTO run_details (run_key, result) VALUES (?, ?)', details)
+            self._conn.commit()
+            self._analyse()
+        return keys
+
+    def _analyse(self):
+        '''
+        refreshes the table statistics once the store has doubled in size since the last analysis. Without them sqlite
+        filters with an index and sorts afterwards, instead of reading the index of the sort key in order and stopping
+        after the limit: 50 ms instead of 0.1 ms for a top-50 query on 100000 runs.
+        Must be called with the lock held.
+        :return:
+        '''
+        rows = self._conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+        analysed = 0
+        if self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+            stat = self._conn.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = 'runs' LIMIT 1").fetchone()
+            analysed = int(stat[0].split()[0]) if stat else 0
+        if rows >= 1000 and rows > 2 * analysed:
+            self._conn.execute('ANALYZE runs')
+            self._conn.commit()
+        return
+
+    def get(self, key):
+        '''
+        looks up a successful run.
+        :param key: str, see run_key()
+        :return: result: the full result dict if it was recorded, else the row as returned by query(). None if the run
+        is not in the store.
+        '''
+        with self._lock:
+            row = self._conn.execute('SELECT result FROM run_details JOIN runs USING (run_key) '
+                                     'WHERE run_key = ? AND ok = 1', (key,)).fetchone()
+        if row is not None:
+            return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+        rows = self.query(where=[('run_key', '=', key)], order_by=None, limit=1)
+        return rows[0] if rows else None
+
+    def query(self, where = (), order_by = 'sharpe', descending = True, limit = 50):
+        '''
+        selects successful runs by their metrics.
+
+        Example, top 50 by Sharpe ratio with a maximum drawdown below 20%:
+            store.query(where=[('max_drawdown', '<', 20)], order_by='sharpe', limit=50)
+
+        :param where: list of (column, operator, value), combined with AND. Operators: < <= > >= = !=
+        :param order_by: column of COLUMNS or None. Runs without a value in this column are left out.
+        :param descending: bool
+        :param limit: int or None
+        :return: rows: list of dict with the keys of COLUMNS and params
+        '''
+        conditions = ['ok = 1']
+        values = []
+        for column, operator, value in where:
+            if column not in COLUMNS:
+                raise ValueError(f'unknown column {column}, expected one of {", ".join(COLUMNS)}')
+            if operator not in _OPERATORS:
+                raise ValueError(f'unknown operator {operator}, expected one of {" ".join(_OPERATORS)}')
+            conditions.append(f'{column} {_OPERATORS[operator]} ?')
+            values.append(value)
+
+        order = ''
+        if order_by is not None:
+            if order_by not in COLUMNS:
+                raise ValueError(f'unknown column {order_by}, expected one of {", ".join(COLUMNS)}')
+            conditions.append(f'{order_by} IS NOT NULL')
+            order = f" ORDER BY {order_by} {'DESC' if descending else 'ASC'}"
+        if limit is not None:
+            order += ' LIMIT ?'
+            values.append(int(limit))
+
+        columns = COLUMNS + ('params',)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {', '.join(columns)} FROM runs WHERE {' AND '.join(conditions)}{order}",
+                                      values).fetchall()
+        results = []
+        for row in rows:
+            result = dict(zip(columns, row))
+            result['params'] = json.loads(result['params'])
+            results.append(result)
+        return results
+
+    def count(self):
+        '''
+        number of recorded runs.
+        :return: int
+        '''
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+
+    def clear(self):
+        '''
+        removes all recorded runs.
+        :return:
+        '''
+        with self._lock:
+            self._conn.execute('DELETE FROM runs')
+            self._conn.execute('DELETE FROM run_details')
+            self._conn.commit()
+        return
+
+    def close(self):
+        '''
+        closes the underlying database connection.
+        :return:
+        '''
+        with self._lock:
+            self._conn.close()
+        return
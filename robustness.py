@@ -0,0 +1,271 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+"""
+Monte Carlo robustness analysis of a completed backtest.
+Three kinds of simulations are run on the recorded equity curve and trade list:
+    bootstrap   bar returns resampled with replacement (in blocks to keep short-term autocorrelation)
+    reshuffle   the order of the closed trades permuted, the same trades in a different sequence
+    perturb     gaussian noise added to every bar return
+Every simulation yields a final PnL, a maximum drawdown and a Sharpe ratio, reported as confidence intervals next to
+the observed values. Simulations run as batched numpy array operations on chunks of rows sized to a memory budget, so
+100000 simulations of several years of daily bars take seconds. Chunks can be spread across a process pool; every
+chunk draws from its own seed, so results do not depend on the number of workers.
+"""
+
+METHODS = ('bootstrap', 'reshuffle', 'perturb')
+
+# bytes per simulated bar of a chunk: float32 returns and int32 resampling indices, see _simulate_chunk()
+_BYTES_PER_BAR = 8
+
+
+def _annualisation(datetimes, count):
+    '''
+    periods per year of a series of count returns between the first and last datetime.
+    :param datetimes: sequence of datetime or None
+    :param count: int
+    :return: float, 252 if the span is unknown
+    '''
+    if datetimes is None or len(datetimes) < 2:
+        return 252.0
+    years = (datetimes[-1] - datetimes[0]).total_seconds() / (365.25 * 24 * 3600)
+    return count / years if years > 0 else 252.0
+
+
+def _sharpe(total, squares, count, periods_per_year):
+    '''
+    annualised Sharpe ratio from the sum and the sum of squares of count returns, nan without variance.
+    '''
+    mean = total / count
+    variance = (squares - total * mean) / (count - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(variance > 0, mean / np.sqrt(variance) * math.sqrt(periods_per_year), np.nan)
+
+
+def _bar_statistics(returns, start_value, periods_per_year):
+    '''
+    final PnL, max drawdown and Sharpe ratio of every column of a matrix of bar returns.
+    The bars are walked once with the equity, peak and drawdown of all simulations as vectors, which is several times
+    faster than cumulative products and maxima over the whole matrix.
+    :param returns: numpy array (bars, simulations) of simple returns
+    :param start_value: float
+    :param periods_per_year: float
+    :return: (final_pnl, max_drawdown in percent, sharpe): numpy arrays (simulations,)
+    '''
+    total = returns.sum(axis=0, dtype=np.float64)
+    squares = np.einsum('ij,ij->j', returns, returns, dtype=np.float64)
+    sharpe = _sharpe(total, squares, len(returns), periods_per_year)
+
+    # equity relative to the start value
+    equity = np.ones(returns.shape[1])
+    peak = np.ones(returns.shape[1])
+    trough = np.ones(returns.shape[1])
+    ratio = np.empty(returns.shape[1])
+    for bar in returns:
+        equity += equity * bar
+        np.maximum(peak, equity, out=peak)
+        np.divide(equity, peak, out=ratio)
+        np.minimum(trough, ratio, out=trough)
+    return (equity - 1.0) * start_value, (1.0 - trough) * 100, sharpe
+
+
+def _trade_statistics(pnl, start_value, periods_per_year):
+    '''
+    final PnL, max drawdown and Sharpe ratio of every row of a matrix of trade PnLs in trading order.
+    :param pnl: numpy array (simulations, trades)
+    :param start_value: float
+    :param periods_per_year: float, trades per year
+    :return: (final_pnl, max_drawdown in percent, sharpe): numpy arrays (simulations,)
+    '''
+    equity = start_value + np.cumsum(pnl, axis=1)
+    before = equity - pnl
+    returns = pnl / before
+    sharpe = _sharpe(returns.sum(axis=1), (returns * returns).sum(axis=1), pnl.shape[1], periods_per_year)
+
+    peak = np.maximum(np.maximum.accumulate(equity, axis=1), start_value)
+    max_drawdown = ((peak - equity) / peak).max(axis=1) * 100
+    return equity[:, -1] - start_value, max_drawdown, sharpe
+
+
+def _simulate_chunk(method, data, rows, seed, options):
+    '''
+    runs one chunk of simulations, in process or in a worker.
+    :param method: str, see METHODS
+    :param data: numpy array, bar returns (bootstrap, perturb) or trade PnLs (reshuffle)
+    :param rows: int, number of simulations
+    :param seed: numpy.random.SeedSequence
+    :param options: dict with keys start_value, periods_per_year, block_size, noise
+    :return: (final_pnl, max_drawdown, sharpe): numpy arrays (rows,)
+    '''
+    rng = np.random.default_rng(seed)
+    n = len(data)
+
+    if method == 'reshuffle':
+        orders = rng.permuted(np.broadcast_to(data, (rows, n)), axis=1)
+        return _trade_statistics(orders, options['start_value'], options['periods_per_year'])
+
+    # one simulation per column, float32 halves the memory traffic and is exact enough for percentiles
+    data = data.astype(np.float32)
+    if method == 'bootstrap':
+        block = max(1, min(options['block_size'], n))
+        if block == 1:
+            returns = data[rng.integers(0, n, size=(n, rows), dtype=np.int32)]
+        else:
+            starts = rng.integers(0, n - block + 1, size=(-(-n // block), 1, rows), dtype=np.int32)
+            returns = data[(starts + np.arange(block, dtype=np.int32)[:, None]).reshape(-1, rows)[:n]]
+    elif method == 'perturb':
+        returns = rng.standard_normal((n, rows), dtype=np.float32)
+        returns *= options['noise'] * data.std()
+        returns += data[:, None]
+        # a bar cannot lose more than everything
+        np.maximum(returns, -1.0, out=returns)
+    else:
+        raise ValueError(f'unknown simulation method {method}, expected one of {", ".join(METHODS)}')
+    return _bar_statistics(returns, options['start_value'], options['periods_per_year'])
+
+
+def _summary(values, observed, confidence):
+    '''
+    confidence interval and moments of a simulated metric.
+    :param values: numpy array
+    :param observed: float or None, value of the actual backtest
+    :param confidence: float, e.g. 0.95
+    :return: dict with keys observed, mean, std, lower, median, upper
+    '''
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return {'observed': observed, 'mean': None, 'std': None, 'lower': None, 'median': None, 'upper': None}
+    tail = (1 - confidence) / 2 * 100
+    lower, median, upper = np.percentile(values, [tail, 50, 100 - tail])
+    return {'observed': observed, 'mean': float(values.mean()), 'std': float(values.std()),
+            'lower': float(lower), 'median': float(median), 'upper': float(upper)}
+
+
+class MonteCarlo:
+    """
+    Bootstrap, trade-reshuffle and return-perturbation simulations of a completed backtest.
+    """
+    def __init__(self, values, datetimes = None, trade_pnl = None, n_simulations = 10000, methods = METHODS,
+                 block_size = 1, noise = 0.5, confidence = 0.95, max_memory_mb = 256, max_workers = None,
+                 seed = None):
+        """
+        Constructs a new Monte Carlo analysis.
+        Args:
+            values: portfolio value after every bar, e.g. result['equity_curve']['value'] of BtCopilot.run_backtest()
+            datetimes: datetimes of the values, used to annualise the Sharpe ratio (252 bars per year if None)
+            trade_pnl: net PnL of the closed trades in trading order, required for the reshuffle method
+            n_simulations: simulations per method
+            methods: subset of METHODS
+            block_size: bars per block of the bootstrap, 1 resamples single bars
+            noise: standard deviation of the perturbation as a multiple of the standard deviation of the bar returns
+            confidence: width of the reported confidence intervals
+            max_memory_mb: memory budget of a chunk of simulations
+            max_workers: worker processes for the chunks, None or 1 runs in process
+            seed: seed of the simulations, None draws a random seed
+        """
+        self.values = np.asarray(values, dtype=float)
+        self.datetimes = datetimes
+        self.trade_pnl = np.asarray(trade_pnl if trade_pnl is not None else [], dtype=float)
+        self.n_simulations = n_simulations
+        self.methods = methods
+        self.block_size = block_size
+        self.noise = noise
+        self.confidence = confidence
+        self.max_memory_mb = max_memory_mb
+        self.max_workers = max_workers
+        self.seed = seed
+
+        if len(self.values) < 3:
+            raise ValueError('the equity curve needs at least three values')
+        self.returns = self.values[1:] / self.values[:-1] - 1
+
+    @classmethod
+    def from_result(cls, result, **kwargs):
+        '''
+        analysis of a backtest result recorded with equity curve and trades, see BtCopilot.run_backtest().
+        :param result: dict
+        :param kwargs: see __init__()
+        :return: MonteCarlo
+        '''
+        from datetime import datetime
+
+        if not result.get('equity_curve'):
+            raise ValueError('the result has no equity curve, run the backtest with record=True')
+        datetimes = [datetime.fromisoformat(value) for value in result['equity_curve']['datetime']]
+        return cls(result['equity_curve']['value'], datetimes=datetimes,
+                   trade_pnl=[trade['pnl_net'] for trade in result.get('trades', [])], **kwargs)
+
+    def _chunk_rows(self, columns):
+        return max(1, int(self.max_memory_mb * 1024 * 1024 / (_BYTES_PER_BAR * max(columns, 1))))
+
+    def _observed(self, method):
+        '''
+        metrics of the actual backtest, computed like the simulated ones.
+        '''
+        if method == 'reshuffle':
+            statistics = _trade_statistics(self.trade_pnl[None, :], self.values[0], self._trades_per_year())
+        else:
+            statistics = _bar_statistics(self.returns[:, None], self.values[0], self._bars_per_year())
+        return [None if not np.isfinite(value[0]) else float(value[0]) for value in statistics]
+
+    def _bars_per_year(self):
+        return _annualisation(self.datetimes, len(self.returns))
+
+    def _trades_per_year(self):
+        return _annualisation(self.datetimes, len(self.trade_pnl))
+
+    def run(self):
+        '''
+        runs all simulations.
+        :return: report: dict mapping method to dict with keys simulations, final_pnl, max_drawdown, sharpe (each a
+        dict with keys observed, mean, std, lower, median, upper) and probability_of_loss
+        '''
+        tasks = []
+        for method in self.methods:
+            if method == 'reshuffle' and len(self.trade_pnl) < 2:
+                print('Trade reshuffle skipped: the backtest has less than two closed trades')
+                continue
+            data = self.trade_pnl if method == 'reshuffle' else self.returns
+            options = {'start_value': float(self.values[0]),
+                       'periods_per_year': self._trades_per_year() if method == 'reshuffle' else self._bars_per_year(),
+                       'block_size': self.block_size,
+                       'noise': self.noise}
+            rows = self._chunk_rows(len(data))
+            chunks = [min(rows, self.n_simulations - start) for start in range(0, self.n_simulations, rows)]
+            seeds = np.random.SeedSequence(self.seed).spawn(len(chunks))
+            tasks.extend((method, data, chunk, seed, options) for chunk, seed in zip(chunks, seeds))
+
+        if self.max_workers and self.max_workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.max_workers, len(tasks))) as executor:
+                outputs = list(executor.map(_simulate_chunk, *zip(*tasks)))
+        else:
+            outputs = [_simulate_chunk(*task) for task in tasks]
+
+        report = {}
+        for method in self.methods:
+            parts = [output for task, output in zip(tasks, outputs) if task[0] == method]
+            if not parts:
+                continue
+            final_pnl, max_drawdown, sharpe = (np.concatenate(values) for values in zip(*parts))
+            observed = self._observed(method)
+            report[method] = {'simulations': len(final_pnl),
+                              'final_pnl': _summary(final_pnl, observed[0], self.confidence),
+                              'max_drawdown': _summary(max_drawdown, observed[1], self.confidence),
+                              'sharpe': _summary(sharpe, observed[2], self.confidence),
+                              'probability_of_loss': float((final_pnl < 0).mean())}
+        return report
+
+
+def report_frame(report):
+    '''
+    flattens a report into a table, one row per method and metric.
+    :param report: dict, see MonteCarlo.run()
+    :return: pandas.DataFrame
+    '''
+    import pandas as pd
+
+    rows = [{'method': method, 'metric': metric, **summary}
+            for method, results in report.items()
+            for metric, summary in results.items() if isinstance(summary, dict)]
+    return pd.DataFrame(rows)
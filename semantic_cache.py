@@ -0,0 +1,435 @@
+import functools
+import math
+import os
+import re
+import sqlite3
+import string
+import threading
+import time
+import zlib
+from collections import Counter
+
+"""
+Semantic cache for near-duplicate prompts.
+Prompts are normalised (template text removed, synonyms and units unified, plurals stemmed) and embedded as hashed
+TF-IDF vectors, or with an optional local embedding model. Entries are indexed per namespace (the goal_code) with
+random-hyperplane locality sensitive hashing, so a lookup only scores the stored prompts in the buckets of the query.
+A stored response is returned when the cosine similarity reaches the threshold and the prompts agree on the sequence of
+their numbers and direction words (long/short, above/below, ...): "7/13 day MA crossover" never answers "7/21 day MA
+crossover", "buy below 30, sell above 70" never answers "sell below 30, buy above 70".
+Entries are kept in SQLite with per-namespace LRU and age-based eviction.
+"""
+
+# hashed feature space of the TF-IDF vectors
+_DIMENSION = 2 ** 14
+
+# words that flip the meaning of a strategy, prompts must agree on them to match
+GUARD_WORDS = {'long', 'short', 'above', 'below', 'over', 'under', 'upper', 'lower', 'higher', 'greater', 'less', 'up',
+               'down', 'buy', 'sell', 'not', 'no', 'without', 'exclude', 'except', 'only', 'close', 'exit', 'entry',
+               'trailing', 'daily', 'weekly', 'monthly', 'hourly', 'minute', 'intraday', 'exponential', 'simple',
+               'weighted', 'sma', 'ema', 'wma', 'rsi', 'macd', 'bollinger', 'atr'}
+
+_STOPWORDS = {'a', 'an', 'the', 'of', 'and', 'or', 'to', 'for', 'on', 'in', 'at', 'by', 'with', 'when', 'is', 'are',
+              'be', 'it', 'its', 'we', 'i', 'my', 'our', 'you', 'that', 'this', 'then', 'use', 'using', 'please',
+              'also', 'as', 'from', 'if', 'into', 'should', 'will', 'would', 'can', 'which', 'has', 'was', 'does'}
+
+# phrase replacements applied before tokenising
+_PHRASES = [(re.compile(pattern), replacement) for pattern, replacement in (
+    (r'\bper\s*cent\b|\bpercent(age)?\b|\bpct\b', '%'),
+    (r'(\d)\s+%', r'\1%'),
+    (r'\bmoving\s+averages?\b|\bma\b', 'ma'),
+    (r'\bstop[\s-]*loss(es)?\b|\bstoploss\b|\bstops?\b', 'stoploss'),
+    (r'\btake[\s-]*profits?\b|\btakeprofit\b', 'takeprofit'),
+    (r'\bcross(es|ed|ing|over|overs)?\b', 'cross'),
+    (r'\bdays?\b|\bd\b', 'day'),
+)]
+
+_TOKEN = re.compile(r'\d+(?:\.\d+)?%?|[a-z]+')
+
+
+def _stem(word):
+    if len(word) > 2 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+
+def tokenise(text):
+    '''
+    normalises a text into tokens: lower case, unified synonyms and units, stemmed plurals, no stopwords.
+    :param text: str
+    :return: tokens: list of str
+    '''
+    text = text.lower()
+    for pattern, replacement in _PHRASES:
+        text = pattern.sub(replacement, text)
+    tokens = []
+    for token in _TOKEN.findall(text):
+        if token[0].isdigit():
+            # 15.0 and 15 are the same number
+            number, percent = (token[:-1], '%') if token.endswith('%') else (token, '')
+            tokens.append(f'{float(number):g}{percent}')
+        elif token not in _STOPWORDS:
+            tokens.append(_stem(token))
+    return tokens
+
+
+def guard_signature(tokens):
+    '''
+    numbers and direction words of a prompt in the order they appear, which must be identical for two prompts to
+    match. The order keeps their roles: "buy below 30, sell above 70" and "sell below 30, buy above 70" or a 10/50 and
+    a 50/10 crossover have the same tokens, but not the same sequence.
+    :param tokens: list of str, see tokenise()
+    :return: signature: str
+    '''
+    return ' '.join(token for token in tokens if token[0].isdigit() or token in GUARD_WORDS)
+
+
+@functools.lru_cache(maxsize=65536)
+def _feature(name):
+    return zlib.crc32(name.encode('utf-8')) % _DIMENSION
+
+
+def hashed_features(tokens):
+    '''
+    sparse term frequencies of a token list: words and character 4-grams of longer words. Word order is ignored,
+    paraphrases reorder words freely; the words that decide the meaning are compared by guard_signature().
+    :param tokens: list of str
+    :return: features: dict mapping feature index to sublinear term frequency
+    '''
+    counts = Counter()
+    for token in tokens:
+        counts[_feature('w:' + token)] += 1
+        if len(token) > 5 and not token[0].isdigit():
+            for j in range(len(token) - 3):
+                counts[_feature('c:' + token[j:j + 4])] += 0.25
+    return {index: 1.0 + math.log(count) if count >= 1 else count for index, count in counts.items()}
+
+
+def template_fragments(templates, min_length = 12):
+    '''
+    literal text of prompt templates, removed from prompts before they are compared.
+    :param templates: iterable of python format string templates
+    :param min_length: int, shorter fragments are kept in the prompt
+    :return: fragments: list of str, longest first
+    '''
+    fragments = set()
+    for template in templates:
+        try:
+            parts = [literal for literal, _, _, _ in string.Formatter().parse(template)]
+        except ValueError:
+            parts = [template]
+        fragments.update(part.strip() for part in parts if len(part.strip()) >= min_length)
+    return sorted(fragments, key=len, reverse=True)
+
+
+class SemanticCache:
+    """
+    Approximate response cache answering prompts that are worded differently but mean the same.
+    A single cache file can be shared by several coding agents.
+    """
+    def __init__(self, path, threshold = 0.9, max_entries_per_namespace = 2000, max_age_seconds = 30 * 24 * 3600,
+                 embed = None, n_tables = 16, n_bits = 8, exhaustive_below = 64, seed = 0):
+        """
+        Constructs a new semantic cache.
+        Args:
+            path: location of the SQLite cache file. Parent directories are created if required.
+            threshold: minimum cosine similarity of a hit
+            max_entries_per_namespace: least recently used entries beyond this are evicted
+            max_age_seconds: entries older than this are evicted. None disables expiry.
+            embed: optional function mapping a list of normalised texts to dense vectors (e.g. the encode method of
+            a local sentence-transformers model). None uses hashed TF-IDF vectors.
+            n_tables: number of LSH hash tables, more tables find more of the similar prompts
+            n_bits: hyperplanes per table, more bits put fewer prompts into a bucket
+            exhaustive_below: namespaces with fewer entries are scanned completely instead of through the index
+            seed: seed of the random hyperplanes
+        """
+        self.path = path
+        self.threshold = threshold
+        self.max_entries_per_namespace = max_entries_per_namespace
+        self.max_age_seconds = max_age_seconds
+        self.embed = embed
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.exhaustive_below = exhaustive_below
+        self.seed = seed
+
+        self._fragments = []
+        # random hyperplane components per feature, see _signature()
+        self._planes = {}
+
+        # in-memory index per namespace: entries, LSH buckets and document frequencies. Built on first use.
+        self._namespaces = None
+        # hit/miss counters per namespace of this instance
+        self._stats = {}
+
+        # sqlite connection and index are shared between threads, access is serialised
+        self._lock = threading.RLock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS semantic_responses (
+                                  id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                  namespace TEXT NOT NULL,
+                                  model_key TEXT NOT NULL,
+                                  prompt TEXT NOT NULL,
+                                  response TEXT NOT NULL,
+                                  created REAL NOT NULL,
+                                  last_access REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_semantic_namespace ON semantic_responses '
+                           '(namespace, last_access)')
+        self._conn.commit()
+
+    def set_boilerplate(self, templates):
+        '''
+        sets the prompt templates whose literal text is ignored when prompts are compared, so only the user input
+        decides a match. Rebuilds the index.
+        :param templates: iterable of format string templates, e.g. PromptLibrary.templates.values()
+        :return:
+        '''
+        with self._lock:
+            self._fragments = template_fragments(templates)
+            # vectors depend on the removed text
+            self._namespaces = None
+        return
+
+    def _normalise(self, prompt):
+        for fragment in self._fragments:
+            prompt = prompt.replace(fragment, ' ')
+        return tokenise(prompt)
+
+    def _vector(self, tokens):
+        '''
+        sparse vector of a prompt: hashed term frequencies, or the dense embedding as {dimension: value}.
+        '''
+        if self.embed is None:
+            return hashed_features(tokens)
+        dense = self.embed([' '.join(tokens)])[0]
+        return {i: float(value) for i, value in enumerate(dense) if value}
+
+    def _signature(self, vector):
+        '''
+        LSH bucket of a vector in every table: the signs of its projections on random hyperplanes.
+        :return: tuple of int, one bucket per table
+        '''
+        import numpy as np
+
+        # the hyperplane components of a feature are drawn from its own seeded generator, so only features that
+        # occur are materialised and signatures stay stable across sessions
+        rows = []
+        for feature in vector:
+            row = self._planes.get(feature)
+            if row is None:
+                row = np.random.default_rng((self.seed, feature)).standard_normal(self.n_tables * self.n_bits)
+                self._planes[feature] = row
+            rows.append(row)
+        projection = np.fromiter(vector.values(), dtype=np.float64, count=len(vector)) @ np.array(rows)
+        bits = (projection > 0).reshape(self.n_tables, self.n_bits)
+        return tuple(int(value) for value in bits @ (1 << np.arange(self.n_bits)))
+
+    def _namespace(self, namespace):
+        if namespace not in self._namespaces:
+            self._namespaces[namespace] = {'entries': {},
+                                           'buckets': [{} for _ in range(self.n_tables)],
+                                           'df': Counter()}
+        return self._namespaces[namespace]
+
+    def _index_entry(self, entry_id, namespace, model_key, prompt):
+        tokens = self._normalise(prompt)
+        vector = self._vector(tokens)
+        entry = {'model_key': model_key, 'guard': guard_signature(tokens), 'vector': vector,
+                 'signature': self._signature(vector) if vector else ()}
+        index = self._namespace(namespace)
+        index['entries'][entry_id] = entry
+        for table, bucket in enumerate(entry['signature']):
+            index['buckets'][table].setdefault(bucket, set()).add(entry_id)
+        index['df'].update(vector.keys())
+        return
+
+    def _unindex_entry(self, entry_id, namespace):
+        index = self._namespaces.get(namespace)
+        if index is None or entry_id not in index['entries']:
+            return
+        entry = index['entries'].pop(entry_id)
+        for table, bucket in enumerate(entry['signature']):
+            index['buckets'][table].get(bucket, set()).discard(entry_id)
+        index['df'].subtract(entry['vector'].keys())
+        return
+
+    def _index(self):
+        '''
+        in-memory index, built from the stored prompts on first use. Must be called with the lock held.
+        :return: dict mapping namespace to index
+        '''
+        if self._namespaces is not None:
+            return self._namespaces
+        self._namespaces = {}
+        rows = self._conn.execute('SELECT id, namespace, model_key, prompt FROM semantic_responses').fetchall()
+        for entry_id, namespace, model_key, prompt in rows:
+            self._index_entry(entry_id, namespace, model_key, prompt)
+        return self._namespaces
+
+    def _similarity(self, index, query, stored):
+        '''
+        cosine similarity, IDF weighted for hashed TF-IDF vectors.
+        '''
+        if self.embed is None:
+            n = len(index['entries'])
+            idf = {feature: math.log((1 + n) / (1 + index['df'][feature])) + 1.0
+                   for feature in query.keys() | stored.keys()}
+        else:
+            idf = None
+
+        def weighted(vector):
+            return vector if idf is None else {feature: value * idf[feature] for feature, value in vector.items()}
+
+        a, b = weighted(query), weighted(stored)
+        dot = sum(value * b[feature] for feature, value in a.items() if feature in b)
+        norm = math.sqrt(sum(value * value for value in a.values())) * math.sqrt(sum(value * value
+                                                                                     for value in b.values()))
+        return dot / norm if norm else 0.0
+
+    def lookup(self, prompt, namespace, model_key = ''):
+        '''
+        finds the most similar stored prompt.
+        :param prompt: str
+        :param namespace: str, usually the goal_code
+        :param model_key: str, model settings that must be identical, e.g. model, temperature and max_tokens
+        :return: (response: str, similarity: float), or (None, best similarity) on a miss
+        '''
+        now = time.time()
+        with self._lock:
+            stats = self._stats.setdefault(namespace, {'hits': 0, 'misses': 0})
+            index = self._index().get(namespace)
+            tokens = self._normalise(prompt)
+            vector = self._vector(tokens) if index else None
+            if not vector:
+                stats['misses'] += 1
+                return None, 0.0
+
+            if len(index['entries']) < self.exhaustive_below:
+                candidates = set(index['entries'])
+            else:
+                candidates = set()
+                for table, bucket in enumerate(self._signature(vector)):
+                    candidates |= index['buckets'][table].get(bucket, set())
+
+            guard = guard_signature(tokens)
+            best_id, best_similarity = None, 0.0
+            for entry_id in candidates:
+                entry = index['entries'][entry_id]
+                if entry['model_key'] != model_key or entry['guard'] != guard:
+                    continue
+                similarity = self._similarity(index, vector, entry['vector'])
+                if similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            row = None
+            if best_id is not None and best_similarity >= self.threshold:
+                row = self._conn.execute('SELECT response, created FROM semantic_responses WHERE id = ?',
+                                         (best_id,)).fetchone()
+                if row is not None and self.max_age_seconds is not None and now - row[1] > self.max_age_seconds:
+                    self._delete([(best_id, namespace)])
+                    row = None
+
+            if row is None:
+                stats['misses'] += 1
+                return None, best_similarity
+
+            self._conn.execute('UPDATE semantic_responses SET last_access = ? WHERE id = ?', (now, best_id))
+            self._conn.commit()
+            stats['hits'] += 1
+            return row[0], best_similarity
+
+    def set(self, prompt, response, namespace, model_key = ''):
+        '''
+        stores a response and applies the eviction policy of its namespace.
+        :param prompt: str
+        :param response: str
+        :param namespace: str
+        :param model_key: str
+        :return:
+        '''
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute('INSERT INTO semantic_responses (namespace, model_key, prompt, response, '
+                                        'created, last_access) VALUES (?, ?, ?, ?, ?, ?)',
+                                        (namespace, model_key, prompt, response, now, now))
+            self._index()
+            self._index_entry(cursor.lastrowid, namespace, model_key, prompt)
+            self._evict(namespace, now)
+            self._conn.commit()
+        return
+
+    def _delete(self, entries):
+        '''
+        removes entries from the database and the index. Must be called with the lock held.
+        :param entries: list of (id, namespace)
+        '''
+        self._conn.executemany('DELETE FROM semantic_responses WHERE id = ?', [(entry_id,) for entry_id, _ in entries])
+        for entry_id, namespace in entries:
+            self._unindex_entry(entry_id, namespace)
+        self._conn.commit()
+        return
+
+    def _evict(self, namespace, now):
+        '''
+        removes expired entries, then the least recently used entries of the namespace beyond its size limit.
+        Must be called with the lock held.
+        '''
+        expired = []
+        if self.max_age_seconds is not None:
+            expired = self._conn.execute('SELECT id, namespace FROM semantic_responses WHERE created < ?',
+                                         (now - self.max_age_seconds,)).fetchall()
+        surplus = self._conn.execute('SELECT id, namespace FROM semantic_responses WHERE namespace = ? '
+                                     'ORDER BY last_access DESC LIMIT -1 OFFSET ?',
+                                     (namespace, self.max_entries_per_namespace)).fetchall()
+        if expired or surplus:
+            self._delete(list(set(expired) | set(surplus)))
+        return
+
+    def clear(self, namespace = None):
+        '''
+        removes all entries, or those of one namespace, and resets the statistics.
+        :param namespace: str or None
+        :return:
+        '''
+        with self._lock:
+            if namespace is None:
+                self._conn.execute('DELETE FROM semantic_responses')
+                self._namespaces = None
+                self._stats = {}
+            else:
+                self._conn.execute('DELETE FROM semantic_responses WHERE namespace = ?', (namespace,))
+                self._index().pop(namespace, None)
+                self._stats.pop(namespace, None)
+            self._conn.commit()
+        return
+
+    def stats(self):
+        '''
+        reports hits, misses and entries per namespace.
+        :return: stats: dict mapping namespace to dict with keys hits, misses, hit_rate, entries
+        '''
+        with self._lock:
+            index = self._index()
+            result = {}
+            for namespace in sorted(set(index) | set(self._stats)):
+                counts = self._stats.get(namespace, {'hits': 0, 'misses': 0})
+                lookups = counts['hits'] + counts['misses']
+                result[namespace] = {'hits': counts['hits'],
+                                     'misses': counts['misses'],
+                                     'hit_rate': counts['hits'] / lookups if lookups else 0.0,
+                                     'entries': len(index.get(namespace, {}).get('entries', {}))}
+            return result
+
+    def close(self):
+        '''
+        closes the underlying database connection.
+        :return:
+        '''
+        with self._lock:
+            self._conn.close()
+        return
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+"""
+Checkpoints of interactive copilot workflows.
+A session keeps the answers given so far and the output of every finished step together with a hash of the step
+inputs. When a session is re-entered, a step whose inputs are unchanged returns its stored output instead of running
+again, so an interrupted autopilot does not pay twice for finished llm calls. A changed answer changes the inputs of the
+steps that depend on it, and only those run again.
+Sessions are kept in one JSON file each, written atomically after every change.
+"""
+
+
+def session_path(directory, name):
+    '''
+    file of a named session, e.g. the project name of the autopilot.
+    :param directory: str
+    :param name: str
+    :return: path: str
+    '''
+    return os.path.join(directory, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name) or 'session'}.json")
+
+
+def inputs_key(inputs):
+    '''
+    hash of the inputs of a step.
+    :param inputs: JSON serialisable value
+    :return: key: str
+    '''
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class SessionStore:
+    """
+    Answers and step outputs of one workflow session, persisted to a JSON file.
+    """
+    def __init__(self, path = None):
+        """
+        Constructs a new session store.
+        Args:
+            path: optional JSON file of the session. An existing file is loaded, None keeps the session in memory.
+        """
+        self.path = path
+
+        self._state = {'answers': {}, 'steps': {}}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._state = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"Session not loaded from {path}: {str(e)}")
+
+    @property
+    def resumed(self):
+        '''
+        True if the session holds answers or steps of an earlier run.
+        :return: bool
+        '''
+        return bool(self._state['answers'] or self._state['steps'])
+
+    def _save(self):
+        if not self.path:
+            return
+        self._state['updated'] = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._state, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+        return
+
+    def answer(self, name, default = None):
+        '''
+        answer given to a question in an earlier run of the session.
+        :param name: str
+        :param default: returned if the question was not answered yet
+        :return: answer
+        '''
+        with self._lock:
+            return self._state['answers'].get(name, default)
+
+    def set_answer(self, name, value):
+        '''
+        records the answer to a question.
+        :param name: str
+        :param value: JSON serialisable value
+        :return:
+        '''
+        with self._lock:
+            self._state['answers'][name] = value
+            self._save()
+        return
+
+    def step(self, name, inputs, run):
+        '''
+        returns the stored output of a step if its inputs are unchanged, otherwise runs it and stores the output.
+        A step that raises is not stored and runs again next time.
+        :param name: str
+        :param inputs: JSON serialisable value, everything the step output depends on
+        :param run: callable without arguments returning a JSON serialisable output
+        :return: (output, reused: bool)
+        '''
+        key = inputs_key(inputs)
+        with self._lock:
+            stored = self._state['steps'].get(name)
+        if stored is not None and stored['key'] == key:
+            return stored['output'], True
+
+        output = run()
+        with self._lock:
+            self._state['steps'][name] = {'key': key, 'output': output, 'completed': time.time()}
+            self._save()
+        return output, False
+
+    def clear(self):
+        with self._lock:
+            self._state = {'answers': {}, 'steps': {}}
+            self._save()
+        return
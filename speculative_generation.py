@@ -0,0 +1,185 @@
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, \
+    FIRST_COMPLETED
+from code_validation import smoke_test_errors
+
+"""
+Speculative best-of-N code generation.
+N completions of the same prompt are streamed at the same time, optionally at different temperatures. Every candidate
+is validated as soon as it is complete: the static checks run in its thread, the smoke backtest in a pool of warm
+workers with one worker per candidate. The first candidate that passes wins. The streams of the other candidates are
+closed when their next chunk arrives, which stops their generation, and their smoke backtests are cancelled.
+The first candidate at every temperature is answered from the response cache like a plain request, further samples
+at the same temperature bypass the cache, otherwise they would all be the same cached answer.
+"""
+
+
+class SpeculativeGenerator:
+    """
+    Generates several code candidates in parallel and returns the first that passes validation.
+    """
+    def __init__(self, coding_agent, validator, temperatures, smoke_test = True):
+        """
+        Constructs a new speculative generator.
+        Args:
+            coding_agent: SimpleCodingAgent streaming the candidates
+            validator: CodeValidator. Its backtest runner runs the smoke tests, it should have a worker per candidate
+            and is closed when the generation ends.
+            temperatures: list of float, one candidate per temperature
+            smoke_test: bool, run the smoke backtest on candidates that pass the static checks
+        """
+        self.coding_agent = coding_agent
+        self.validator = validator
+        self.temperatures = list(temperatures)
+        self.smoke_test = smoke_test
+
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def _validate(self, code, candidate):
+        '''
+        validates a candidate, the smoke test runs in the shared backtest runner.
+        :return: report, see CodeValidator.validate(), or None if the generation ended first
+        '''
+        report = self.validator.validate(code, smoke_test=False)
+        runner = self.validator.backtest_runner
+        if not report['ok'] or not self.smoke_test or runner is None:
+            return report
+
+        start = time.perf_counter()
+        with self._lock:
+            # a winner closes the runner under the lock, no smoke test may start after that
+            if self._stop.is_set():
+                return None
+            future = runner.submit(code, cwd=self.validator.cwd, max_bars=self.validator.smoke_bars)
+        candidate['smoke_future'] = future
+        try:
+            result = future.result(timeout=self.validator.smoke_timeout)
+        except CancelledError:
+            return None
+        except FutureTimeoutError:
+            result = {'ok': False, 'error': f'backtest did not finish within {self.validator.smoke_timeout} seconds',
+                      'runs': []}
+        except Exception as e:
+            if self._stop.is_set():
+                # the worker was terminated when another candidate won
+                return None
+            result = {'ok': False, 'error': f'{type(e).__name__}: {str(e)}', 'runs': []}
+        report['timings']['smoke_test'] = time.perf_counter() - start
+        report['smoke_result'] = result
+        errors = smoke_test_errors(result)
+        if errors:
+            report.update(ok=False, stage='smoke_test', errors=errors)
+        return report
+
+    def _candidate(self, prompt, goal_code, candidate):
+        '''
+        streams and validates one candidate. Stops early once another candidate has won.
+        :return: candidate: dict
+        '''
+        start = time.perf_counter()
+        chunks = []
+        stream = self.coding_agent.stream_code(prompt=prompt, temperature=candidate['temperature'],
+                                               goal_code=goal_code, cached=candidate['cached'])
+        try:
+            for chunk in stream:
+                if self._stop.is_set():
+                    candidate['status'] = 'cancelled'
+                    return candidate
+                chunks.append(chunk)
+        finally:
+            # stops receiving tokens of a cancelled candidate
+            stream.close()
+        candidate['code'] = ''.join(chunks)
+        candidate['generation_time'] = time.perf_counter() - start
+
+        if self._stop.is_set():
+            candidate['status'] = 'cancelled'
+            return candidate
+        report = self._validate(candidate['code'], candidate)
+        candidate['validation_time'] = time.perf_counter() - start - candidate['generation_time']
+        if report is None:
+            candidate['status'] = 'cancelled'
+            return candidate
+        candidate['report'] = report
+        candidate['status'] = 'passed' if report['ok'] else 'failed'
+        return candidate
+
+    def _cancel(self, candidates):
+        '''
+        ends the generation: open streams stop at their next chunk, smoke tests are cancelled or terminated.
+        '''
+        with self._lock:
+            self._stop.set()
+            for candidate in candidates:
+                if candidate.get('smoke_future') is not None:
+                    candidate['smoke_future'].cancel()
+            if self.validator.backtest_runner is not None:
+                self.validator.backtest_runner.close(kill=True)
+        return
+
+    def generate(self, prompt, goal_code = 'build_code'):
+        '''
+        streams all candidates in parallel and returns the first that passes validation.
+        If no candidate passes, the first candidate that completed is returned with its validation report.
+        :param prompt: str
+        :param goal_code: str
+        :return: result: dict with keys ok, code, report, winner (index of the winning candidate or None), runtime and
+        candidates (dicts with keys index, temperature, cached, status: passed, failed, cancelled or error,
+        generation_time, validation_time, stage and errors)
+        '''
+        start = time.perf_counter()
+        self._stop.clear()
+        candidates = []
+        for index, temperature in enumerate(self.temperatures):
+            candidates.append({'index': index, 'temperature': temperature,
+                               'cached': temperature not in self.temperatures[:index],
+                               'status': 'running', 'code': None, 'report': None,
+                               'generation_time': None, 'validation_time': None})
+        if self.smoke_test and self.validator.backtest_runner is not None:
+            # workers import their dependencies while the llm is generating
+            self.validator.backtest_runner.warm_up(wait=False)
+
+        winner = None
+        completed = []
+        errors = []
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        try:
+            pending = {executor.submit(self._candidate, prompt, goal_code, candidate): candidate
+                       for candidate in candidates}
+            while pending and winner is None:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    candidate = pending.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        candidate.update(status='error', error=f'{type(e).__name__}: {str(e)}')
+                        errors.append(e)
+                        continue
+                    if candidate['status'] in ('passed', 'failed'):
+                        completed.append(candidate)
+                    if candidate['status'] == 'passed' and winner is None:
+                        winner = candidate
+        finally:
+            self._cancel(candidates)
+            # cancelled candidates finish in the background, at the latest with their next chunk
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if winner is None and not completed and errors:
+            raise errors[0]
+        chosen = winner or (completed[0] if completed else None)
+        for candidate in candidates:
+            if candidate['status'] == 'running':
+                candidate['status'] = 'cancelled'
+            report = candidate['report']
+            candidate['stage'] = None if report is None else report['stage']
+            candidate['errors'] = [] if report is None else report['errors']
+        return {'ok': winner is not None,
+                'code': chosen['code'] if chosen else '',
+                'report': chosen['report'] if chosen else None,
+                'winner': winner['index'] if winner else None,
+                'runtime': time.perf_counter() - start,
+                'candidates': [{key: value for key, value in candidate.items()
+                                if key not in ('code', 'report', 'smoke_future')} for candidate in candidates]}
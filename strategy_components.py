@@ -0,0 +1,255 @@
+import ast
+import contextvars
+import hashlib
+import json
+import os
+import textwrap
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from prompt_compaction import _call_name, strip_code
+
+"""
+Incremental analysis of backtest code.
+The code is split into components (strategy params, indicators, next() logic, order handling, data feeds, analyzers,
+broker setup, ...) and every component is fingerprinted on its normalised source, so formatting, comment and
+logging changes do not count as edits. LLM results are stored per component and fingerprint; after an edit only the
+changed components are sent to the llm and the answer is merged from the stored pieces. Results of earlier versions
+of a component are dropped, so the store only grows with the code.
+"""
+
+# strategy methods grouped into one component
+_METHOD_COMPONENTS = {'__init__': 'indicators',
+                      'next': 'next',
+                      'prenext': 'next',
+                      'nextstart': 'next',
+                      'notify_order': 'orders',
+                      'notify_trade': 'orders'}
+
+# calls on cerebro (or the broker) that identify module level components
+_FEED_CALLS = {'adddata', 'resampledata', 'replaydata', 'chaindata', 'rolloverdata'}
+_ANALYZER_CALLS = {'addanalyzer', 'addobserver', 'addobservermulti', 'addwriter'}
+_BROKER_CALLS = {'addsizer', 'addsizer_byidx', 'setcash', 'setcommission', 'addcommissioninfo', 'set_slippage_perc',
+                 'set_slippage_fixed', 'set_coc', 'set_coo', 'setbroker'}
+
+
+def fingerprint(source):
+    '''
+    fingerprint of a component source.
+    :param source: str
+    :return: sha1 hex digest: str
+    '''
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def _normalise(node):
+    '''
+    source of a node without comments, docstrings and logging statements.
+    :param node: ast node
+    :return: source: str, empty for logging only statements
+    '''
+    source = strip_code(textwrap.dedent(ast.unparse(node)), strategy_only=False)
+    # statements that only logged leave nothing to analyse
+    return '' if source.strip() == 'pass' else source
+
+
+def _module_component(statement):
+    '''
+    component of a module level statement.
+    :param statement: ast.stmt
+    :return: component name: str
+    '''
+    calls = {_call_name(node) for node in ast.walk(statement) if isinstance(node, ast.Call)}
+    attributes = {node.attr for node in ast.walk(statement) if isinstance(node, ast.Attribute)}
+
+    if calls & _FEED_CALLS or 'feeds' in attributes or any(name and name.endswith('Data') for name in calls):
+        return 'data_feeds'
+    if calls & _ANALYZER_CALLS or 'analyzers' in attributes:
+        return 'analyzers'
+    if calls & _BROKER_CALLS or 'broker' in attributes:
+        return 'broker'
+    return 'cerebro'
+
+
+def extract_components(code):
+    '''
+    splits backtest code into named components.
+    Strategy classes give <Class>.params, <Class>.indicators, <Class>.next, <Class>.orders and one component per other
+    method; other classes give one component each; module level statements are grouped into data_feeds, analyzers,
+    broker and cerebro. Code that cannot be parsed is a single component named code.
+    :param code: str
+    :return: components: dict mapping name to normalised source, in code order
+    '''
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return {'code': code}
+
+    components = {}
+
+    def add(name, source):
+        if source.strip():
+            components[name] = components[name] + '\n' + source if name in components else source
+
+    module_statements = []
+    for statement in tree.body:
+        if isinstance(statement, (ast.Import, ast.ImportFrom)):
+            continue
+        if not isinstance(statement, ast.ClassDef):
+            module_statements.append(statement)
+            continue
+
+        is_strategy = any('Strategy' in ast.unparse(base) for base in statement.bases)
+        if not is_strategy:
+            add(statement.name, _normalise(statement))
+            continue
+
+        header = f"class {statement.name}({', '.join(ast.unparse(base) for base in statement.bases)}):"
+        add(f'{statement.name}.params', header)
+        for member in statement.body:
+            if isinstance(member, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                component = _METHOD_COMPONENTS.get(member.name, member.name)
+                add(f'{statement.name}.{component}', _normalise(member))
+            elif not (isinstance(member, ast.Expr) and isinstance(member.value, ast.Constant)):
+                # params, lines, plotinfo and other class attributes
+                add(f'{statement.name}.params', textwrap.indent(ast.unparse(member), '    '))
+
+    for statement in module_statements:
+        add(_module_component(statement), _normalise(statement))
+
+    return components
+
+
+def changed_components(old_components, new_components):
+    '''
+    compares two component sets.
+    :param old_components: dict, see extract_components()
+    :param new_components: dict
+    :return: (added, changed, removed): lists of component names
+    '''
+    added = [name for name in new_components if name not in old_components]
+    removed = [name for name in old_components if name not in new_components]
+    changed = [name for name in new_components if name in old_components and
+               fingerprint(new_components[name]) != fingerprint(old_components[name])]
+    return added, changed, removed
+
+
+class ComponentAnalyser:
+    """
+    Runs per-component llm analyses and stores the results by goal code, model, temperature, component name and
+    fingerprint. Results can be persisted to a JSON file, so unchanged components are not re-analysed across sessions.
+    Only the current fingerprint of every component is kept, and the least recently used results are dropped beyond
+    max_entries.
+    """
+    def __init__(self, coding_agent, prompt_library, path = None, max_workers = 4, max_entries = 5000):
+        """
+        Constructs a new component analyser.
+        Args:
+            coding_agent: agent answering the component prompts
+            prompt_library: PromptLibrary with the component goal codes
+            path: optional JSON file the stored results are kept in
+            max_workers: concurrent llm calls for changed components
+            max_entries: number of stored results, None keeps all
+        """
+        self.coding_agent = coding_agent
+        self.prompt_library = prompt_library
+        self.path = path
+        self.max_workers = max_workers
+        self.max_entries = max_entries
+
+        self._results = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._results = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"Component analyses not loaded from {path}: {str(e)}")
+
+    def _save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._results, f)
+        os.replace(tmp_path, self.path)
+        return
+
+    def _key(self, goal_code, temperature, name, source):
+        '''
+        store key of a component result. Answers depend on the model and the temperature as much as on the prompt.
+        :return: key: str, goal_code:model:temperature:name:fingerprint
+        '''
+        model_name = getattr(self.coding_agent, 'model_name', None)
+        return f'{goal_code}:{model_name}:{float(temperature):g}:{name}:{fingerprint(source)}'
+
+    def _store(self, key, response):
+        '''
+        stores a result, replacing the results of earlier versions of the component. Call with the lock held.
+        :param key: str, see _key()
+        :param response: str
+        :return:
+        '''
+        prefix = key.rsplit(':', 1)[0] + ':'
+        for stale in [stored for stored in self._results if stored.startswith(prefix)]:
+            del self._results[stale]
+        self._results[key] = response
+        if self.max_entries is not None:
+            while len(self._results) > self.max_entries:
+                # insertion order is use order, see analyse()
+                del self._results[next(iter(self._results))]
+        return
+
+    def analyse(self, components, goal_code, temperature, stats = None):
+        '''
+        analyses all components, calling the llm only for components without a stored result.
+        :param components: dict, see extract_components()
+        :param goal_code: str, prompt library template with the input variables component and user_input
+        :param temperature: float
+        :param stats: optional dict filled with the number of components, analysed and reused components of this call
+        :return: results: dict mapping component name to llm response, in component order
+        '''
+        keys = {name: self._key(goal_code, temperature, name, source) for name, source in components.items()}
+        with self._lock:
+            stored = {name: self._results[keys[name]] for name in components if keys[name] in self._results}
+        pending = [name for name in components if name not in stored]
+
+        def analyse_component(name):
+            prompt = self.prompt_library.format(goal_code, component=name, user_input=components[name])
+            return self.coding_agent.simple_LLMcall(prompt=prompt, temperature=temperature, goal_code=goal_code)
+
+        responses = {}
+        if pending:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                # every call runs in a copy of the caller's context, so metrics spans are inherited
+                futures = [executor.submit(contextvars.copy_context().run, analyse_component, name)
+                           for name in pending]
+                responses = {name: future.result() for name, future in zip(pending, futures)}
+
+        if stats is not None:
+            stats.update({'components': len(components), 'analysed': len(pending),
+                          'reused': len(components) - len(pending)})
+        results = {name: responses[name] if name in responses else stored[name] for name in components}
+        with self._lock:
+            for name, response in results.items():
+                # reused results move to the end of the use order
+                self._results.pop(keys[name], None)
+                self._store(keys[name], response)
+            if pending:
+                self._save()
+        return results
+
+    def clear(self):
+        with self._lock:
+            self._results = {}
+            self._save()
+        return
+
+
+def merge_results(results):
+    '''
+    merges per-component results into one answer.
+    :param results: dict mapping component name to text
+    :return: text: str
+    '''
+    return '\n\n'.join(f'{name}:\n{text.strip()}' for name, text in results.items())
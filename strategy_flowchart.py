@@ -0,0 +1,292 @@
+import ast
+import hashlib
+import os
+import re
+import shutil
+import textwrap
+from prompt_compaction import _call_name, _is_docstring, _is_logging
+
+"""
+Deterministic flowchart of a backtrader strategy, generated from the code without an llm.
+Every bt.Strategy subclass becomes a cluster: its params, the indicators created in __init__() and the control flow
+of next() with the branch conditions as decisions and the orders as highlighted actions. Logging is left out.
+The graphviz DOT source is built in process. Rendering to an image needs the graphviz python package and the dot
+executable; without them only the DOT file is written. Both are cached by a hash of the code, so an unchanged
+strategy is not processed again.
+"""
+
+# bump when the chart layout changes, invalidates cached charts
+GENERATOR_VERSION = 1
+
+# strategy methods that create orders
+ORDER_CALLS = {'buy', 'sell', 'close', 'cancel', 'order_target_size', 'order_target_value', 'order_target_percent',
+               'buy_bracket', 'sell_bracket'}
+
+_WRAP = 40
+
+
+def flowchart_key(code):
+    '''
+    cache key of the chart of the code.
+    :param code: str
+    :return: key: str (sha1 hex digest)
+    '''
+    return hashlib.sha1(f'{GENERATOR_VERSION}\n{code}'.encode('utf-8')).hexdigest()
+
+
+def _text(node):
+    '''
+    short source of an expression: self., params and current bar indices removed, e.g.
+    self.dataclose[0] >= self.buyprice * (1.0 + self.params.take_profit) -> dataclose >= buyprice * (1.0 + take_profit)
+    :param node: ast node
+    :return: str
+    '''
+    text = ast.unparse(node)
+    text = re.sub(r'\bself\.(params|p)\.', '', text)
+    text = re.sub(r'\bself\.', '', text)
+    text = re.sub(r'\bdatas\[(\d+)\]', r'data\1', text)
+    return text.replace('[0]', '')
+
+
+def _label(text, width = _WRAP):
+    '''
+    escapes a text for a DOT label and wraps long lines.
+    :param text: str
+    :param width: int
+    :return: str
+    '''
+    lines = [wrapped for line in text.splitlines() for wrapped in (textwrap.wrap(line, width) or [''])]
+    return '\\n'.join(line.replace('\\', '\\\\').replace('"', '\\"') for line in lines)
+
+
+def _is_order(statement):
+    return any(isinstance(node, ast.Call) and _call_name(node) in ORDER_CALLS for node in ast.walk(statement))
+
+
+def _param_name(node):
+    return node.value if isinstance(node, ast.Constant) and isinstance(node.value, str) else ast.unparse(node)
+
+
+def _strategy_params(cls):
+    '''
+    params of a strategy class: params = (('pfast', 10), ...) or params = dict(pfast=10).
+    :param cls: ast.ClassDef
+    :return: params: list of str 'name = default'
+    '''
+    for statement in cls.body:
+        if not (isinstance(statement, ast.Assign) and any(isinstance(target, ast.Name) and target.id == 'params'
+                                                          for target in statement.targets)):
+            continue
+        value = statement.value
+        if isinstance(value, ast.Call) and isinstance(value.func, ast.Name) and value.func.id == 'dict':
+            return [f'{keyword.arg} = {ast.unparse(keyword.value)}' for keyword in value.keywords]
+        if isinstance(value, ast.Dict):
+            return [f'{_param_name(key)} = {ast.unparse(item)}' for key, item in zip(value.keys, value.values)]
+        if isinstance(value, (ast.Tuple, ast.List)):
+            return [f'{_param_name(item.elts[0])} = {ast.unparse(item.elts[1])}'
+                    for item in value.elts if isinstance(item, (ast.Tuple, ast.List)) and len(item.elts) == 2]
+    return []
+
+
+def _indicators(method):
+    '''
+    attributes (or their items) assigned from calls in __init__(), e.g.
+    self.sma = bt.indicators.SMA(self.data, period=self.p.period) or self.rsi[d] = bt.ind.RSI(d).
+    :param method: ast.FunctionDef or None
+    :return: indicators: list of str 'name = Indicator(args)'
+    '''
+    if method is None:
+        return []
+    indicators = []
+    for node in ast.walk(method):
+        if (isinstance(node, ast.Assign) and isinstance(node.value, ast.Call) and len(node.targets) == 1
+                and isinstance(node.targets[0], (ast.Attribute, ast.Subscript))):
+            name = _call_name(node.value)
+            arguments = [_text(argument) for argument in node.value.args]
+            arguments += [f'{keyword.arg}={_text(keyword.value)}' for keyword in node.value.keywords if keyword.arg]
+            indicators.append(f"{_text(node.targets[0])} = {name}({', '.join(arguments)})")
+    return indicators
+
+
+class _Graph:
+    """
+    Nodes and edges of the chart of one strategy.
+    """
+    def __init__(self, prefix):
+        """
+        Constructs a new graph.
+        Args:
+            prefix: node id prefix, unique per strategy
+        """
+        self.prefix = prefix
+        self.nodes = []
+        self.edges = []
+
+    def node(self, label, **attributes):
+        node_id = f'{self.prefix}{len(self.nodes)}'
+        self.nodes.append((node_id, label, attributes))
+        return node_id
+
+    def connect(self, sources, target):
+        '''
+        connects the open ends of the flow to a node.
+        :param sources: list of (node id, edge label or None)
+        :param target: node id
+        :return:
+        '''
+        for source, label in sources:
+            self.edges.append((source, target, label))
+        return
+
+    def walk(self, statements, sources):
+        '''
+        adds the control flow of a block.
+        :param statements: list of ast statements
+        :param sources: open ends of the flow before the block
+        :return: open ends of the flow after the block
+        '''
+        pending = []
+
+        def flush(sources):
+            # consecutive plain statements share one box
+            if not pending:
+                return sources
+            node = self.node('\n'.join(pending), shape='box')
+            self.connect(sources, node)
+            pending.clear()
+            return [(node, None)]
+
+        for statement in statements:
+            if _is_logging(statement) or _is_docstring(statement) or isinstance(statement, ast.Pass):
+                continue
+            if isinstance(statement, ast.If):
+                sources = flush(sources)
+                decision = self.node(_text(statement.test), shape='diamond')
+                self.connect(sources, decision)
+                sources = self.walk(statement.body, [(decision, 'yes')]) + \
+                    self.walk(statement.orelse, [(decision, 'no')])
+            elif isinstance(statement, (ast.For, ast.While)):
+                sources = flush(sources)
+                if isinstance(statement, ast.For):
+                    target = statement.target
+                    names = ', '.join(_text(name) for name in target.elts) if isinstance(target, ast.Tuple) \
+                        else _text(target)
+                    loop = self.node(f'for {names} in {_text(statement.iter)}', shape='hexagon')
+                else:
+                    loop = self.node(f'while {_text(statement.test)}', shape='hexagon')
+                self.connect(sources, loop)
+                self.connect(self.walk(statement.body, [(loop, 'next')]), loop)
+                sources = [(loop, 'done')]
+            elif isinstance(statement, (ast.With, ast.Try)):
+                sources = self.walk(statement.body, flush(sources))
+            elif isinstance(statement, ast.Return):
+                node = self.node('return' if statement.value is None else f'return {_text(statement.value)}',
+                                 shape='oval')
+                self.connect(flush(sources), node)
+                return []
+            elif _is_order(statement):
+                value = statement.value if isinstance(statement, (ast.Assign, ast.Expr)) else statement
+                action = self.node(_text(value), shape='box', style='filled', fillcolor='lightblue')
+                self.connect(flush(sources), action)
+                sources = [(action, None)]
+            else:
+                pending.append(_text(statement))
+        return flush(sources)
+
+
+def strategy_dot(code):
+    '''
+    builds the graphviz DOT source of the flowchart of all strategies in the code.
+    :param code: str
+    :return: dot: str
+    '''
+    tree = ast.parse(code)
+    strategies = [node for node in ast.walk(tree) if isinstance(node, ast.ClassDef)
+                  and any('Strategy' in ast.unparse(base) for base in node.bases)]
+    if not strategies:
+        raise ValueError('No strategy class found: define a subclass of bt.Strategy.')
+
+    lines = ['digraph strategy {',
+             '    node [fontname="Helvetica", fontsize=10];',
+             '    edge [fontname="Helvetica", fontsize=9];']
+    for index, cls in enumerate(strategies):
+        methods = {node.name: node for node in cls.body if isinstance(node, ast.FunctionDef)}
+        graph = _Graph(prefix=f's{index}_')
+
+        params = _strategy_params(cls)
+        header = graph.node('\n'.join([f'{cls.name}'] + params), shape='note')
+        indicators = _indicators(methods.get('__init__'))
+        sources = [(header, None)]
+        if indicators:
+            node = graph.node('\n'.join(['indicators'] + indicators), shape='box', style='rounded')
+            graph.connect(sources, node)
+            sources = [(node, None)]
+
+        start = graph.node('next()', shape='oval', style='bold')
+        graph.connect(sources, start)
+        if 'next' in methods:
+            sources = graph.walk(methods['next'].body, [(start, None)])
+            if sources:
+                graph.connect(sources, graph.node('end of bar', shape='oval'))
+
+        lines.append(f'    subgraph cluster_{index} {{')
+        lines.append(f'        label="{_label(cls.name)}";')
+        for node_id, label, attributes in graph.nodes:
+            extra = ''.join(f', {name}="{value}"' for name, value in attributes.items())
+            lines.append(f'        {node_id} [label="{_label(label)}"{extra}];')
+        for source, target, label in graph.edges:
+            lines.append(f'        {source} -> {target}' + (f' [label="{label}"];' if label else ';'))
+        lines.append('    }')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def _write(path, content):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb' if isinstance(content, bytes) else 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    return
+
+
+def render_flowchart(code, cache_dir, output_path = None, format = 'png'):
+    '''
+    writes the DOT source and, if graphviz is installed, the rendered image of the flowchart. Both are cached by
+    flowchart_key(), an unchanged strategy is copied from the cache.
+    :param code: str
+    :param cache_dir: str, directory of the cached charts
+    :param output_path: str, output file without extension, e.g. outputs/myBacktest_flowchart. None only caches.
+    :param format: str, image format of graphviz
+    :return: result: dict with keys dot (path), image (path or None if graphviz is not available), cached (bool)
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    key = flowchart_key(code)
+    dot_path = os.path.join(cache_dir, f'{key}.gv')
+    image_path = os.path.join(cache_dir, f'{key}.{format}')
+
+    cached = os.path.exists(dot_path)
+    if not cached:
+        _write(dot_path, strategy_dot(code))
+
+    if not os.path.exists(image_path):
+        try:
+            import graphviz
+            with open(dot_path) as f:
+                _write(image_path, graphviz.Source(f.read()).pipe(format=format))
+            cached = False
+        except ImportError:
+            image_path = None
+        except Exception as e:
+            # graphviz.ExecutableNotFound if the dot executable is missing
+            print(f"Flowchart not rendered, ensure graphviz is installed on your system: {str(e)}")
+            image_path = None
+
+    result = {'dot': dot_path, 'image': image_path, 'cached': cached}
+    if output_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        shutil.copyfile(dot_path, f'{output_path}.gv')
+        result['dot'] = f'{output_path}.gv'
+        if image_path is not None:
+            shutil.copyfile(image_path, f'{output_path}.{format}')
+            result['image'] = f'{output_path}.{format}'
+    return result
@@ -0,0 +1,255 @@
+import ast
+import datetime
+import hashlib
+import os
+import sys
+import types
+import backtrader as bt
+
+"""
+Reads generated backtrader code without running it.
+The strategy classes are loaded in isolation and the Cerebro setup (data feeds, cash, sizer, commission, analyzers)
+is extracted from the syntax tree, so the backtest can be rebuilt and run with different parameters.
+"""
+
+# top level statements that are executed when loading the strategy classes
+_DEFINITION_NODES = (ast.Import, ast.ImportFrom, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+def _attribute_chain(node):
+    '''
+    turns an attribute access like bt.feeds.YahooFinanceCSVData into ['bt', 'feeds', 'YahooFinanceCSVData'].
+    :param node: ast node
+    :return: chain: list of str
+    '''
+    chain = []
+    while isinstance(node, ast.Attribute):
+        chain.insert(0, node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        chain.insert(0, node.id)
+    return chain
+
+
+def _literal_constants(tree):
+    '''
+    collects top level assignments of literal values, e.g. data_path = 'BTC-USD.csv'.
+    :param tree: ast.Module
+    :return: constants: dict
+    '''
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            try:
+                constants[node.targets[0].id] = _evaluate(node.value, constants)
+            except ValueError:
+                continue
+    return constants
+
+
+def _evaluate(node, constants):
+    '''
+    evaluates literals, known constants and datetime constructors. Anything else raises ValueError.
+    :param node: ast node
+    :param constants: dict
+    :return: value
+    '''
+    if isinstance(node, ast.Name) and node.id in constants:
+        return constants[node.id]
+
+    if isinstance(node, ast.Call):
+        chain = _attribute_chain(node.func)
+        if chain and chain[-1] in ('datetime', 'date'):
+            args = [_evaluate(arg, constants) for arg in node.args]
+            kwargs = {kw.arg: _evaluate(kw.value, constants) for kw in node.keywords}
+            return getattr(datetime, chain[-1])(*args, **kwargs)
+        raise ValueError(f'cannot evaluate call to {".".join(chain)}')
+
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError):
+        raise ValueError(f'cannot evaluate {ast.dump(node)}')
+
+
+def _keyword_arguments(call, constants):
+    '''
+    evaluates the keyword arguments of a call. Arguments that cannot be evaluated statically are skipped.
+    :param call: ast.Call
+    :param constants: dict
+    :return: kwargs: dict
+    '''
+    kwargs = {}
+    for keyword in call.keywords:
+        if keyword.arg is None:
+            continue
+        try:
+            kwargs[keyword.arg] = _evaluate(keyword.value, constants)
+        except ValueError:
+            continue
+    return kwargs
+
+
+def load_strategy_classes(code):
+    '''
+    loads the bt.Strategy subclasses defined in the code. Only imports, class and function definitions are executed,
+    the backtest itself is not run.
+    :param code: str
+    :return: strategies: dict mapping class name to class
+    '''
+    tree = ast.parse(code)
+    module = ast.Module(body=[node for node in tree.body if isinstance(node, _DEFINITION_NODES)], type_ignores=[])
+
+    # backtrader looks up the module of a strategy class, so the definitions live in a registered module
+    module_name = '_generated_strategy_' + hashlib.sha1(code.encode('utf-8')).hexdigest()[:12]
+    generated = types.ModuleType(module_name)
+    sys.modules[module_name] = generated
+    exec(compile(module, f'<{module_name}>', 'exec'), generated.__dict__)
+    namespace = generated.__dict__
+
+    return {name: obj for name, obj in namespace.items()
+            if isinstance(obj, type) and issubclass(obj, bt.Strategy) and obj is not bt.Strategy}
+
+
+def parse_backtest_spec(code):
+    '''
+    extracts the Cerebro setup from generated code.
+
+    Example result for resources/example_backtest.py:
+        {'strategy': 'SmaCross',
+         'strategy_kwargs': {},
+         'feeds': [{'feed': 'YahooFinanceCSVData', 'kwargs': {'dataname': 'BTC-USD.csv', 'fromdate': ..., ...}}],
+         'cash': 100000.0,
+         'sizer': {'sizer': 'FixedSize', 'kwargs': {'stake': 10}},
+         'commission': None,
+         'analyzers': [{'analyzer': 'SharpeRatio', 'kwargs': {'_name': 'mysharpe'}}, ...]}
+
+    :param code: str
+    :return: spec: dict
+    '''
+    tree = ast.parse(code)
+    constants = _literal_constants(tree)
+
+    spec = {'strategy': None,
+            'strategy_kwargs': {},
+            'feeds': [],
+            'cash': None,
+            'sizer': None,
+            'commission': None,
+            'analyzers': []}
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        chain = _attribute_chain(node.func)
+        if not chain:
+            continue
+
+        # data feeds: bt.feeds.<Feed>(...)
+        if 'feeds' in chain[:-1]:
+            spec['feeds'].append({'feed': chain[-1], 'kwargs': _keyword_arguments(node, constants)})
+
+        elif chain[-1] == 'addstrategy' and node.args:
+            strategy_chain = _attribute_chain(node.args[0])
+            if strategy_chain:
+                spec['strategy'] = strategy_chain[-1]
+                spec['strategy_kwargs'] = _keyword_arguments(node, constants)
+
+        elif chain[-1] == 'setcash' and node.args:
+            try:
+                spec['cash'] = float(_evaluate(node.args[0], constants))
+            except ValueError:
+                pass
+
+        elif chain[-1] in ('addsizer', 'addsizer_byidx') and node.args:
+            spec['sizer'] = {'sizer': _attribute_chain(node.args[-1])[-1],
+                             'kwargs': _keyword_arguments(node, constants)}
+
+        elif chain[-1] == 'setcommission':
+            kwargs = _keyword_arguments(node, constants)
+            if node.args:
+                try:
+                    kwargs['commission'] = float(_evaluate(node.args[0], constants))
+                except ValueError:
+                    pass
+            spec['commission'] = kwargs
+
+        elif chain[-1] == 'addanalyzer' and node.args:
+            spec['analyzers'].append({'analyzer': _attribute_chain(node.args[0])[-1],
+                                      'kwargs': _keyword_arguments(node, constants)})
+
+    return spec
+
+
+def resolve_data_path(dataname, data_dir = None):
+    '''
+    resolves the data file of a feed. Relative paths are looked up in data_dir, then in the working directory.
+    :param dataname: str
+    :param data_dir: str
+    :return: path: str
+    '''
+    if data_dir and not os.path.isabs(dataname) and os.path.exists(os.path.join(data_dir, dataname)):
+        return os.path.join(data_dir, dataname)
+    return dataname
+
+
+def build_feed(feed_spec, data_dir = None, **overrides):
+    '''
+    instantiates the backtrader data feed described by a feed spec.
+    :param feed_spec: dict, element of spec['feeds']
+    :param data_dir: str
+    :param overrides: feed parameters replacing those of the spec, e.g. fromdate/todate
+    :return: feed: bt.feed.AbstractDataBase
+    '''
+    kwargs = dict(feed_spec['kwargs'])
+    kwargs.update(overrides)
+    if isinstance(kwargs.get('dataname'), str):
+        kwargs['dataname'] = resolve_data_path(kwargs['dataname'], data_dir)
+    return getattr(bt.feeds, feed_spec['feed'])(**kwargs)
+
+
+def preload_feed(feed_spec, data_dir = None, **overrides):
+    '''
+    parses a data feed once and returns its bars as a pandas DataFrame, ready to be wrapped in bt.feeds.PandasData.
+    :param feed_spec: dict, element of spec['feeds']
+    :param data_dir: str
+    :param overrides: feed parameters replacing those of the spec
+    :return: bars: pandas.DataFrame indexed by datetime
+    '''
+    import pandas as pd
+
+    feed = build_feed(feed_spec, data_dir, **overrides)
+
+    # feeds need an environment to start, a throwaway cerebro provides it
+    bt.Cerebro().adddata(feed)
+    feed._start()
+    feed.preload()
+
+    columns = ['open', 'high', 'low', 'close', 'volume', 'openinterest']
+    bars = pd.DataFrame({column: list(getattr(feed.lines, column).array) for column in columns},
+                        index=pd.DatetimeIndex([bt.num2date(x) for x in feed.lines.datetime.array], name='datetime'))
+    feed.stop()
+    return bars
+
+
+def configure_cerebro(cerebro, spec, analyzers = True):
+    '''
+    applies the broker, sizer and analyzer setup of a spec to a cerebro instance.
+    :param cerebro: bt.Cerebro
+    :param spec: dict
+    :param analyzers: bool, add the analyzers of the spec
+    :return: cerebro: bt.Cerebro
+    '''
+    if spec['cash'] is not None:
+        cerebro.broker.setcash(spec['cash'])
+
+    if spec['sizer'] is not None:
+        cerebro.addsizer(getattr(bt.sizers, spec['sizer']['sizer']), **spec['sizer']['kwargs'])
+
+    if spec['commission'] is not None:
+        cerebro.broker.setcommission(**spec['commission'])
+
+    if analyzers:
+        for analyzer in spec['analyzers']:
+            cerebro.addanalyzer(getattr(bt.analyzers, analyzer['analyzer']), **analyzer['kwargs'])
+
+    return cerebro
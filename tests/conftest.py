@@ -0,0 +1,69 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+"""
+Shared fixtures: a synthetic daily price history in the Yahoo Finance CSV format of the example backtest.
+"""
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_CODE_PATH = os.path.join(REPO_DIR, 'resources', 'example_backtest.py')
+
+
+def write_yahoo_csv(path, start = '2019-01-01', end = '2023-06-30', seed = 7):
+    '''
+    writes a random walk with trends in the Yahoo Finance CSV format.
+    :param path: str
+    :return: bars: pandas.DataFrame
+    '''
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, end, freq='D')
+    drift = np.repeat(rng.normal(0, 0.004, size=len(dates) // 60 + 1), 60)[:len(dates)]
+    close = 4000 * np.exp(np.cumsum(drift + rng.normal(0, 0.025, size=len(dates))))
+    open_ = np.concatenate([[close[0]], close[:-1]])
+    high = np.maximum(open_, close) * (1 + rng.uniform(0, 0.02, size=len(dates)))
+    low = np.minimum(open_, close) * (1 - rng.uniform(0, 0.02, size=len(dates)))
+    bars = pd.DataFrame({'Date': dates.strftime('%Y-%m-%d'), 'Open': open_, 'High': high, 'Low': low,
+                         'Close': close, 'Adj Close': close,
+                         'Volume': rng.integers(1_000_000, 10_000_000, size=len(dates))})
+    bars.to_csv(path, index=False, float_format='%.6f')
+    return bars
+
+
+@pytest.fixture(scope='session')
+def data_dir(tmp_path_factory):
+    path = tmp_path_factory.mktemp('data')
+    write_yahoo_csv(os.path.join(path, 'BTC-USD.csv'))
+    return str(path)
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / 'cache')
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''
+    working directory with a settings.yaml for BtCopilot, outputs and caches are written below it.
+    :return: settings: dict
+    '''
+    settings = {'project_name': 'test', 'resources_dir': os.path.join(REPO_DIR, 'resources'),
+                'output_dir': str(tmp_path / 'outputs'), 'prompt_lib': 'prompt_library_default.csv',
+                'coding_temp': 0.3, 'strategy_descr_temp': 0.3, 'strategy_feedback_temp': 0.3,
+                'cache_dir': str(tmp_path / 'cache'), 'max_concurrency': 4, 'llm_timeout': 120,
+                'validate_code': True, 'max_fix_iterations': 2}
+    (tmp_path / 'settings.yaml').write_text(yaml.safe_dump(settings))
+    monkeypatch.chdir(tmp_path)
+    return settings
+
+
+@pytest.fixture(scope='session')
+def example_code():
+    with open(EXAMPLE_CODE_PATH) as f:
+        return f.read()
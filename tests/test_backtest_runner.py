@@ -0,0 +1,72 @@
+import os
+import time
+import pytest
+import backtest_runner
+
+
+def example_script(example_code, run_call):
+    code = example_code.replace('results = cerebro.run()', f'results = {run_call}')
+    code = code.replace("cerebro.plot(style='bar')", '')
+    return code + "\nprint('observers:', len(results[0].observers))\n"
+
+
+def test_run_arguments_are_kept_when_recording(example_code, data_dir):
+    code = example_script(example_code, 'cerebro.run(stdstats=False)')
+    result = backtest_runner.execute_code(code, cwd=data_dir, record=True)
+    assert result['ok'], result['error']
+    assert 'observers: 0' in result['stdout']
+    assert result['metrics']['total_trades'] > 0
+    assert len(result['equity_curve']['value']) > 0
+
+
+def test_feed_name_keyword(example_code, data_dir, cache_dir):
+    code = example_script(example_code, 'cerebro.run()').replace("dataname='BTC-USD.csv',",
+                                                                  "dataname='BTC-USD.csv', name='BTC',")
+    code += "print('feed:', results[0].datas[0]._name, type(results[0].datas[0]).__name__)\n"
+    result = backtest_runner.execute_code(code, cwd=data_dir, cache_dir=cache_dir)
+    assert result['ok'], result['error']
+    assert 'feed: BTC MemmapData' in result['stdout']
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason='reads the process state from /proc')
+def test_timeout_terminates_worker(tmp_path):
+    pid_path = tmp_path / 'pid'
+    code = f"import os, time\nopen({str(pid_path)!r}, 'w').write(str(os.getpid()))\ntime.sleep(60)\n"
+    runner = backtest_runner.BacktestRunner()
+    try:
+        result = runner.run(code, cwd=str(tmp_path), timeout=3)
+        assert not result['ok'] and 'did not finish' in result['error']
+        pid = int(pid_path.read_text())
+        deadline = time.time() + 10
+        while time.time() < deadline and _running(pid):
+            time.sleep(0.1)
+        assert not _running(pid)
+
+        # a fresh pool serves the next run
+        result = runner.run("print('done')", cwd=str(tmp_path), timeout=30)
+        assert result['ok'] and 'done' in result['stdout']
+    finally:
+        runner.close()
+
+
+def _running(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # zombies have exited, they only wait to be reaped
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def test_crashed_worker_is_replaced(tmp_path):
+    runner = backtest_runner.BacktestRunner()
+    try:
+        result = runner.run("import os\nos._exit(1)\n", cwd=str(tmp_path), timeout=30)
+        assert not result['ok'] and 'terminated abruptly' in result['error']
+        assert result['final_value'] is None and result['runs'] == []
+
+        # a fresh pool serves the next run
+        result = runner.run("print('done')", cwd=str(tmp_path), timeout=30)
+        assert result['ok'] and 'done' in result['stdout']
+    finally:
+        runner.close()
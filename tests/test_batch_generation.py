@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+import pytest
+from batch_generation import BatchGenerator, RateLimiter, load_batch
+from bt_copilot import BtCopilot
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class FlakyAgent:
+    """
+    Coding agent failing the first calls of every prompt with a rate limit error.
+    """
+    test_mode = False
+    client_pool = None
+
+    def __init__(self, failures = 0):
+        self.failures = failures
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def code(self, prompt, temperature, goal_code = None, semantic = True):
+        with self._lock:
+            self.calls.append((prompt, goal_code))
+            attempts = sum(call[0] == prompt for call in self.calls)
+        if attempts <= self.failures:
+            raise RateLimitError('429 too many requests')
+        return f'# generated\nprint({len(prompt)})\n'
+
+
+ROWS = [{'name': 'sma cross', 'strategy': 'Buy when the 10 day SMA crosses above the 30 day SMA.',
+         'analysers': 'Print the Sharpe ratio.'},
+        {'name': 'rsi', 'strategy': 'Buy when the RSI drops below 30, sell above 70.', 'custom': 'Use a 2% stop.'}]
+DEFAULTS = {'datapipeline': 'Use BTC-USD.csv from yahoo finance.'}
+
+
+@pytest.fixture
+def make_generator(workdir, tmp_path):
+    def make(agent, **kwargs):
+        kwargs.setdefault('requests_per_minute', None)
+        return BatchGenerator(BtCopilot(agent), output_dir=str(tmp_path / 'batch'), backoff=0.01, **kwargs)
+    return make
+
+
+@pytest.mark.parametrize('row', ROWS)
+def test_batch_prompt_matches_the_serial_flow(make_generator, row):
+    generator = make_generator(FlakyAgent())
+    copilot = generator.copilot
+    copilot.set_datapipeline(DEFAULTS['datapipeline'])
+    copilot.set_strategy(row['strategy'])
+    if 'analysers' in row:
+        copilot.set_analysers(row['analysers'])
+    if 'custom' in row:
+        copilot.set_custom_prompt(row['custom'])
+    copilot.compose_prompt_from_elements()
+
+    assert generator.compose_prompt(dict(DEFAULTS, **row)) == copilot.compiled_prompt
+
+
+def test_batch_uses_the_build_code_goal(make_generator):
+    generator = make_generator(FlakyAgent())
+    entries = generator.run(ROWS, defaults=DEFAULTS)
+    assert all(entry['ok'] for entry in entries)
+    assert {goal_code for _, goal_code in generator.copilot.coding_agent.calls} == {'build_code'}
+
+
+def test_rate_limiter_throttles():
+    limiter = RateLimiter(requests_per_minute=600, burst=1)
+    start = time.monotonic()
+    for _ in range(4):
+        limiter.acquire()
+    # the first request is sent at once, the others every 0.1 s
+    assert time.monotonic() - start >= 0.25
+
+
+def test_rate_limiter_pause_blocks_all_requests():
+    limiter = RateLimiter(requests_per_minute=None)
+    assert limiter.acquire() == 0.0
+    limiter.pause(0.2)
+    assert limiter.acquire() >= 0.15
+
+
+def test_failed_calls_are_retried(make_generator):
+    generator = make_generator(FlakyAgent(failures=2), max_retries=2)
+    entries = generator.run(ROWS[:1], defaults=DEFAULTS)
+    assert entries[0]['ok'] and entries[0]['attempts'] == 3 and entries[0]['error'] is None
+
+
+def test_rows_fail_after_the_last_retry(make_generator):
+    generator = make_generator(FlakyAgent(failures=5), max_retries=1)
+    entries = generator.run(ROWS[:1], defaults=DEFAULTS)
+    assert not entries[0]['ok'] and entries[0]['attempts'] == 2
+    assert entries[0]['error'].startswith('RateLimitError')
+
+
+def test_rerun_resumes_from_the_manifest(make_generator, tmp_path):
+    agent = FlakyAgent()
+    first = make_generator(agent).run(ROWS, defaults=DEFAULTS)
+    assert len(agent.calls) == 2
+
+    # an interrupted run leaves a partially written line behind
+    with open(tmp_path / 'batch' / 'manifest.jsonl', 'a') as f:
+        f.write('{"index": 5, "ok"')
+    second = make_generator(agent).run(ROWS + [{'strategy': 'Buy and hold.'}], defaults=DEFAULTS)
+    assert len(agent.calls) == 3
+    assert [entry.get('skipped', False) for entry in second] == [True, True, False]
+    assert [entry['file'] for entry in second[:2]] == [entry['file'] for entry in first]
+
+    # the entry written after the partial line is read back
+    make_generator(agent).run(ROWS + [{'strategy': 'Buy and hold.'}], defaults=DEFAULTS)
+    assert len(agent.calls) == 3
+
+    make_generator(agent).run(ROWS, defaults=DEFAULTS, resume=False)
+    assert len(agent.calls) == 5
+
+
+def test_load_batch_skips_empty_rows(tmp_path):
+    path = tmp_path / 'ideas.jsonl'
+    path.write_text('\n'.join(json.dumps(row) for row in ROWS + [{'name': 'empty'}]) + '\n')
+    assert [row['name'] for row in load_batch(str(path))] == ['sma cross', 'rsi']
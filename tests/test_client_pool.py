@@ -0,0 +1,64 @@
+import pytest
+
+openai = pytest.importorskip('openai')
+pytest.importorskip('langchain')
+
+import client_pool
+from client_pool import LLMClientPool
+from mock_llm_server import MockLLMServer
+
+
+@pytest.fixture
+def server():
+    with MockLLMServer(response_text='mock completion') as server:
+        yield server
+
+
+def test_clients_are_reused(server):
+    pool = LLMClientPool(API_KEY='test', pool_size=2, api_base=server.api_base)
+    try:
+        client = pool.get('text-davinci-003', 0.3)
+        assert pool.get('text-davinci-003', 0.30000001) is client
+        pool.get('text-davinci-003', 0.7)
+        pool.get('text-curie-001', 0.3)
+        # least recently used client is dropped beyond pool_size
+        assert pool.get('text-davinci-003', 0.7) is not None
+        stats = pool.stats()
+        assert stats['clients_created'] == 3 and stats['clients_reused'] == 2
+    finally:
+        pool.close()
+
+
+def test_requests_reuse_connections(server):
+    pool = LLMClientPool(API_KEY='test', api_base=server.api_base)
+    try:
+        client = pool.get('text-davinci-003', 0.3)
+        before = pool.stats()
+        answers = [client(f'prompt {i}') for i in range(3)]
+        stats = pool.stats()
+    finally:
+        pool.close()
+    assert answers == ['mock completion'] * 3
+    assert server.requests_served == 3
+    assert stats['requests_sent'] - before['requests_sent'] == 3
+    assert stats['connections_opened'] - before['connections_opened'] <= 1
+
+
+def test_pools_share_the_process_session(server):
+    first = LLMClientPool(API_KEY='test', api_base=server.api_base)
+    second = LLMClientPool(API_KEY='test', api_base=server.api_base)
+    assert first.session is second.session is openai.requestssession
+
+    # closing one pool leaves the session of the other in place
+    first.close()
+    first.close()
+    assert openai.requestssession is second.session
+    assert second.get('text-davinci-003', 0.3)('prompt') == 'mock completion'
+    second.close()
+
+    # the session stays installed for a later pool, threads of the openai package keep using it
+    third = LLMClientPool(API_KEY='test', api_base=server.api_base)
+    assert third.session is second.session is openai.requestssession
+    assert third.get('text-davinci-003', 0.3)('prompt') == 'mock completion'
+    third.close()
+    assert client_pool._shared['pools'] == 0
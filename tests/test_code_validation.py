@@ -0,0 +1,41 @@
+import pytest
+from backtest_runner import BacktestRunner
+from code_validation import CodeValidator, format_errors
+
+
+@pytest.fixture(scope='module')
+def runner(tmp_path_factory):
+    runner = BacktestRunner(cache_dir=str(tmp_path_factory.mktemp('cache')))
+    yield runner
+    runner.close()
+
+
+def test_example_passes_all_stages(example_code, data_dir, runner):
+    report = CodeValidator(backtest_runner=runner, cwd=data_dir, smoke_bars=20).validate(example_code)
+    assert report['ok'], format_errors(report)
+    assert list(report['timings']) == ['syntax', 'structure', 'names', 'data_files', 'smoke_test']
+    assert report['smoke_result']['runs']
+
+
+@pytest.mark.parametrize('old, new, stage', [
+    ('def next(self):', 'def next(self)', 'syntax'),
+    ('cerebro.addstrategy(SmaCross)', '', 'structure'),
+    ('if self.order:', 'if self.order or undefined_signal:', 'names'),
+    ("dataname='BTC-USD.csv'", "dataname='ETH-USD.csv'", 'data_files'),
+    ('self.dataclose = self.datas[0].close', 'self.dataclose = self.datas[0].close\n        1 / 0', 'smoke_test'),
+])
+def test_first_failing_stage(example_code, data_dir, runner, old, new, stage):
+    assert old in example_code
+    report = CodeValidator(backtest_runner=runner, cwd=data_dir, smoke_bars=20).validate(
+        example_code.replace(old, new, 1))
+    assert not report['ok']
+    assert report['stage'] == stage
+    assert report['errors'] and format_errors(report).startswith('- ')
+
+
+def test_smoke_test_is_optional(example_code, data_dir):
+    code = example_code.replace('self.dataclose = self.datas[0].close',
+                                'self.dataclose = self.datas[0].close\n        1 / 0')
+    assert CodeValidator(cwd=data_dir).validate(code)['ok']
+    report = CodeValidator(backtest_runner=BacktestRunner(), cwd=data_dir).validate(code, smoke_test=False)
+    assert report['ok'] and 'smoke_test' not in report['timings']
@@ -0,0 +1,102 @@
+import os
+import backtrader as bt
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import write_yahoo_csv
+from data_pipeline import TIMEFRAMES, DataPipeline, add_universe, align_arrays
+
+
+class _RecordBars(bt.Strategy):
+    def __init__(self):
+        self.bars = {data._name: [] for data in self.datas}
+
+    def next(self):
+        for data in self.datas:
+            if len(data) and (not self.bars[data._name] or self.bars[data._name][-1][0] != data.datetime[0]):
+                self.bars[data._name].append((data.datetime[0], data.open[0], data.high[0], data.low[0],
+                                              data.close[0], data.volume[0]))
+
+
+def _backtrader_resampled(path, rule):
+    cerebro = bt.Cerebro(stdstats=False)
+    timeframe, compression = TIMEFRAMES[rule]
+    cerebro.resampledata(bt.feeds.YahooFinanceCSVData(dataname=path), timeframe=timeframe, compression=compression,
+                         name='resampled')
+    cerebro.addstrategy(_RecordBars)
+    return np.array(cerebro.run()[0].bars['resampled'])
+
+
+@pytest.mark.parametrize('rule', ['W', 'M', 'Q', 'Y'])
+def test_resample_matches_cerebro(data_dir, cache_dir, rule):
+    path = os.path.join(data_dir, 'BTC-USD.csv')
+    expected = _backtrader_resampled(path, rule)
+    arrays = DataPipeline(cache_dir=cache_dir, max_workers=1).load({'BTC-USD': path}, rule=rule)['BTC-USD']
+    actual = np.column_stack([arrays[line] for line in ('datetime', 'open', 'high', 'low', 'close', 'volume')])
+
+    assert actual.shape == expected.shape
+    # same trading day of every bar, backtrader stamps resampled bars with the session end
+    np.testing.assert_array_equal(np.floor(actual[:, 0]), np.floor(expected[:, 0]))
+    np.testing.assert_allclose(actual[:, 1:], expected[:, 1:], rtol=1e-9)
+
+
+def test_resampled_feeds_in_cerebro(data_dir, cache_dir):
+    path = os.path.join(data_dir, 'BTC-USD.csv')
+    cerebro = bt.Cerebro(stdstats=False)
+    feeds = add_universe(cerebro, {'BTC-USD': path}, resample=['W'], cache_dir=cache_dir, max_workers=1)
+    assert list(feeds) == ['BTC-USD', 'BTC-USD_W']
+    cerebro.addstrategy(_RecordBars)
+    bars = cerebro.run()[0].bars
+    expected = _backtrader_resampled(path, 'W')
+    np.testing.assert_allclose(np.array(bars['BTC-USD_W'])[:, 1:], expected[:, 1:], rtol=1e-9)
+
+
+def test_align_fills_gaps_inside_history():
+    universe = {'A': {'datetime': np.array([1.0, 2.0, 3.0]), 'open': np.array([1.0, 2.0, 3.0]),
+                      'high': np.array([1.0, 2.0, 3.0]), 'low': np.array([1.0, 2.0, 3.0]),
+                      'close': np.array([1.0, 2.0, 3.0]), 'volume': np.array([5.0, 5.0, 5.0]),
+                      'openinterest': np.zeros(3)},
+                'B': {'datetime': np.array([2.0, 4.0]), 'open': np.array([20.0, 40.0]),
+                      'high': np.array([20.0, 40.0]), 'low': np.array([20.0, 40.0]),
+                      'close': np.array([21.0, 41.0]), 'volume': np.array([7.0, 7.0]),
+                      'openinterest': np.zeros(2)}}
+    aligned = align_arrays(universe)
+    np.testing.assert_array_equal(aligned['B']['datetime'], [1.0, 2.0, 3.0, 4.0])
+    np.testing.assert_array_equal(aligned['B']['close'], [np.nan, 21.0, 21.0, 41.0])
+    np.testing.assert_array_equal(aligned['B']['volume'], [np.nan, 7.0, 0.0, 7.0])
+    np.testing.assert_array_equal(aligned['A']['close'], [1.0, 2.0, 3.0, np.nan])
+    assert list(align_arrays(universe, how='intersection')['A']['datetime']) == [2.0]
+
+
+def test_resampled_universe_with_different_calendars(tmp_path, cache_dir):
+    paths = {'CRYPTO': str(tmp_path / 'CRYPTO.csv'), 'STOCK': str(tmp_path / 'STOCK.csv')}
+    write_yahoo_csv(paths['CRYPTO'], start='2021-01-01', end='2021-12-31')
+    bars = write_yahoo_csv(paths['STOCK'], start='2021-01-01', end='2021-12-31', seed=11)
+    # weekdays only, the weekly bars of the stock end on friday and those of the crypto symbol on sunday
+    bars[pd.to_datetime(bars['Date']).dt.dayofweek < 5].to_csv(paths['STOCK'], index=False, float_format='%.6f')
+
+    cerebro = bt.Cerebro(stdstats=False)
+    add_universe(cerebro, paths, resample=['W'], cache_dir=cache_dir, max_workers=1)
+    cerebro.addstrategy(_RecordBars)
+    recorded = cerebro.run()[0].bars
+
+    # one bar per week and symbol, no forward-filled bars on the other calendar
+    for symbol, path in paths.items():
+        actual = np.array(recorded[f'{symbol}_W'])
+        expected = _backtrader_resampled(path, 'W')
+        assert actual.shape == expected.shape
+        np.testing.assert_allclose(actual[:, 1:], expected[:, 1:], rtol=1e-9)
+
+
+def test_align_resampled_bars_on_periods():
+    # weekly bars: A ends on fridays (ordinals 5 and 12 are fridays), B on sundays and misses the second week
+    universe = {'A': {'datetime': np.array([5.0, 12.0, 19.0]), 'close': np.array([1.0, 2.0, 3.0])},
+                'B': {'datetime': np.array([7.0, 21.0]), 'close': np.array([10.0, 30.0])}}
+    for arrays in universe.values():
+        arrays.update({line: arrays['close'].copy() for line in ('open', 'high', 'low', 'volume', 'openinterest')})
+    aligned = align_arrays(universe, rule='W')
+    np.testing.assert_array_equal(aligned['A']['datetime'], [5.0, 12.0, 19.0])
+    # the missing week repeats the previous close at the end of the period as seen by A
+    np.testing.assert_array_equal(aligned['B']['datetime'], [7.0, 12.0, 21.0])
+    np.testing.assert_array_equal(aligned['B']['close'], [10.0, 10.0, 30.0])
+    np.testing.assert_array_equal(aligned['B']['volume'], [10.0, 0.0, 30.0])
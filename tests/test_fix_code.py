@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+from bt_copilot import BtCopilot
+from code_validation import CodeValidator
+
+BROKEN = ('if self.order:', 'if self.order or undefined_signal:')
+
+
+class ScriptedAgent:
+    """
+    Coding agent answering fix requests with prepared code.
+    """
+    test_mode = False
+
+    def __init__(self, generated, fixes):
+        self.generated = generated
+        self.fixes = list(fixes)
+        self.prompts = []
+
+    def code(self, prompt, temperature, goal_code = None, semantic = True):
+        self.prompts.append(prompt)
+        return self.fixes.pop(0)
+
+    def stream_code(self, prompt, temperature, goal_code = None, cached = True):
+        for line in self.generated.splitlines(keepends=True):
+            yield line
+
+    async def astream_code(self, prompt, temperature, goal_code = None, cached = True):
+        for line in self.generated.splitlines(keepends=True):
+            yield line
+
+
+@pytest.fixture
+def make_copilot(workdir, data_dir):
+    def make(generated, fixes):
+        copilot = BtCopilot(ScriptedAgent(generated, fixes))
+        copilot._code_validator = CodeValidator(cwd=data_dir)
+        copilot.compiled_prompt = 'SMA crossover on BTC-USD.csv'
+        return copilot
+    return make
+
+
+@pytest.fixture
+def broken_code(example_code):
+    return example_code.replace(*BROKEN)
+
+
+def test_failed_fixes_keep_the_code(make_copilot, broken_code):
+    copilot = make_copilot(broken_code, [broken_code.replace('undefined_signal', 'other_undefined'),
+                                         broken_code.replace('undefined_signal', 'third_undefined')])
+    copilot.code = broken_code
+    report = copilot.fix_code(smoke_test=False)
+    assert not report['ok'] and report['fix_iterations'] == 2
+    assert copilot.code == broken_code
+    # the second attempt fixes the first one
+    assert 'other_undefined' in copilot.coding_agent.prompts[1]
+
+
+def test_passing_fix_replaces_the_code(make_copilot, broken_code, example_code):
+    copilot = make_copilot(broken_code, [example_code])
+    copilot.code = broken_code
+    report = copilot.fix_code(smoke_test=False)
+    assert report['ok'] and report['fix_iterations'] == 1
+    assert copilot.code == example_code
+
+
+def _stream(copilot, asynchronous):
+    if not asynchronous:
+        return ''.join(copilot.stream_code_from_prompt())
+
+    async def collect():
+        return ''.join([chunk async for chunk in copilot.astream_code_from_prompt()])
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_stream_saves_only_passing_fix(make_copilot, broken_code, example_code, asynchronous):
+    copilot = make_copilot(broken_code, [example_code])
+    assert _stream(copilot, asynchronous) == broken_code
+    assert copilot.validation_report['ok'] and copilot.validation_report['fix_iterations'] == 1
+    assert copilot.code == example_code
+    with open(copilot._code_file_path()) as f:
+        assert f.read() == example_code
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_stream_keeps_failing_code(make_copilot, broken_code, asynchronous):
+    copilot = make_copilot(broken_code, [broken_code.replace('undefined_signal', 'other_undefined')] * 2)
+    assert _stream(copilot, asynchronous) == broken_code
+    assert not copilot.validation_report['ok']
+    assert copilot.code == broken_code
+    with open(copilot._code_file_path()) as f:
+        assert f.read() == broken_code
@@ -0,0 +1,31 @@
+import asyncio
+from bt_copilot import BtCopilot
+
+
+async def answer(value, delay = 0.0):
+    await asyncio.sleep(delay)
+    return value
+
+
+async def fail():
+    raise ValueError('llm error')
+
+
+def test_failures_are_returned_as_exceptions(workdir):
+    copilot = BtCopilot(coding_agent=None)
+    results = asyncio.run(copilot.gather_analyses({'description': answer('text'),
+                                                   'feedback': fail(),
+                                                   'visualisation': answer('late', delay=5)}, timeout=0.5))
+    assert results['description'] == 'text'
+    assert isinstance(results['feedback'], ValueError)
+    assert isinstance(results['visualisation'], asyncio.TimeoutError)
+
+
+def test_timeout_defaults_to_settings(workdir):
+    copilot = BtCopilot(coding_agent=None)
+    copilot.settings['llm_timeout'] = 0.1
+    results = asyncio.run(copilot.gather_analyses({'slow': answer('late', delay=5)}))
+    assert isinstance(results['slow'], asyncio.TimeoutError)
+
+    copilot.settings['llm_timeout'] = None
+    assert asyncio.run(copilot.gather_analyses({'slow': answer('done', delay=0.2)})) == {'slow': 'done'}
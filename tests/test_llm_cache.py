@@ -0,0 +1,61 @@
+from llm_cache import LLMResponseCache
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'cache' / 'llm.sqlite')
+    cache = LLMResponseCache(path)
+    key = LLMResponseCache.make_key('describe the strategy', 0.3, 'text-davinci-003', 2000)
+    assert cache.get(key) is None
+    cache.set(key, 'a crossover strategy')
+    assert cache.get(key) == 'a crossover strategy'
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'entries': 1,
+                             'bytes': len('a crossover strategy')}
+    cache.close()
+
+    reopened = LLMResponseCache(path)
+    assert reopened.get(key) == 'a crossover strategy'
+    reopened.clear()
+    assert reopened.get(key) is None and reopened.stats()['entries'] == 0
+    reopened.close()
+
+
+def test_key_covers_all_request_settings():
+    key = LLMResponseCache.make_key('prompt', 0.3, 'model', 2000)
+    assert key == LLMResponseCache.make_key('prompt', 0.30, 'model', 2000)
+    assert len({key,
+                LLMResponseCache.make_key('prompt ', 0.3, 'model', 2000),
+                LLMResponseCache.make_key('prompt', 0.7, 'model', 2000),
+                LLMResponseCache.make_key('prompt', 0.3, 'other', 2000),
+                LLMResponseCache.make_key('prompt', 0.3, 'model', 1000)}) == 5
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / 'llm.sqlite'), max_entries=2)
+    cache.set('a', 'first')
+    cache.set('b', 'second')
+    # reading a makes b the least recently used entry
+    cache._conn.execute("UPDATE responses SET last_access = last_access - 10 WHERE key = 'b'")
+    assert cache.get('a') == 'first'
+    cache.set('c', 'third')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'first' and cache.get('c') == 'third'
+    cache.close()
+
+
+def test_size_limit(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / 'llm.sqlite'), max_bytes=10)
+    cache.set('a', '123456')
+    cache._conn.execute("UPDATE responses SET last_access = last_access - 10 WHERE key = 'a'")
+    cache.set('b', '654321')
+    assert cache.get('a') is None and cache.get('b') == '654321'
+    assert cache.stats()['bytes'] == 6
+    cache.close()
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / 'llm.sqlite'), max_age_seconds=60)
+    cache.set('a', 'old answer')
+    cache._conn.execute("UPDATE responses SET created = created - 120 WHERE key = 'a'")
+    assert cache.get('a') is None
+    assert cache.stats()['entries'] == 0
+    cache.close()
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import time
+import pytest
+from bt_copilot import BtCopilot
+from metrics import MetricsRegistry, estimate_cost, percentile
+
+CHUNKS = ['The strategy ', 'buys dips ', 'and sells rallies.']
+
+
+class StreamingAgent:
+    """
+    Coding agent streaming a prepared answer slowly and recording the call in its registry.
+    """
+    test_mode = False
+    model_name = 'text-davinci-003'
+
+    def __init__(self, metrics, delay = 0.05):
+        self.metrics = metrics
+        self.delay = delay
+
+    def stream_LLMcall(self, prompt, temperature, goal_code = None):
+        start = time.perf_counter()
+        for chunk in CHUNKS:
+            time.sleep(self.delay)
+            yield chunk
+        self.metrics.record_call(model_name=self.model_name, prompt=prompt, completion=''.join(CHUNKS),
+                                 latency=time.perf_counter() - start, goal_code=goal_code, streamed=True)
+
+    async def astream_LLMcall(self, prompt, temperature, goal_code = None):
+        for chunk in self.stream_LLMcall(prompt, temperature, goal_code):
+            yield chunk
+
+
+@pytest.fixture
+def copilot(workdir):
+    copilot = BtCopilot(StreamingAgent(MetricsRegistry()))
+    copilot.set_strategy('Buy when the RSI drops below 30.')
+    return copilot
+
+
+def _spans(copilot, name):
+    return [span for span in copilot.coding_agent.metrics.spans if span['name'] == name]
+
+
+def test_percentile():
+    assert percentile([4, 1, 3, 2], 50) == 2.5
+    assert percentile([1, 2, 3, 4, 5], 0) == 1 and percentile([1, 2, 3, 4, 5], 100) == 5
+    assert percentile(list(range(101)), 95) == pytest.approx(95)
+    assert percentile([None, 7], 99) == 7
+    assert percentile([], 50) is None
+
+
+def test_summary_groups_calls():
+    registry = MetricsRegistry()
+    for latency in (0.1, 0.2, 0.3, 0.4):
+        registry.record_call('text-davinci-003', 'prompt', 'completion', latency=latency, goal_code='build_code')
+    registry.record_call('text-davinci-003', 'prompt', '', latency=1.0, goal_code='build_code', error='Timeout')
+    registry.record_call('text-davinci-003', 'other', 'completion', latency=0.5, goal_code='fix_code',
+                         cache_hit=True)
+
+    summary = registry.summary()
+    assert summary['build_code']['count'] == 5 and summary['build_code']['errors'] == 1
+    assert summary['build_code']['latency_p50'] == pytest.approx(0.3)
+    assert summary['fix_code']['cache_hit_rate'] == 1.0 and summary['fix_code']['cost'] == 0.0
+    assert summary['build_code']['cost'] > 0
+    assert estimate_cost('unknown-model', 10, 10) is None
+
+
+def test_stream_span_covers_the_iteration(copilot):
+    chunks = list(copilot.stream_strategy_feedback(feedback_basis='description'))
+    assert chunks == CHUNKS
+
+    span, = _spans(copilot, 'stream_strategy_feedback')
+    assert span['status'] == 'ok' and span['duration'] >= 3 * copilot.coding_agent.delay
+    # the llm call made while streaming belongs to the span
+    call, = copilot.coding_agent.metrics.calls
+    assert call['span_id'] == span['span_id'] and call['goal_code'] == 'get_strategy_feedback_from_description'
+
+
+def test_stream_closed_early_is_cancelled(copilot):
+    stream = copilot.stream_strategy_feedback(feedback_basis='description')
+    assert next(stream) == CHUNKS[0]
+    assert _spans(copilot, 'stream_strategy_feedback') == []
+    stream.close()
+
+    span, = _spans(copilot, 'stream_strategy_feedback')
+    assert span['status'] == 'cancelled'
+
+
+def test_async_stream_span_covers_the_iteration(copilot):
+    async def consume():
+        return [chunk async for chunk in copilot.astream_strategy_feedback(feedback_basis='description')]
+
+    assert asyncio.run(consume()) == CHUNKS
+    span, = _spans(copilot, 'astream_strategy_feedback')
+    assert span['status'] == 'ok' and span['duration'] >= 3 * copilot.coding_agent.delay
+    assert copilot.coding_agent.metrics.calls[0]['span_id'] == span['span_id']
+
+
+def test_nested_spans_and_jsonl_export(tmp_path):
+    trace_path = tmp_path / 'trace.jsonl'
+    registry = MetricsRegistry(trace_path=str(trace_path))
+    with registry.span('outer', ideas=2) as outer:
+        with registry.span('inner') as inner:
+            registry.record_call('text-davinci-003', 'prompt', 'completion', latency=0.1)
+    with pytest.raises(ValueError):
+        with registry.span('failing'):
+            raise ValueError('bad data')
+
+    assert inner['parent_span_id'] == outer['span_id'] and inner['trace_id'] == outer['trace_id']
+    assert registry.calls[0]['goal_code'] == 'inner'
+    assert registry.spans[-1]['status'] == 'error' and registry.spans[-1]['error'] == 'ValueError: bad data'
+
+    # every completed record is appended to the trace file as it happens
+    traced = [json.loads(line) for line in trace_path.read_text().splitlines()]
+    assert [record['type'] for record in traced] == ['llm_call', 'span', 'span', 'span']
+
+    export_path = tmp_path / 'export' / 'records.jsonl'
+    assert registry.export_jsonl(str(export_path)) == 4
+    exported = [json.loads(line) for line in export_path.read_text().splitlines()]
+    # sorted by start time, the outer span first
+    assert [record.get('name') for record in exported] == ['outer', 'inner', None, 'failing']
+    assert exported[0]['attributes'] == {'ideas': 2}
@@ -0,0 +1,83 @@
+import json
+import pytest
+import optimiser
+from optimiser import ParameterSweep, parameter_grid, random_search
+
+# an extra entry filter takes the strategy out of the vectorized template
+EXTRA_FILTER = ('if self.crossover > 0:', 'if self.crossover > 0 and self.dataclose[0] > self.dataclose[-5]:')
+
+
+def test_parameter_grid():
+    combinations = parameter_grid({'pfast': [5, 10], 'pslow': [20, 30, 40]})
+    assert len(combinations) == 6
+    assert combinations[0] == {'pfast': 5, 'pslow': 20} and combinations[-1] == {'pfast': 10, 'pslow': 40}
+    assert parameter_grid({}) == [{}]
+
+
+def test_random_search():
+    space = {'pfast': (5, 20), 'stop_loss': (0.05, 0.2), 'pslow': [30, 50]}
+    combinations = random_search(space, n_iter=50, seed=3)
+    assert combinations == random_search(space, n_iter=50, seed=3)
+    for params in combinations:
+        assert isinstance(params['pfast'], int) and 5 <= params['pfast'] <= 20
+        assert isinstance(params['stop_loss'], float) and 0.05 <= params['stop_loss'] <= 0.2
+        assert params['pslow'] in (30, 50)
+    # duplicates are removed
+    small = random_search({'pfast': [10], 'pslow': (20, 21)}, n_iter=50, seed=3)
+    assert sorted(params['pslow'] for params in small) == [20, 21]
+
+
+def test_checkpoint_resume(example_code, data_dir, cache_dir, tmp_path):
+    checkpoint_path = str(tmp_path / 'sweep.jsonl')
+    combinations = parameter_grid({'pfast': [5, 10], 'pslow': [20, 30]})
+
+    def sweep(code = example_code):
+        return ParameterSweep(code, data_dir=data_dir, cache_dir=cache_dir, checkpoint_path=checkpoint_path,
+                              engine='vectorized')
+
+    first = sweep().run(combinations[:2])
+    assert len(first) == 2
+
+    # mark a checkpointed row and leave a partially written line behind, like an interrupted sweep
+    with open(checkpoint_path) as f:
+        records = [json.loads(line) for line in f]
+    records[0]['row']['final_value'] = -1.0
+    with open(checkpoint_path, 'w') as f:
+        f.write(''.join(json.dumps(record) + '\n' for record in records) + '{"key": "abc", "ro')
+
+    results = sweep().run(combinations)
+    assert len(results) == 4 and results['final_value'].iloc[0] == -1.0
+    assert (results['final_value'].iloc[1:] > 0).all()
+    assert list(results['pfast']) == [5, 5, 10, 10]
+    # the new records start on a line of their own
+    with open(checkpoint_path) as f:
+        assert len(f.read().splitlines()) == 5
+    assert len(sweep()._load_checkpoint()) == 4
+
+    # checkpointed rows are only reused for the same code
+    changed = sweep(example_code.replace('setcash(', 'setcash(2 * ')).run(combinations[:1])
+    assert changed['final_value'].iloc[0] > 0
+
+
+def test_auto_engine_falls_back_to_backtrader(example_code, data_dir, cache_dir, tmp_path):
+    code = example_code.replace(*EXTRA_FILTER)
+    assert code != example_code
+    sweep = ParameterSweep(code, data_dir=data_dir, cache_dir=cache_dir, max_workers=1, engine='auto',
+                           checkpoint_path=str(tmp_path / 'sweep.jsonl'))
+    assert sweep.engine == 'backtrader'
+
+    results = sweep.run([{'pfast': 5, 'pslow': 20}, {'pfast': 10, 'pslow': 30}])
+    assert list(results['engine']) == ['backtrader', 'backtrader']
+    assert list(results['pfast']) == [5, 10] and (results['total_trades'] > 0).all()
+
+
+def test_code_without_backtest_is_rejected(example_code):
+    with pytest.raises(ValueError):
+        ParameterSweep('import backtrader as bt\ncerebro = bt.Cerebro()\n')
+    with pytest.raises(ValueError):
+        ParameterSweep(example_code.replace('cerebro.addstrategy(', 'print('))
+
+
+def test_params_key_ignores_order():
+    assert optimiser.params_key({'a': 1, 'b': 2}) == optimiser.params_key({'b': 2, 'a': 1})
+    assert optimiser.params_key({'a': 1}) != optimiser.params_key({'a': 2})
@@ -0,0 +1,84 @@
+import ast
+import pytest
+from code_validation import check_names
+from prompt_compaction import PromptCompactor, count_tokens, strip_code
+
+CONSTANT_SETUP = '''
+import os
+from datetime import datetime
+import backtrader as bt
+
+DATA_DIR = 'data'
+PATH = os.path.join(DATA_DIR, 'BTC-USD.csv')
+START, END = datetime(2020, 1, 1), datetime(2022, 12, 31)
+FAST = 10
+UNUSED = 'not part of the backtest'
+
+
+class SmaCross(bt.Strategy):
+    params = (('pfast', FAST),)
+
+    def __init__(self):
+        self.sma = bt.ind.SMA(period=self.p.pfast)
+
+    def log(self, txt):
+        print(txt)
+
+    def next(self):
+        self.log('next bar')
+        if not self.position and self.data.close[0] > self.sma[0]:
+            self.buy()
+
+
+cerebro = bt.Cerebro()
+data = bt.feeds.YahooFinanceCSVData(dataname=PATH, fromdate=START, todate=END)
+cerebro.adddata(data)
+cerebro.addstrategy(SmaCross)
+print('Starting value', cerebro.broker.getvalue())
+cerebro.run()
+'''
+
+
+class _Agent:
+    model_name = 'text-davinci-003'
+    max_tokens = 100
+
+
+def test_constant_driven_feed_setup_survives():
+    stripped = strip_code(CONSTANT_SETUP)
+    assert check_names(ast.parse(stripped)) == []
+    for line in ("DATA_DIR = 'data'", "PATH = os.path.join(DATA_DIR, 'BTC-USD.csv')",
+                 'START, END = (datetime(2020, 1, 1), datetime(2022, 12, 31))', 'FAST = 10',
+                 'bt.feeds.YahooFinanceCSVData(dataname=PATH, fromdate=START, todate=END)'):
+        assert line in stripped
+    assert 'UNUSED' not in stripped
+    assert 'print' not in stripped and 'self.log' not in stripped
+
+
+def test_example_has_no_undefined_names(example_code):
+    stripped = strip_code(example_code)
+    assert check_names(ast.parse(stripped)) == []
+    assert "dataname='BTC-USD.csv'" in stripped
+    assert len(stripped) < len(example_code)
+
+
+def test_code_within_budget_is_unchanged(example_code):
+    tokens = count_tokens(example_code)
+    compactor = PromptCompactor(_Agent(), prompt_library=None, context_tokens=tokens + 200)
+    code, report = compactor.compact(example_code, template_tokens=50)
+    assert code == example_code
+    assert report['stage'] == 'unchanged' and report['tokens_after'] == tokens
+
+
+def test_code_over_budget_is_stripped(example_code):
+    stripped_tokens = count_tokens(strip_code(example_code))
+    compactor = PromptCompactor(_Agent(), prompt_library=None, context_tokens=stripped_tokens + 150)
+    code, report = compactor.compact(example_code, template_tokens=50)
+    assert report['stage'] == 'stripped'
+    assert code == strip_code(example_code)
+    assert check_names(ast.parse(code)) == []
+
+
+@pytest.mark.parametrize('code', ['x = (', ''])
+def test_unparsable_code_is_returned(code):
+    assert strip_code(code) == code
@@ -0,0 +1,21 @@
+import csv
+import os
+from conftest import REPO_DIR
+from prompt_library import PromptLibrary, REQUIRED_TEMPLATES
+
+DEFAULT_LIBRARY = os.path.join(REPO_DIR, 'resources', 'prompt_library_default.csv')
+
+
+def test_default_library_has_all_templates():
+    library = PromptLibrary(DEFAULT_LIBRARY)
+    assert set(REQUIRED_TEMPLATES) <= set(library.templates)
+    assert '\r' not in library.templates['fix_code']
+
+
+def test_default_library_keeps_crlf_records():
+    with open(DEFAULT_LIBRARY, 'rb') as f:
+        data = f.read().decode('utf-8')
+    rows = list(csv.reader(data.splitlines(keepends=True)))
+    # records end with CRLF, line breaks inside quoted prompts are LF
+    assert data.count('\r\n') == len(rows) - 1
+    assert not data.endswith('\n')
@@ -0,0 +1,45 @@
+import os
+import results_store
+
+
+def test_round_trip(tmp_path, example_code, data_dir):
+    store = results_store.ResultsStore(str(tmp_path / 'store' / 'results.sqlite'))
+    fingerprint = store.data_fingerprint(example_code, cwd=data_dir)
+    assert fingerprint is not None
+
+    metrics = {'sharpe': 1.2, 'max_drawdown': 8.5, 'total_trades': 12, 'final_value': 104000.0}
+    result = {'ok': True, 'final_value': 104000.0, 'trades': [{'pnl_net': 40.5}]}
+    key = store.record(example_code, {'pfast': 5}, fingerprint, metrics, result=result, project='test')
+    assert key == results_store.run_key(example_code, {'pfast': 5}, fingerprint)
+    assert store.get(key) == result
+
+    rows = [{'code': example_code, 'params': {'pfast': fast}, 'data_fingerprint': fingerprint,
+             'metrics': {'sharpe': fast / 10, 'max_drawdown': fast}, 'engine': 'vectorized'}
+            for fast in range(10, 15)]
+    store.record_many(rows)
+    assert store.count() == 6
+
+    top = store.query(where=[('max_drawdown', '<', 14), ('engine', '=', 'vectorized')], order_by='sharpe', limit=2)
+    assert [row['params'] for row in top] == [{'pfast': 13}, {'pfast': 12}]
+
+    # runs without details come back as their row
+    row = store.get(results_store.run_key(example_code, {'pfast': 10}, fingerprint, 'vectorized'))
+    assert row['sharpe'] == 1.0 and row['params'] == {'pfast': 10}
+
+    # the store survives reopening
+    store.close()
+    reopened = results_store.ResultsStore(str(tmp_path / 'store' / 'results.sqlite'))
+    assert reopened.get(key) == result
+    reopened.close()
+
+
+def test_data_fingerprint_follows_file_content(tmp_path, example_code):
+    path = tmp_path / 'BTC-USD.csv'
+    path.write_text('Date,Open,High,Low,Close,Adj Close,Volume\n2020-01-01,1,1,1,1,1,1\n')
+    store = results_store.ResultsStore(str(tmp_path / 'results.sqlite'))
+    first = store.data_fingerprint(example_code, cwd=str(tmp_path))
+    path.write_text('Date,Open,High,Low,Close,Adj Close,Volume\n2020-01-01,2,2,2,2,2,2\n')
+    os.utime(path, (1, 1))
+    assert store.data_fingerprint(example_code, cwd=str(tmp_path)) != first
+    assert store.data_fingerprint(example_code, cwd=str(tmp_path / 'missing')) is None
+    store.close()
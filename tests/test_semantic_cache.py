@@ -0,0 +1,73 @@
+import pytest
+import semantic_cache
+from semantic_cache import SemanticCache, guard_signature, tokenise
+
+OPPOSITE_PROMPTS = [
+    ('Buy when RSI below 30, sell above 70', 'Sell when RSI below 30, buy above 70'),
+    ('Go long when the 10 day SMA crosses the 50 day SMA', 'Go long when the 50 day SMA crosses the 10 day SMA'),
+    ('Buy when the close is below the lower Bollinger band and sell when it is above the upper band',
+     'Buy when the close is above the upper Bollinger band and sell when it is below the lower band'),
+]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SemanticCache(str(tmp_path / 'semantic' / 'cache.sqlite'), threshold=0.8)
+    yield cache
+    cache.close()
+
+
+@pytest.mark.parametrize('stored, query', OPPOSITE_PROMPTS)
+def test_guard_keeps_roles(stored, query):
+    assert sorted(tokenise(stored)) == sorted(tokenise(query))
+    assert guard_signature(tokenise(stored)) != guard_signature(tokenise(query))
+
+
+@pytest.mark.parametrize('stored, query', OPPOSITE_PROMPTS)
+def test_opposite_prompts_miss(cache, stored, query):
+    cache.set(stored, 'stored code', namespace='build_code')
+    response, _ = cache.lookup(query, namespace='build_code')
+    assert response is None
+    assert cache.lookup(stored, namespace='build_code')[0] == 'stored code'
+
+
+def test_paraphrase_hits(cache):
+    cache.set('7/13 day MA crossover with 15% stop', 'sma code', namespace='build_code')
+    response, similarity = cache.lookup('cross of 7 and 13 day moving averages, stop loss 15 percent',
+                                        namespace='build_code')
+    assert response == 'sma code' and similarity >= 0.8
+    assert cache.lookup('7/21 day MA crossover with 15% stop', namespace='build_code')[0] is None
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = SemanticCache(path)
+    cache.set('RSI 14 strategy, buy below 30', 'rsi code', namespace='build_code', model_key='gpt|0.3')
+    assert cache.lookup('RSI 14 strategy, buy below 30', namespace='build_code', model_key='gpt|0.3')[0] == 'rsi code'
+    # namespaces and model settings are kept apart
+    assert cache.lookup('RSI 14 strategy, buy below 30', namespace='describe', model_key='gpt|0.3')[0] is None
+    assert cache.lookup('RSI 14 strategy, buy below 30', namespace='build_code', model_key='gpt|0.7')[0] is None
+    assert cache.stats()['build_code'] == {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'entries': 1}
+    cache.close()
+
+    reopened = SemanticCache(path)
+    assert reopened.lookup('RSI 14 strategy, buy below 30', namespace='build_code', model_key='gpt|0.3')[0] == \
+        'rsi code'
+    reopened.clear('build_code')
+    assert reopened.stats().get('build_code', {}).get('entries', 0) == 0
+    reopened.close()
+
+
+def test_eviction(tmp_path):
+    cache = SemanticCache(str(tmp_path / 'cache.sqlite'), max_entries_per_namespace=2)
+    for period in (10, 20, 30):
+        cache.set(f'SMA {period} strategy', f'code {period}', namespace='build_code')
+    assert cache.stats()['build_code']['entries'] == 2
+    assert cache.lookup('SMA 10 strategy', namespace='build_code')[0] is None
+    assert cache.lookup('SMA 30 strategy', namespace='build_code')[0] == 'code 30'
+    cache.close()
+
+
+def test_module_guard_words_are_normalised():
+    # guard words are compared after tokenise(), plural or synonym forms must not be needed
+    assert all(semantic_cache._stem(word) == word for word in semantic_cache.GUARD_WORDS)
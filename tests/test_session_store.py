@@ -0,0 +1,91 @@
+import os
+import shutil
+import pytest
+from bt_copilot import BtCopilot
+from conftest import REPO_DIR
+from prompt_library import PromptLibrary
+from session_store import SessionStore
+
+ANSWERS = ['sessions', 'Use BTC-USD.csv from yahoo finance.', 'Buy when the RSI drops below 30.',
+           'Print the Sharpe ratio.', 'n']
+
+
+class NoLLMAgent:
+    """
+    Coding agent failing every llm call, the autopilot steps tested here only fill prompt templates.
+    """
+    test_mode = False
+    metrics = None
+
+    def __getattr__(self, name):
+        raise AssertionError(f'unexpected call of {name}')
+
+
+def test_step_reuses_output_for_unchanged_inputs(tmp_path):
+    path = str(tmp_path / 'session.json')
+    calls = []
+
+    def run():
+        calls.append(1)
+        return f'output {len(calls)}'
+
+    assert SessionStore(path).step('build', {'prompt': 'a'}, run) == ('output 1', False)
+    # a new store reads the session file
+    assert SessionStore(path).step('build', {'prompt': 'a'}, run) == ('output 1', True)
+    assert SessionStore(path).step('build', {'prompt': 'b'}, run) == ('output 2', False)
+
+    def fail():
+        raise RuntimeError('llm unavailable')
+    with pytest.raises(RuntimeError):
+        SessionStore(path).step('feedback', {}, fail)
+    assert SessionStore(path).step('feedback', {}, run) == ('output 3', False)
+
+
+@pytest.fixture
+def run_autopilot(workdir, tmp_path, monkeypatch):
+    library_path = str(tmp_path / 'prompt_library.csv')
+    shutil.copy(os.path.join(REPO_DIR, 'resources', 'prompt_library_default.csv'), library_path)
+
+    def run(answers):
+        answers = iter(answers)
+        monkeypatch.setattr('builtins.input', lambda prompt='': next(answers))
+        copilot = BtCopilot(NoLLMAgent())
+        copilot.prompt_library = PromptLibrary(library_path)
+        built = []
+
+        def recorded(element, set_element):
+            def set_recorded(user_input):
+                built.append(element)
+                set_element(user_input)
+            return set_recorded
+
+        for element in ('datapipeline', 'strategy', 'analysers'):
+            setattr(copilot, f'set_{element}', recorded(element, getattr(copilot, f'set_{element}')))
+        copilot.autopilot()
+        return copilot, built
+    run.library_path = library_path
+    return run
+
+
+def test_autopilot_resumes_and_follows_the_prompt_library(run_autopilot):
+    first, built = run_autopilot(ANSWERS)
+    assert built == ['datapipeline', 'strategy', 'analysers']
+
+    # enter keeps the previous answers, the finished steps are reused
+    second, built = run_autopilot(['sessions', '', '', '', ''])
+    assert built == []
+    assert second.prompt_elements == first.prompt_elements
+
+    # an edited template builds the elements using it again
+    with open(run_autopilot.library_path, newline='') as f:
+        library = f.read()
+    template = first.prompt_library.template('set_strategy')
+    with open(run_autopilot.library_path, 'w', newline='') as f:
+        f.write(library.replace(template, 'Trading rules: {user_input}', 1))
+    stat = os.stat(run_autopilot.library_path)
+    os.utime(run_autopilot.library_path, (stat.st_atime, stat.st_mtime + 10))
+
+    third, built = run_autopilot(['sessions', '', '', '', ''])
+    assert built == ['strategy']
+    assert third.prompt_elements['strategy'] == 'Trading rules: Buy when the RSI drops below 30.'
+    assert third.prompt_elements['datapipeline'] == first.prompt_elements['datapipeline']
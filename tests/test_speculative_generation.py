@@ -0,0 +1,77 @@
+import threading
+import pytest
+
+pytest.importorskip('openai')
+pytest.importorskip('langchain')
+
+from backtest_runner import BacktestRunner
+from code_validation import CodeValidator
+from coding_agent import SimpleCodingAgent
+from mock_llm_server import MockLLMServer
+from speculative_generation import SpeculativeGenerator
+
+
+def in_turn(*texts):
+    '''
+    responder answering the requests with the texts in turn.
+    '''
+    lock = threading.Lock()
+    served = []
+
+    def respond(prompt):
+        with lock:
+            served.append(prompt)
+            return texts[(len(served) - 1) % len(texts)]
+    return respond
+
+
+@pytest.fixture
+def invalid_code(example_code):
+    return example_code.replace('if self.order:', 'if self.order or undefined_signal:')
+
+
+def test_first_valid_candidate_wins(example_code, invalid_code, data_dir):
+    runner = BacktestRunner(max_workers=2)
+    validator = CodeValidator(backtest_runner=runner, cwd=data_dir)
+    with MockLLMServer(responder=in_turn(invalid_code, example_code), token_latency=0.001) as server:
+        agent = SimpleCodingAgent(API_KEY='test', model_name='text-curie-001', api_base=server.api_base)
+        result = SpeculativeGenerator(agent, validator, temperatures=[0.3, 0.7]).generate('SMA crossover')
+        assert server.requests_served == 2
+
+    assert result['ok'] and result['code'] == example_code
+    assert result['report']['smoke_result']['ok']
+    statuses = {candidate['index']: candidate['status'] for candidate in result['candidates']}
+    assert statuses[result['winner']] == 'passed'
+    loser, = [candidate for candidate in result['candidates'] if candidate['index'] != result['winner']]
+    assert loser['status'] == 'failed' and loser['stage'] == 'names'
+    assert any('undefined_signal' in error for error in loser['errors'])
+    # the smoke test workers are shut down with the generation
+    assert runner._executor is None
+
+
+def test_losing_stream_is_cancelled(example_code, invalid_code, data_dir):
+    # the invalid candidate is long, streaming it completely would take more than 10 seconds
+    slow_invalid = invalid_code + '\n' + '# padding\n' * 5000
+    validator = CodeValidator(cwd=data_dir)
+    with MockLLMServer(responder=in_turn(example_code, slow_invalid), token_latency=0.002) as server:
+        agent = SimpleCodingAgent(API_KEY='test', model_name='text-curie-001', api_base=server.api_base)
+        result = SpeculativeGenerator(agent, validator, temperatures=[0.3, 0.3],
+                                      smoke_test=False).generate('SMA crossover')
+
+    assert result['ok'] and result['code'] == example_code
+    assert result['runtime'] < 5
+    loser, = [candidate for candidate in result['candidates'] if candidate['index'] != result['winner']]
+    assert loser['status'] == 'cancelled' and loser['errors'] == []
+
+
+def test_no_valid_candidate(invalid_code, data_dir):
+    validator = CodeValidator(cwd=data_dir)
+    with MockLLMServer(responder=in_turn(invalid_code)) as server:
+        agent = SimpleCodingAgent(API_KEY='test', model_name='text-curie-001', api_base=server.api_base)
+        result = SpeculativeGenerator(agent, validator, temperatures=[0.3, 0.7],
+                                      smoke_test=False).generate('SMA crossover')
+
+    # the first completed candidate is returned with its report
+    assert not result['ok'] and result['winner'] is None
+    assert result['code'] == invalid_code and result['report']['stage'] == 'names'
+    assert {candidate['status'] for candidate in result['candidates']} == {'failed'}
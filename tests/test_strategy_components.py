@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+import threading
+import pytest
+from bt_copilot import BtCopilot
+from conftest import REPO_DIR
+from prompt_library import PromptLibrary
+from strategy_components import ComponentAnalyser, extract_components
+
+LIBRARY = PromptLibrary(os.path.join(REPO_DIR, 'resources', 'prompt_library_default.csv'))
+
+
+class CountingAgent:
+    """
+    Coding agent answering every prompt with a numbered analysis.
+    """
+    test_mode = False
+    metrics = None
+
+    def __init__(self, model_name = 'text-davinci-003'):
+        self.model_name = model_name
+        self.prompts = []
+        self._lock = threading.Lock()
+
+    def simple_LLMcall(self, prompt, temperature, goal_code = None):
+        with self._lock:
+            self.prompts.append(prompt)
+            return f'analysis {len(self.prompts)}'
+
+
+def analyse(analyser, code, temperature = 0.3, goal_code = 'get_component_feedback'):
+    stats = {}
+    results = analyser.analyse(extract_components(code), goal_code=goal_code, temperature=temperature, stats=stats)
+    return results, stats
+
+
+def test_unchanged_components_are_reused(example_code, tmp_path):
+    path = str(tmp_path / 'components.json')
+    agent = CountingAgent()
+    first, stats = analyse(ComponentAnalyser(agent, LIBRARY, path=path), example_code)
+    assert stats['analysed'] == stats['components'] == len(first)
+
+    # a new session reads the stored results, comment and logging changes are not edits
+    edited = example_code.replace('def next(self):', 'def next(self):\n        # look for crossovers')
+    second, stats = analyse(ComponentAnalyser(agent, LIBRARY, path=path), edited)
+    assert stats['analysed'] == 0 and second == first
+    assert len(agent.prompts) == len(first)
+
+
+def test_edited_component_is_reanalysed_and_replaced(example_code, tmp_path):
+    path = str(tmp_path / 'components.json')
+    agent = CountingAgent()
+    analyser = ComponentAnalyser(agent, LIBRARY, path=path)
+    first, _ = analyse(analyser, example_code)
+    edited = example_code.replace('setcash(', 'setcash(2 * ')
+    assert edited != example_code
+
+    second, stats = analyse(analyser, edited)
+    changed = [name for name in second if second[name] != first[name]]
+    assert stats['analysed'] == 1 and changed == ['broker']
+    # the result of the old broker component is dropped, the store does not grow with every edit
+    with open(path) as f:
+        assert len(json.load(f)) == len(first)
+
+
+def test_model_and_temperature_are_part_of_the_key(example_code):
+    agent = CountingAgent()
+    analyser = ComponentAnalyser(agent, LIBRARY)
+    components = len(analyse(analyser, example_code)[0])
+
+    assert analyse(analyser, example_code, temperature=0.7)[1]['analysed'] == components
+    agent.model_name = 'gpt-3.5-turbo-instruct'
+    assert analyse(analyser, example_code, temperature=0.7)[1]['analysed'] == components
+    assert analyse(analyser, example_code, goal_code='get_component_description')[1]['analysed'] == components
+    # every combination is kept side by side
+    agent.model_name = 'text-davinci-003'
+    assert analyse(analyser, example_code)[1]['analysed'] == 0
+
+
+def test_store_is_bounded(example_code):
+    analyser = ComponentAnalyser(CountingAgent(), LIBRARY, max_entries=3)
+    results, stats = analyse(analyser, example_code)
+    assert stats['components'] > 3 and len(results) == stats['components']
+    assert len(analyser._results) == 3
+
+
+def test_concurrent_analyses_keep_their_own_statistics(workdir, example_code, capsys):
+    copilot = BtCopilot(CountingAgent())
+    copilot.code = example_code
+
+    async def analyse_both():
+        return await asyncio.gather(copilot.aget_strategy_feedback(incremental=True),
+                                    copilot.aget_strategy_description(incremental=True))
+
+    feedback, description = asyncio.run(analyse_both())
+    components = len(extract_components(example_code))
+    assert feedback != description
+    assert copilot.components == extract_components(example_code)
+    lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith('Incremental analysis')]
+    assert lines == [f'Incremental analysis: {components} of {components} components analysed, 0 reused'] * 2
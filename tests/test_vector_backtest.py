@@ -0,0 +1,69 @@
+import pytest
+import optimiser
+import vector_backtest
+
+INVERTED_ENTRY = ('if self.crossover > 0:', 'if self.crossover < 0:')
+EXTRA_FILTER = ('if self.crossover > 0:', 'if self.crossover > 0 and self.dataclose[0] > self.dataclose[-5]:')
+NO_ORDER_GUARD = ('if self.order:\n            return\n', '')
+SELL_ON_ENTRY = ('self.order = self.buy()', 'self.order = self.sell()')
+
+
+def mutate(code, replacement):
+    old, new = replacement
+    assert old in code
+    return code.replace(old, new, 1)
+
+
+def test_detects_example(example_code):
+    signal = vector_backtest.detect_signal_strategy(example_code)
+    assert signal['strategy'] == 'SmaCross'
+    assert (signal['fast'], signal['slow']) == ('pfast', 'pslow')
+    assert (signal['take_profit'], signal['stop_loss']) == ('take_profit', 'stop_loss')
+
+
+def test_exits_are_optional(example_code):
+    code = example_code
+    for condition in ('elif self.dataclose[0] >= self.buyprice * (1.0 + self.params.take_profit):',
+                      'elif self.dataclose[0] <= self.buyprice * (1.0 - self.params.stop_loss):'):
+        start = code.index(condition)
+        end = code.index('self.order = self.sell()', start) + len('self.order = self.sell()')
+        code = code[:start] + code[end:]
+    signal = vector_backtest.detect_signal_strategy(code)
+    assert signal is not None
+    assert (signal['take_profit'], signal['stop_loss']) == (None, None)
+
+
+@pytest.mark.parametrize('replacement', [INVERTED_ENTRY, EXTRA_FILTER, NO_ORDER_GUARD, SELL_ON_ENTRY])
+def test_rejects_changed_trading_logic(example_code, replacement):
+    assert vector_backtest.detect_signal_strategy(mutate(example_code, replacement)) is None
+
+
+@pytest.mark.parametrize('params', [{'pfast': 5, 'pslow': 20}, {}])
+def test_parity_on_example(example_code, data_dir, cache_dir, params):
+    comparison = vector_backtest.parity_check(example_code, [params], data_dir=data_dir, cache_dir=cache_dir)
+    assert comparison['match'].all(), comparison[~comparison['match']]
+    assert comparison.loc[comparison['metric'] == 'total_trades', 'backtrader'].iloc[0] > 0
+
+
+@pytest.mark.parametrize('replacement', [INVERTED_ENTRY, EXTRA_FILTER])
+def test_mutated_strategies_run_on_backtrader(example_code, data_dir, cache_dir, replacement):
+    code = mutate(example_code, replacement)
+    params = {'pfast': 5, 'pslow': 20}
+    with pytest.raises(ValueError):
+        vector_backtest.VectorizedBacktest(code, data_dir=data_dir, cache_dir=cache_dir)
+    with pytest.raises(ValueError):
+        optimiser.ParameterSweep(code, data_dir=data_dir, cache_dir=cache_dir, engine='vectorized')
+
+    sweep = optimiser.ParameterSweep(code, data_dir=data_dir, cache_dir=cache_dir, max_workers=1, engine='auto')
+    assert sweep.engine == 'backtrader'
+    row = sweep.run([params]).iloc[0]
+
+    optimiser._init_worker(code, data_dir, cache_dir)
+    reference = optimiser._run_combination(params)
+    assert row['final_value'] == pytest.approx(reference['final_value'])
+    assert row['total_trades'] == reference['total_trades']
+
+
+def test_auto_engine_uses_vectorized_for_example(example_code, data_dir, cache_dir):
+    sweep = optimiser.ParameterSweep(example_code, data_dir=data_dir, cache_dir=cache_dir, engine='auto')
+    assert sweep.engine == 'vectorized'
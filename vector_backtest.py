@@ -0,0 +1,558 @@
+import ast
+import math
+import backtrader as bt
+import numpy as np
+import data_cache
+import strategy_loader
+
+"""
+Vectorized fast-path backtester for simple signal strategies.
+Covers the common subset of generated strategies: long-only SMA crossover entries, exits on the opposite cross and
+optional stop-loss/take-profit relative to the entry price, fixed size orders and percentage commission.
+Indicators and signals are computed as NumPy array operations and the simulation only visits trades, not bars.
+Fills follow backtrader's defaults (market orders execute at the next bar's open, orders are rejected when the cash
+does not cover them at the creating bar's close), so results match backtrader for supported strategies.
+Use parity_check() to compare both engines on a strategy.
+"""
+
+_SMA_NAMES = ('SimpleMovingAverage', 'SMA', 'MovingAverageSimple')
+_LOGGING_CALLS = ('log', 'print')
+_CLOSE_LINES = ('self.datas[0].close', 'self.data.close', 'self.data0.close')
+
+
+def _self_param(node):
+    '''
+    returns X for self.params.X / self.p.X, otherwise None.
+    :param node: ast node
+    :return: param name: str or None
+    '''
+    chain = strategy_loader._attribute_chain(node)
+    if len(chain) == 3 and chain[0] == 'self' and chain[1] in ('params', 'p'):
+        return chain[2]
+    return None
+
+
+def _self_attribute(node):
+    '''
+    returns X for self.X, otherwise None.
+    :param node: ast node
+    :return: attribute name: str or None
+    '''
+    chain = strategy_loader._attribute_chain(node)
+    if len(chain) == 2 and chain[0] == 'self':
+        return chain[1]
+    return None
+
+
+def _is_logging(statement):
+    return isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Call) and \
+        strategy_loader._attribute_chain(statement.value.func)[-1:] in [[name] for name in _LOGGING_CALLS]
+
+
+def _block(body):
+    '''
+    statements of a block without logging calls, which do not change the simulation.
+    '''
+    return [statement for statement in body if not _is_logging(statement)]
+
+
+def _assigned(method, attribute):
+    '''
+    values assigned to self.<attribute> in a method.
+    :return: list of ast nodes
+    '''
+    return [node.value for node in ast.walk(method) if isinstance(node, ast.Assign) and len(node.targets) == 1
+            and _self_attribute(node.targets[0]) == attribute]
+
+
+def _is_order(statement, names):
+    '''
+    checks for self.order = self.<name>() or self.<name>() without arguments.
+    '''
+    if isinstance(statement, ast.Assign) and len(statement.targets) == 1 and \
+            _self_attribute(statement.targets[0]) == 'order':
+        call = statement.value
+    elif isinstance(statement, ast.Expr):
+        call = statement.value
+    else:
+        return False
+    return isinstance(call, ast.Call) and not call.args and not call.keywords and \
+        strategy_loader._attribute_chain(call.func) in [['self', name] for name in names]
+
+
+def _is_cross(test, crossover, operator):
+    # self.<crossover> > 0 or self.<crossover> < 0
+    return isinstance(test, ast.Compare) and len(test.ops) == 1 and isinstance(test.ops[0], operator) and \
+        _self_attribute(test.left) == crossover and isinstance(test.comparators[0], ast.Constant) and \
+        test.comparators[0].value == 0
+
+
+def _exit_threshold(test, close, operators, sign):
+    '''
+    finds the param p of self.<close>[0] >= self.buyprice * (1.0 + self.params.p) (operators GtE/Gt, sign '+') or
+    self.<close>[0] <= self.buyprice * (1.0 - self.params.p) (operators LtE/Lt, sign '-').
+    :return: param name: str or None
+    '''
+    if not (isinstance(test, ast.Compare) and len(test.ops) == 1 and isinstance(test.ops[0], operators)):
+        return None
+    left, right = test.left, test.comparators[0]
+    if not (isinstance(left, ast.Subscript) and _self_attribute(left.value) == close and
+            isinstance(left.slice, ast.Constant) and left.slice.value == 0):
+        return None
+    if not (isinstance(right, ast.BinOp) and isinstance(right.op, ast.Mult) and
+            _self_attribute(right.left) == 'buyprice' and isinstance(right.right, ast.BinOp)):
+        return None
+    factor = right.right
+    operator = ast.Add if sign == '+' else ast.Sub
+    if isinstance(factor.op, operator) and isinstance(factor.left, ast.Constant) and factor.left.value == 1:
+        return _self_param(factor.right)
+    return None
+
+
+def _match_next(method, crossover, close):
+    '''
+    checks that next() is the trading logic the engine simulates, logging aside:
+
+        if self.order:
+            return
+        if not self.position:
+            if self.crossover > 0:
+                self.order = self.buy()
+        else:
+            if self.crossover < 0:
+                self.order = self.sell()
+            elif self.dataclose[0] >= self.buyprice * (1.0 + self.params.take_profit):
+                self.order = self.sell()
+            elif self.dataclose[0] <= self.buyprice * (1.0 - self.params.stop_loss):
+                self.order = self.sell()
+
+    The take profit and stop loss branches are optional and may come in any order after the cross exit.
+    :param method: ast.FunctionDef
+    :param crossover: str, attribute of the CrossOver indicator
+    :param close: str, attribute of the close line
+    :return: (take_profit, stop_loss) param names or None, or None if next() differs
+    '''
+    body = _block(method.body)
+    if len(body) != 2:
+        return None
+    guard, position = body
+    if not (isinstance(guard, ast.If) and _self_attribute(guard.test) == 'order' and not guard.orelse and
+            len(guard.body) == 1 and isinstance(guard.body[0], ast.Return) and guard.body[0].value is None):
+        return None
+    if not (isinstance(position, ast.If) and isinstance(position.test, ast.UnaryOp) and
+            isinstance(position.test.op, ast.Not) and _self_attribute(position.test.operand) == 'position'):
+        return None
+
+    entry = _block(position.body)
+    if not (len(entry) == 1 and isinstance(entry[0], ast.If) and not entry[0].orelse and
+            _is_cross(entry[0].test, crossover, ast.Gt)):
+        return None
+    entry_orders = _block(entry[0].body)
+    if not (len(entry_orders) == 1 and _is_order(entry_orders[0], ('buy',))):
+        return None
+
+    # elif chain of exits
+    exits = _block(position.orelse)
+    conditions = []
+    while exits:
+        if not (len(exits) == 1 and isinstance(exits[0], ast.If)):
+            return None
+        branch = _block(exits[0].body)
+        if not (len(branch) == 1 and _is_order(branch[0], ('sell', 'close'))):
+            return None
+        conditions.append(exits[0].test)
+        exits = _block(exits[0].orelse)
+    if not conditions or not _is_cross(conditions[0], crossover, ast.Lt):
+        return None
+
+    take_profit = stop_loss = None
+    for test in conditions[1:]:
+        profit = _exit_threshold(test, close, (ast.GtE,), '+')
+        loss = _exit_threshold(test, close, (ast.LtE,), '-')
+        if profit is not None and take_profit is None:
+            take_profit = profit
+        elif loss is not None and stop_loss is None:
+            stop_loss = loss
+        else:
+            return None
+    return take_profit, stop_loss
+
+
+def detect_signal_strategy(code):
+    '''
+    checks whether the strategy in the code belongs to the supported subset and maps its params onto the engine.
+
+    Example result for resources/example_backtest.py:
+        {'strategy': 'SmaCross', 'fast': 'pfast', 'slow': 'pslow',
+         'take_profit': 'take_profit', 'stop_loss': 'stop_loss', 'defaults': {'pfast': 10, ...}}
+
+    fast/slow are param names or fixed integer periods, take_profit/stop_loss are param names or None.
+    :param code: str
+    :return: signal spec: dict, or None if the strategy is not supported
+    '''
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+
+    spec = strategy_loader.parse_backtest_spec(code)
+    if spec['strategy'] is None or len(spec['feeds']) != 1 or data_cache.memmap_feed_kwargs(spec['feeds'][0]) is None:
+        return None
+    if spec['sizer'] is not None and spec['sizer']['sizer'] not in ('FixedSize', 'SizerFix'):
+        return None
+    if spec['commission'] is not None and set(spec['commission']) - {'commission'}:
+        return None
+
+    classes = [node for node in tree.body if isinstance(node, ast.ClassDef) and node.name == spec['strategy']]
+    if not classes:
+        return None
+    methods = {node.name: node for node in classes[0].body if isinstance(node, ast.FunctionDef)}
+    if '__init__' not in methods or 'next' not in methods:
+        return None
+
+    # params with their defaults
+    defaults = {}
+    for node in classes[0].body:
+        if isinstance(node, ast.Assign) and any(getattr(t, 'id', None) == 'params' for t in node.targets):
+            try:
+                value = ast.literal_eval(node.value)
+            except ValueError:
+                return None
+            defaults = dict(value)
+
+    # indicators: two SMAs and one CrossOver of them
+    periods = {}
+    crossover = None
+    for node in ast.walk(methods['__init__']):
+        if not (isinstance(node, ast.Assign) and isinstance(node.value, ast.Call)):
+            continue
+        target = _self_attribute(node.targets[0])
+        name = strategy_loader._attribute_chain(node.value.func)[-1:]
+        if not target or not name:
+            continue
+        if name[0] in _SMA_NAMES:
+            period = [kw.value for kw in node.value.keywords if kw.arg == 'period']
+            if not period:
+                return None
+            param = _self_param(period[0])
+            if param is None:
+                try:
+                    param = int(ast.literal_eval(period[0]))
+                except ValueError:
+                    return None
+            periods[target] = param
+        elif name[0] in ('CrossOver', 'CrossOverIndicator'):
+            crossover = (target, [_self_attribute(arg) for arg in node.value.args])
+        elif 'indicators' in strategy_loader._attribute_chain(node.value.func) or \
+                'ind' in strategy_loader._attribute_chain(node.value.func):
+            # any other indicator is outside the supported subset
+            return None
+
+    if crossover is None or len(crossover[1]) != 2 or not all(arg in periods for arg in crossover[1]):
+        return None
+
+    # close line compared by the exits, the entry price is the fill price recorded in notify_order()
+    closes = [target for target in ('dataclose', 'close')
+              if any(ast.unparse(value) in _CLOSE_LINES for value in _assigned(methods['__init__'], target))]
+    if 'notify_order' not in methods or not closes:
+        return None
+    if [ast.unparse(value) for value in _assigned(methods['notify_order'], 'buyprice')] != ['order.executed.price']:
+        return None
+    # a pending order is released in notify_order(), otherwise the strategy stops trading
+    if not any(isinstance(value, ast.Constant) and value.value is None
+               for value in _assigned(methods['notify_order'], 'order')):
+        return None
+
+    # next(): exactly the trading logic of the engine
+    matched = _match_next(methods['next'], crossover[0], closes[0])
+    if matched is None:
+        return None
+    take_profit, stop_loss = matched
+
+    return {'strategy': spec['strategy'],
+            'fast': periods[crossover[1][0]],
+            'slow': periods[crossover[1][1]],
+            'take_profit': take_profit,
+            'stop_loss': stop_loss,
+            'defaults': defaults}
+
+
+def sma(values, period):
+    '''
+    simple moving average, NaN until period values are available.
+    :param values: numpy array
+    :param period: int
+    :return: numpy array
+    '''
+    result = np.full(len(values), np.nan)
+    if period <= len(values):
+        result[period - 1:] = np.lib.stride_tricks.sliding_window_view(values, period).mean(axis=1)
+    return result
+
+
+def crossover(fast, slow):
+    '''
+    backtrader's CrossOver: +1 when fast crosses above slow, -1 when it crosses below, 0 otherwise.
+    Equal values do not end a cross, the last non-zero difference is carried forward.
+    :param fast: numpy array
+    :param slow: numpy array
+    :return: numpy array of -1, 0, 1
+    '''
+    diff = fast - slow
+    valid = ~np.isnan(diff)
+    nzd = np.where(valid & (diff != 0), diff, np.nan)
+
+    # carry the last non-zero difference forward, the first valid bar seeds it with its raw difference
+    first = np.argmax(valid) if valid.any() else len(diff)
+    if first < len(diff):
+        nzd[first] = diff[first]
+    index = np.where(~np.isnan(nzd), np.arange(len(nzd)), 0)
+    np.maximum.accumulate(index, out=index)
+    nzd = nzd[index]
+
+    previous = np.concatenate(([np.nan], nzd[:-1]))
+    cross = np.zeros(len(diff))
+    cross[(previous < 0) & (diff > 0)] = 1
+    cross[(previous > 0) & (diff < 0)] = -1
+    return cross
+
+
+class VectorizedBacktest:
+    """
+    Runs a supported signal strategy (see detect_signal_strategy) on NumPy arrays.
+    The data feed is loaded once from the memory-mapped market data cache, moving averages are computed once per
+    period and shared between parameter combinations.
+    """
+    def __init__(self, code, data_dir = None, cache_dir = data_cache.DEFAULT_CACHE_DIR):
+        """
+        Constructs a new vectorized backtest.
+        Args:
+            code: generated backtrader code
+            data_dir: directory in which relative data file names are looked up
+            cache_dir: market data cache directory
+        """
+        self.signal = detect_signal_strategy(code)
+        if self.signal is None:
+            raise ValueError('strategy is not supported by the vectorized engine')
+
+        self.spec = strategy_loader.parse_backtest_spec(code)
+        feed_kwargs = data_cache.memmap_feed_kwargs(self.spec['feeds'][0])
+        arrays = data_cache.MarketDataCache(cache_dir=cache_dir).load(
+            strategy_loader.resolve_data_path(feed_kwargs['dataname'], data_dir),
+            source_feed=feed_kwargs['sourcefeed'],
+            source_kwargs=feed_kwargs['sourcekwargs'])
+
+        # same date filter as backtrader feeds
+        dt = np.asarray(arrays['datetime'])
+        mask = np.ones(len(dt), dtype=bool)
+        if feed_kwargs.get('fromdate') is not None:
+            mask &= dt >= bt.date2num(feed_kwargs['fromdate'])
+        if feed_kwargs.get('todate') is not None:
+            mask &= dt <= bt.date2num(feed_kwargs['todate'])
+
+        self.datetime = dt[mask]
+        self.open = np.asarray(arrays['open'])[mask]
+        self.close = np.asarray(arrays['close'])[mask]
+        self.years = np.array([bt.num2date(x).year for x in self.datetime])
+
+        self.cash = self.spec['cash'] if self.spec['cash'] is not None else 10000.0
+        self.stake = self.spec['sizer']['kwargs'].get('stake', 1) if self.spec['sizer'] is not None else 1
+        self.commission = (self.spec['commission'] or {}).get('commission', 0.0)
+
+        self._sma_cache = {}
+
+    def _sma(self, period):
+        if period not in self._sma_cache:
+            self._sma_cache[period] = sma(self.close, period)
+        return self._sma_cache[period]
+
+    def _param(self, params, name):
+        '''
+        resolves an engine input from the params (falling back to the strategy defaults) or a fixed value.
+        '''
+        if name is None:
+            return None
+        if not isinstance(name, str):
+            return name
+        return params.get(name, self.signal['defaults'].get(name))
+
+    def simulate(self, params):
+        '''
+        simulates one parameter combination.
+        :param params: dict
+        :return: simulation: dict with value (portfolio value per bar) and trades (list of dict)
+        '''
+        fast_period = int(self._param(params, self.signal['fast']))
+        slow_period = int(self._param(params, self.signal['slow']))
+        take_profit = self._param(params, self.signal['take_profit'])
+        stop_loss = self._param(params, self.signal['stop_loss'])
+
+        fast = self._sma(fast_period)
+        slow = self._sma(slow_period)
+        cross = crossover(fast, slow)
+
+        n = len(self.close)
+        # next() starts once the crossover has a previous value
+        first_bar = max(fast_period, slow_period)
+        cross[:first_bar] = 0
+
+        # exit condition per bar, relative to an entry price filled in per trade
+        entry_signals = np.flatnonzero(cross > 0)
+        exit_cross = cross < 0
+
+        cash = self.cash
+        size = self.stake
+        position = np.zeros(n)
+        cash_path = np.full(n, np.nan)
+        trades = []
+        cursor = 0
+
+        while True:
+            # next entry signal at or after the cursor; the order fills at the next open
+            candidates = entry_signals[np.searchsorted(entry_signals, cursor):]
+            entry = None
+            for signal_bar in candidates:
+                if signal_bar + 1 >= n:
+                    break
+                # submission check at the creating bar's close
+                if cash - size * self.close[signal_bar] * (1 + self.commission) < 0:
+                    continue
+                # execution check at the fill price
+                if cash - size * self.open[signal_bar + 1] * (1 + self.commission) < 0:
+                    continue
+                entry = signal_bar
+                break
+            if entry is None:
+                break
+
+            fill = entry + 1
+            entry_price = self.open[fill]
+            entry_comm = size * entry_price * self.commission
+            cash_path[cursor:fill] = cash
+            cash -= size * entry_price + entry_comm
+
+            # first bar from the fill on whose close triggers an exit
+            exits = exit_cross[fill:].copy()
+            closes = self.close[fill:]
+            if take_profit is not None:
+                exits |= closes >= entry_price * (1.0 + take_profit)
+            if stop_loss is not None:
+                exits |= closes <= entry_price * (1.0 - stop_loss)
+            hits = np.flatnonzero(exits)
+
+            if not len(hits) or fill + hits[0] + 1 >= n:
+                # position is still open at the end
+                position[fill:] = size
+                cash_path[fill:] = cash
+                cursor = n
+                break
+
+            exit_fill = fill + hits[0] + 1
+            exit_price = self.open[exit_fill]
+            exit_comm = size * exit_price * self.commission
+            position[fill:exit_fill] = size
+            cash_path[fill:exit_fill] = cash
+            cash += size * exit_price - exit_comm
+
+            pnl = size * (exit_price - entry_price)
+            trades.append({'entry_bar': int(fill), 'exit_bar': int(exit_fill),
+                           'entry_dt': bt.num2date(self.datetime[fill]).isoformat(),
+                           'exit_dt': bt.num2date(self.datetime[exit_fill]).isoformat(),
+                           'size': size, 'entry_price': float(entry_price), 'exit_price': float(exit_price),
+                           'pnl': float(pnl), 'pnlcomm': float(pnl - entry_comm - exit_comm)})
+            cursor = exit_fill
+
+        cash_path[cursor:] = np.where(np.isnan(cash_path[cursor:]), cash, cash_path[cursor:])
+        value = cash_path + position * self.close
+        return {'value': value, 'trades': trades}
+
+    def metrics(self, simulation):
+        '''
+        computes the sweep metrics of a simulation, matching backtrader's SharpeRatio (yearly, riskfreerate 0.01),
+        DrawDown, Returns and TradeAnalyzer defaults.
+        :param simulation: dict from simulate()
+        :return: metrics: dict
+        '''
+        value = simulation['value']
+        trades = simulation['trades']
+        start_value = self.cash
+
+        # drawdown on the portfolio value
+        peak = np.maximum.accumulate(value)
+        moneydown = peak - value
+        drawdown = 100.0 * moneydown / peak
+
+        # yearly returns, each year relative to the last value of the previous one
+        year_ends = np.flatnonzero(np.diff(self.years)) if len(self.years) else np.array([], dtype=int)
+        period_end_values = np.concatenate((value[year_ends], value[-1:]))
+        period_start_values = np.concatenate(([start_value], period_end_values[:-1]))
+        excess = period_end_values / period_start_values - 1.0 - 0.01
+        std = excess.std() if len(excess) else 0.0
+        sharpe = float(excess.mean() / std) if len(excess) and std > 0 else None
+
+        final_value = float(value[-1]) if len(value) else start_value
+        ratio = final_value / start_value
+        total_return = math.log(ratio) if ratio > 0 else float('-inf')
+        annual_return = math.expm1(total_return / len(value) * 252.0) if len(value) else 0.0
+
+        pnls = np.array([trade['pnlcomm'] for trade in trades])
+        return {'sharpe': sharpe,
+                'max_drawdown': float(drawdown.max()) if len(value) else 0.0,
+                'max_moneydown': float(moneydown.max()) if len(value) else 0.0,
+                'total_return': total_return,
+                'annual_return': annual_return,
+                'total_trades': len(trades),
+                'won_trades': int((pnls >= 0).sum()) if len(pnls) else 0,
+                'lost_trades': int((pnls < 0).sum()) if len(pnls) else 0,
+                'pnl_net': float(pnls.sum()) if len(pnls) else 0.0,
+                'final_value': final_value}
+
+    def run(self, params):
+        '''
+        runs one parameter combination.
+        :param params: dict
+        :return: row: dict with the params and the metrics
+        '''
+        row = dict(params)
+        row.update(self.metrics(self.simulate(params)))
+        return row
+
+    def run_many(self, combinations):
+        '''
+        runs many parameter combinations, sharing moving averages between them.
+        :param combinations: list of dict
+        :return: results: pandas.DataFrame
+        '''
+        import pandas as pd
+        return pd.DataFrame([self.run(params) for params in combinations])
+
+
+def parity_check(code, combinations, data_dir = None, cache_dir = data_cache.DEFAULT_CACHE_DIR, rel_tol = 1e-6):
+    '''
+    runs the combinations with the vectorized engine and with backtrader and compares the metrics.
+    :param code: str
+    :param combinations: list of dict
+    :param data_dir: str
+    :param cache_dir: str
+    :param rel_tol: float, relative tolerance
+    :return: comparison: pandas.DataFrame with one row per combination and metric, column 'match'
+    '''
+    import pandas as pd
+    import optimiser
+
+    engine = VectorizedBacktest(code, data_dir=data_dir, cache_dir=cache_dir)
+    optimiser._init_worker(code, data_dir, cache_dir)
+
+    rows = []
+    for params in combinations:
+        vectorized = engine.run(params)
+        reference = optimiser._run_combination(params)
+        for metric in ('sharpe', 'max_drawdown', 'total_return', 'total_trades', 'won_trades', 'lost_trades',
+                       'pnl_net', 'final_value'):
+            a, b = vectorized.get(metric), reference.get(metric)
+            if a is None or b is None:
+                match = a is None and b is None
+            else:
+                match = math.isclose(a, b, rel_tol=rel_tol, abs_tol=1e-9)
+            rows.append({**params, 'metric': metric, 'vectorized': a, 'backtrader': b, 'match': match})
+    return pd.DataFrame(rows)
@@ -0,0 +1,341 @@
+import contextlib
+import io
+import math
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+import backtrader as bt
+import numpy as np
+import pandas as pd
+import data_cache
+import strategy_loader
+from backtest_runner import _Recorder
+from optimiser import _init_worker, _worker, params_key, prepare_feeds
+
+"""
+Walk-forward validation of generated backtests.
+The date range of the backtest is split into consecutive out-of-sample windows, each preceded by an in-sample window
+that is either rolling (fixed length) or anchored (starts with the data). The params are optimised on every in-sample
+window and the best combination is evaluated on the following out-of-sample window. Out-of-sample runs start with the
+in-sample bars as indicator warm-up, orders are only accepted from the start of the out-of-sample window.
+All runs of all windows share one process pool; the workers load the data feeds once and slice every window from the
+memory-mapped cache. A window's out-of-sample run starts as soon as its in-sample runs are done.
+Metrics are computed from the equity curve, so they are comparable between windows of any length.
+"""
+
+_PERIOD = re.compile(r'^\s*(\d+)\s*([DWMY])\s*$', re.IGNORECASE)
+_PERIOD_UNITS = {'D': 'days', 'W': 'weeks', 'M': 'months', 'Y': 'years'}
+
+# last moment before a window boundary, todate of backtrader feeds is inclusive
+_BEFORE = timedelta(microseconds=1)
+
+
+def period_offset(period):
+    '''
+    parses a window length.
+    :param period: str such as '90D', '6M', '2Y', an int (days) or a pandas.DateOffset
+    :return: pandas.DateOffset
+    '''
+    if isinstance(period, pd.DateOffset):
+        return period
+    if isinstance(period, int):
+        return pd.DateOffset(days=period)
+    match = _PERIOD.match(str(period))
+    if match is None:
+        raise ValueError(f'invalid period {period}, expected e.g. 90D, 4W, 6M or 2Y')
+    return pd.DateOffset(**{_PERIOD_UNITS[match.group(2).upper()]: int(match.group(1))})
+
+
+def walk_forward_windows(start, end, in_sample, out_of_sample, anchored = False):
+    '''
+    splits a date range into in-sample and out-of-sample windows. The out-of-sample windows are consecutive and cover
+    the range after the first in-sample window, the last one may be shorter.
+    :param start: datetime
+    :param end: datetime, exclusive
+    :param in_sample: period, see period_offset()
+    :param out_of_sample: period
+    :param anchored: bool, every in-sample window starts at start instead of rolling
+    :return: windows: list of dict with keys in_sample and out_of_sample, each a (start, end) tuple with exclusive end
+    '''
+    in_sample = period_offset(in_sample)
+    out_of_sample = period_offset(out_of_sample)
+
+    windows = []
+    oos_start = pd.Timestamp(start) + in_sample
+    while oos_start < pd.Timestamp(end):
+        oos_end = min(oos_start + out_of_sample, pd.Timestamp(end))
+        is_start = pd.Timestamp(start) if anchored else oos_start - in_sample
+        windows.append({'in_sample': (is_start.to_pydatetime(), oos_start.to_pydatetime()),
+                        'out_of_sample': (oos_start.to_pydatetime(), oos_end.to_pydatetime())})
+        oos_start = oos_end
+    return windows
+
+
+def equity_metrics(datetimes, values, trades = ()):
+    '''
+    metrics of an equity curve, with the keys of optimiser.flatten_analysis().
+    sharpe is annualised from the bar returns without risk free rate, max_drawdown in percent, total_return is the log
+    return like bt.analyzers.Returns.
+    :param datetimes: sequence of backtrader date numbers
+    :param values: sequence of portfolio values
+    :param trades: closed trades as recorded by backtest_runner._Recorder
+    :return: metrics: dict
+    '''
+    values = np.asarray(values, dtype=float)
+    metrics = {'sharpe': None, 'max_drawdown': 0.0, 'max_moneydown': 0.0, 'total_return': 0.0, 'annual_return': 0.0,
+               'total_trades': len(trades),
+               'won_trades': sum(1 for trade in trades if trade['pnl_net'] > 0),
+               'lost_trades': sum(1 for trade in trades if trade['pnl_net'] < 0),
+               'pnl_net': float(sum(trade['pnl_net'] for trade in trades))}
+    if len(values) < 2 or values[0] <= 0:
+        return metrics
+
+    peak = np.maximum.accumulate(values)
+    metrics['max_drawdown'] = float(((peak - values) / peak).max() * 100)
+    metrics['max_moneydown'] = float((peak - values).max())
+    metrics['total_return'] = float(math.log(values[-1] / values[0]))
+
+    years = (datetimes[-1] - datetimes[0]) / 365.25
+    returns = values[1:] / values[:-1] - 1
+    if years > 0:
+        metrics['annual_return'] = float(math.exp(metrics['total_return'] / years) - 1)
+        deviation = returns.std(ddof=1)
+        if deviation > 0:
+            metrics['sharpe'] = float(returns.mean() / deviation * math.sqrt(len(returns) / years))
+    return metrics
+
+
+def _out_of_sample(strategy_cls, trade_from):
+    '''
+    subclass of a strategy that ignores orders before trade_from, the bars before serve as indicator warm-up.
+    :param strategy_cls: bt.Strategy subclass
+    :param trade_from: float, backtrader date number
+    :return: class
+    '''
+    class OutOfSample(strategy_cls):
+        def _trading(self):
+            return self.datetime[0] >= trade_from
+
+        # close() and order_target_*() place their orders through buy() and sell()
+        def buy(self, *args, **kwargs):
+            return super(OutOfSample, self).buy(*args, **kwargs) if self._trading() else None
+
+        def sell(self, *args, **kwargs):
+            return super(OutOfSample, self).sell(*args, **kwargs) if self._trading() else None
+
+        def buy_bracket(self, *args, **kwargs):
+            return super(OutOfSample, self).buy_bracket(*args, **kwargs) if self._trading() else [None, None, None]
+
+        def sell_bracket(self, *args, **kwargs):
+            return super(OutOfSample, self).sell_bracket(*args, **kwargs) if self._trading() else [None, None, None]
+
+    OutOfSample.__name__ = strategy_cls.__name__
+    return OutOfSample
+
+
+def _run_window(params, fromdate, todate, trade_from = None):
+    '''
+    runs one parameter combination on a date window in a worker process, see optimiser._init_worker().
+    :param params: dict
+    :param fromdate: datetime
+    :param todate: datetime, inclusive
+    :param trade_from: datetime or None. Out-of-sample run: orders are accepted from this date, the equity curve and
+    the metrics start there.
+    :return: result: dict with keys metrics, and datetime, value and trades for out-of-sample runs
+    '''
+    spec = _worker['spec']
+    strategy = _worker['strategy']
+    if trade_from is not None:
+        strategy = _out_of_sample(strategy, bt.date2num(trade_from))
+
+    cerebro = bt.Cerebro(stdstats=False)
+    for make_feed in _worker['feeds']:
+        cerebro.adddata(make_feed(fromdate=fromdate, todate=todate))
+    cerebro.addstrategy(strategy, **{**spec['strategy_kwargs'], **params})
+    strategy_loader.configure_cerebro(cerebro, spec, analyzers=False)
+    cerebro.addanalyzer(_Recorder, _name='recorder')
+
+    # generated strategies log every order, keep the worker output quiet
+    with contextlib.redirect_stdout(io.StringIO()):
+        recorder = cerebro.run()[0].analyzers.recorder
+
+    datetimes = np.asarray(recorder.datetimes)
+    values = np.asarray(recorder.values)
+    if trade_from is None:
+        return {'metrics': equity_metrics(datetimes, values, recorder.trades)}
+
+    first = int(np.searchsorted(datetimes, bt.date2num(trade_from), side='left'))
+    return {'metrics': equity_metrics(datetimes[first:], values[first:], recorder.trades),
+            'datetime': datetimes[first:].tolist(),
+            'value': values[first:].tolist(),
+            'trades': recorder.trades}
+
+
+class WalkForward:
+    """
+    Walk-forward optimisation and out-of-sample evaluation of a generated strategy across a process pool.
+    """
+    def __init__(self, code, data_dir = None, max_workers = None, cache_dir = data_cache.DEFAULT_CACHE_DIR):
+        """
+        Constructs a new walk-forward test.
+        Args:
+            code: generated backtrader code containing the strategy and the Cerebro setup
+            data_dir: directory in which relative data file names are looked up
+            max_workers: number of worker processes, defaults to all cores
+            cache_dir: market data cache directory
+        """
+        self.code = code
+        self.data_dir = data_dir
+        self.max_workers = max_workers or os.cpu_count()
+        self.cache_dir = cache_dir
+
+        self.spec = strategy_loader.parse_backtest_spec(code)
+        if self.spec['strategy'] is None:
+            raise ValueError('no cerebro.addstrategy(...) call found in the code')
+        if not self.spec['feeds']:
+            raise ValueError('no bt.feeds data feed found in the code')
+
+    def date_range(self):
+        '''
+        date range of the backtest: fromdate/todate of the first feed, else the first and last bar of its data.
+        :return: (start: datetime, end: datetime, exclusive)
+        '''
+        feed_spec = self.spec['feeds'][0]
+        start, end = feed_spec['kwargs'].get('fromdate'), feed_spec['kwargs'].get('todate')
+        if start is None or end is None:
+            bars = strategy_loader.preload_feed(feed_spec, self.data_dir)
+            start = start or bars.index[0].to_pydatetime()
+            end = end or bars.index[-1].to_pydatetime()
+        # a todate without time includes the whole day
+        if isinstance(end, datetime) and end.time() == datetime.min.time():
+            end = end + timedelta(days=1)
+        return start, end
+
+    def run(self, combinations, in_sample = '1Y', out_of_sample = '3M', anchored = False, metric = 'sharpe',
+            maximise = True):
+        '''
+        optimises on every in-sample window and evaluates the best combination on the following window.
+        :param combinations: list of dict, e.g. from optimiser.parameter_grid() or optimiser.random_search()
+        :param in_sample: period of the in-sample windows, see period_offset()
+        :param out_of_sample: period of the out-of-sample windows
+        :param anchored: bool, in-sample windows start with the data instead of rolling
+        :param metric: key of equity_metrics() the in-sample runs are ranked by
+        :param maximise: bool, False selects the combination with the lowest metric (e.g. max_drawdown)
+        :return: result: dict with keys
+            windows: pandas.DataFrame, one row per window with its dates, the selected params, the in-sample metric
+                     and the out-of-sample metrics
+            equity_curve: pandas.Series, out-of-sample equity of all windows chained together
+            metrics: dict, see equity_metrics(), of the chained out-of-sample equity
+            trades: list of dict, out-of-sample trades of all windows
+        '''
+        start, end = self.date_range()
+        windows = walk_forward_windows(start, end, in_sample, out_of_sample, anchored=anchored)
+        if not windows:
+            raise ValueError(f'the backtest from {start:%Y-%m-%d} to {end:%Y-%m-%d} is shorter than one in-sample '
+                             f'and one out-of-sample window')
+
+        prepare_feeds(self.spec, self.data_dir, self.cache_dir)
+
+        in_sample_results = [{} for _ in windows]
+        selected = {}
+        out_of_sample_results = {}
+        with ProcessPoolExecutor(max_workers=min(self.max_workers, len(windows) * len(combinations)),
+                                 initializer=_init_worker,
+                                 initargs=(self.code, self.data_dir, self.cache_dir)) as executor:
+            pending = {}
+            for index, window in enumerate(windows):
+                is_start, is_end = window['in_sample']
+                for params in combinations:
+                    future = executor.submit(_run_window, params, is_start, is_end - _BEFORE)
+                    pending[future] = ('in_sample', index, params)
+            remaining = [len(combinations)] * len(windows)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    phase, index, params = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"Walk-forward {phase.replace('_', '-')} run of window {index} failed: {str(e)}")
+                        result = None
+
+                    if phase == 'out_of_sample':
+                        if result is not None:
+                            out_of_sample_results[index] = (params, result)
+                        continue
+
+                    if result is not None:
+                        in_sample_results[index][params_key(params)] = (params, result['metrics'])
+                    remaining[index] -= 1
+                    if remaining[index] == 0:
+                        best = self._select(in_sample_results[index].values(), metric, maximise)
+                        if best is None:
+                            print(f'Walk-forward window {index} skipped: no in-sample run has a {metric}')
+                            continue
+                        is_start, _ = windows[index]['in_sample']
+                        oos_start, oos_end = windows[index]['out_of_sample']
+                        future = executor.submit(_run_window, best[0], is_start, oos_end - _BEFORE, oos_start)
+                        pending[future] = ('out_of_sample', index, best[0])
+                        selected[index] = best
+
+        return self._stitch(windows, selected, out_of_sample_results, metric)
+
+    @staticmethod
+    def _select(results, metric, maximise):
+        '''
+        best in-sample combination.
+        :param results: iterable of (params, metrics)
+        :return: (params, metrics) or None if no run has a value for the metric
+        '''
+        ranked = [(params, metrics) for params, metrics in results if metrics.get(metric) is not None]
+        if not ranked:
+            return None
+        select = max if maximise else min
+        return select(ranked, key=lambda item: item[1][metric])
+
+    def _stitch(self, windows, selected, out_of_sample_results, metric):
+        '''
+        chains the out-of-sample equity curves: every window continues with the final value of the previous one.
+        :param windows: list of dict, see walk_forward_windows()
+        :param selected: dict mapping window index to the best in-sample (params, metrics)
+        :param out_of_sample_results: dict mapping window index to (params, result of _run_window())
+        :param metric: str
+        :return: result dict, see run()
+        '''
+        rows = []
+        datetimes = []
+        values = []
+        trades = []
+        level = None
+        for index, window in enumerate(windows):
+            if index not in out_of_sample_results:
+                continue
+            params, result = out_of_sample_results[index]
+            segment = np.asarray(result['value'])
+            if len(segment) == 0:
+                continue
+            if level is None:
+                level = segment[0]
+            segment = segment / segment[0] * level
+            level = segment[-1]
+            datetimes.extend(result['datetime'])
+            values.extend(segment.tolist())
+            trades.extend(result['trades'])
+
+            row = {'window': index,
+                   'in_sample_start': window['in_sample'][0],
+                   'out_of_sample_start': window['out_of_sample'][0],
+                   'out_of_sample_end': window['out_of_sample'][1]}
+            row.update(params)
+            row[f'in_sample_{metric}'] = selected[index][1][metric]
+            row.update({f'oos_{key}': value for key, value in result['metrics'].items()})
+            rows.append(row)
+
+        equity_curve = pd.Series(values, index=pd.DatetimeIndex([bt.num2date(value) for value in datetimes],
+                                                                name='datetime'), name='value')
+        return {'windows': pd.DataFrame(rows),
+                'equity_curve': equity_curve,
+                'metrics': equity_metrics(datetimes, values, trades),
+                'trades': trades}